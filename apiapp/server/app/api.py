@@ -1,7 +1,7 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-# from fastapi.concurrency import asynccontextmanager
+from fastapi.concurrency import asynccontextmanager
 # import asyncio
 
 # from app.configs.settings import get_settings
@@ -15,12 +15,23 @@ from app.routes.core import router as core_router
 
 # WebRTC: RTSP streaming
 from app.routes.webrtc import router as webrtc_router
+from app.routes.webrtc import start_webrtc, cleanup_webrtc
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # закреплённые камеры подключаются сразу, остальные -- по первому зрителю
+    await start_webrtc()
+    yield
+    await cleanup_webrtc()
+
 
 app = FastAPI(
     title="aivideolab",
     version="0.1.0",
     description="Система распознавания мимико-пантомимических и речевых признаков",
     root_path="/api/v1",
+    lifespan=lifespan,
 )
 
 # CORS middleware using settings
@@ -35,9 +35,181 @@ class Settings(BaseSettings):
 
     CUSTOM_TMP_DIR: Optional[Path] = None
 
+    # Потоковая загрузка: тело запроса пишется на диск блоками такого размера
+    # (пока пишется один, принимается следующий -- в памяти не больше двух)
+    UPLOAD_CHUNK_BYTES: int = 1024 * 1024
+
     # Префикс маршрутов API
     FILES_API_PREFIX: str = "/core"
 
+    # --- Ниже часть, связанная с RTSP/WebRTC ---
+
+    # Режим источника по умолчанию: auto | passthrough | transcode
+    # auto -- H.264 передаётся без перекодирования, остальное (H.265) перекодируется
+    WEBRTC_SOURCE_MODE: str = "auto"
+
+    # Таймауты подключения к камере и чтения из неё, секунды
+    RTSP_OPEN_TIMEOUT: float = 5.0
+    RTSP_READ_TIMEOUT: float = 10.0
+    # Сколько камер можно открывать одновременно (потоки вне event loop)
+    RTSP_OPEN_WORKERS: int = 4
+
+    # Переподключение к камере при обрыве: зрители остаются подключены, пока камера
+    # недоступна, им повторяется последний кадр. Пауза между попытками растёт
+    # от MIN до MAX (со случайным разбросом); через GIVE_UP секунд источник закрывается (0 -- никогда)
+    RTSP_RECONNECT: bool = True
+    RTSP_RECONNECT_MIN_DELAY: float = 0.5
+    RTSP_RECONNECT_MAX_DELAY: float = 30.0
+    RTSP_RECONNECT_GIVE_UP: float = 300.0
+    # Как часто повторять последний кадр, пока камеры нет, секунды
+    WEBRTC_PLACEHOLDER_INTERVAL: float = 1.0
+
+    # Сколько секунд держать камеру открытой после ухода последнего зрителя:
+    # перезагрузка страницы подхватывает ту же RTSP-сессию (0 -- закрывать сразу)
+    RTSP_SOURCE_GRACE: float = 10.0
+
+    # Уборка зависших соединений: ICE и DTLS должны установиться за отведённое время,
+    # соединение без медиа в обе стороны дольше MEDIA_TIMEOUT закрывается. Секунды
+    WEBRTC_ICE_TIMEOUT: float = 15.0
+    WEBRTC_CONNECT_TIMEOUT: float = 30.0
+    WEBRTC_MEDIA_TIMEOUT: float = 30.0
+    WEBRTC_REAP_INTERVAL: float = 5.0
+
+    # Допуск новых соединений: сверх лимитов предложение получает 503 с Retry-After
+    # (0 -- без лимита). Задержка event loop в секундах, CPU в процентах одного ядра
+    WEBRTC_MAX_CONNECTIONS: int = 0
+    WEBRTC_MAX_TRANSCODE_SOURCES: int = 0
+    WEBRTC_MAX_LOOP_LAG: float = 0.0
+    WEBRTC_MAX_CPU_PERCENT: float = 0.0
+    WEBRTC_RETRY_AFTER: int = 5
+    # Приоритетный класс (консоли операторов): заголовок X-Priority-Token с этим токеном
+    # даёт дополнительные соединения сверх лимита и не отсекается по нагрузке
+    WEBRTC_PRIORITY_TOKEN: str = ""
+    WEBRTC_PRIORITY_CONNECTIONS: int = 5
+
+    # STUN-серверы, по которым сервер собирает свои кандидаты для WHEP/WHIP. Пусто --
+    # только host-кандидаты: ответ отдаётся сразу, без ожидания сбора кандидатов
+    WEBRTC_SERVER_ICE_SERVERS: list[str] = []
+
+    # Снимки камер (/webrtc/snapshot): кодируются не чаще раза в interval секунд,
+    # кэш в памяти ограничен по размеру. Камеру без зрителей подключаем только
+    # за одним ключевым кадром, не дольше pull_timeout секунд
+    WEBRTC_SNAPSHOT_INTERVAL: float = 2.0
+    WEBRTC_SNAPSHOT_CACHE_BYTES: int = 32 * 1024 * 1024
+    WEBRTC_SNAPSHOT_QUALITY: int = 80
+    WEBRTC_SNAPSHOT_PULL_TIMEOUT: float = 5.0
+
+    # Вывод для клиентов без WebRTC. LL-HLS: видео камеры без перекодирования,
+    # части по part_target секунд, сегменты от ключевого кадра после segment_target,
+    # в памяти последние window сегментов; без запросов idle секунд -- закрываем.
+    # MJPEG: не больше fps кадров в секунду шириной width (0 -- как у камеры)
+    WEBRTC_HLS_PART_TARGET: float = 0.5
+    WEBRTC_HLS_SEGMENT_TARGET: float = 2.0
+    WEBRTC_HLS_WINDOW: int = 6
+    WEBRTC_HLS_IDLE: float = 30.0
+    WEBRTC_MJPEG_FPS: float = 5.0
+    WEBRTC_MJPEG_WIDTH: int = 640
+    WEBRTC_MJPEG_QUALITY: int = 70
+
+    # Кадры камер для процессов анализа на этом хосте: кольцо из slots кадров
+    # в shared memory на камеру и разрешение; подписка живёт lease секунд,
+    # если потребитель её не продлевает
+    WEBRTC_TAP_SLOTS: int = 8
+    WEBRTC_TAP_LEASE: float = 30.0
+
+    # Модель на кадрах всех активных камер, пачками через камеры в пуле процессов.
+    # Пусто -- выключено; "onnx:/models/x.onnx" или "модуль:фабрика"
+    # (заглушка для тестов: "app.services.inference:MeanBrightness").
+    # Кадр без результата за deadline секунд считается пропуском.
+    # decode -- сколько видео декодировать ради модели: full, reduced (декодер
+    # пропускает неопорные кадры и деблокинг) или keyframes (только ключевые);
+    # decode_every -- из декодированных брать каждый N-й (например, каждый 2-й ключевой)
+    WEBRTC_INFERENCE_MODEL: str = ""
+    WEBRTC_INFERENCE_WORKERS: int = 2
+    WEBRTC_INFERENCE_WIDTH: int = 224
+    WEBRTC_INFERENCE_HEIGHT: int = 224
+    WEBRTC_INFERENCE_FPS: float = 5.0
+    WEBRTC_INFERENCE_MAX_BATCH: int = 16
+    WEBRTC_INFERENCE_MAX_WAIT: float = 0.05
+    WEBRTC_INFERENCE_DEADLINE: float = 0.5
+    WEBRTC_INFERENCE_DECODE: str = "full"
+    WEBRTC_INFERENCE_DECODE_EVERY: int = 1
+
+    # Детектор движения на каждой камере: fps раз в секунду яркость кадра,
+    # уменьшенная до width точек по ширине, сравнивается с предыдущей. Движение --
+    # если больше min_area доли точек изменилось больше чем на threshold уровней;
+    # кончилось -- через hold секунд без него. Пока движения нет, кадры не идут
+    # в модель, а записи с motion=true не пишутся. Движение видно и на кадрах,
+    # декодированных с пропусками (decode и decode_every, как у модели)
+    WEBRTC_MOTION: bool = False
+    WEBRTC_MOTION_FPS: float = 5.0
+    WEBRTC_MOTION_WIDTH: int = 160
+    WEBRTC_MOTION_THRESHOLD: float = 20.0
+    WEBRTC_MOTION_MIN_AREA: float = 0.01
+    WEBRTC_MOTION_HOLD: float = 3.0
+    WEBRTC_MOTION_DECODE: str = "reduced"
+    WEBRTC_MOTION_DECODE_EVERY: int = 1
+
+    # Запись камер в storage сессии: фрагментированный MP4 без перекодирования,
+    # новый сегмент на ключевом кадре после стольких секунд или байт
+    RTSP_RECORD_SEGMENT_SECONDS: float = 60.0
+    RTSP_RECORD_SEGMENT_BYTES: int = 256 * 1024 * 1024
+    # Сколько байт может ждать записи на диск; дальше видео выбрасываем до ключевого кадра
+    RTSP_RECORD_QUEUE_BYTES: int = 16 * 1024 * 1024
+    # Запись по событию: не больше стольких секунд до события, по умолчанию столько после
+    RTSP_RECORD_MAX_PRE_EVENT: float = 60.0
+    RTSP_RECORD_POST_EVENT: float = 30.0
+
+    # Сколько секунд комната сигналинга живёт после последней активности
+    WEBRTC_SIGNALING_TTL: float = 300.0
+
+    # Где хранится общее состояние (сигналинг, TURN, владельцы камер): "memory" --
+    # в процессе, одна нода; "redis" -- общий для нескольких реплик сервер Redis
+    WEBRTC_STATE_BACKEND: str = "memory"
+    WEBRTC_STATE_URL: str = "redis://localhost:6379/0"
+    # Нода кластера: id (по умолчанию имя хоста) и адрес, по которому её достают
+    # другие ноды. Пустой адрес -- без маршрутизации между нодами
+    WEBRTC_NODE_ID: str = ""
+    WEBRTC_NODE_URL: str = ""
+    # Нода считается живой столько секунд после последнего heartbeat
+    WEBRTC_NODE_TTL: float = 10.0
+    # Камера закреплена за нодой столько секунд после последнего предложения на неё
+    WEBRTC_CLAIM_TTL: float = 300.0
+
+    # "Закреплённые" камеры: держим подключение постоянно и кэшируем последний GOP,
+    # чтобы новый зритель сразу начинал с ключевого кадра
+    RTSP_PINNED_SOURCES: list[str] = []
+
+    # Очередь кадров на каждого зрителя: сколько кадров он может отстать,
+    # прежде чем начнём выбрасывать старые (задержка не растёт бесконечно)
+    WEBRTC_MAX_QUEUE: int = 10
+
+    # Адаптация под канал зрителя: лесенка масштабов (1.0 -- исходное видео),
+    # уменьшенные копии кодируются в H.264 один раз на источник и делятся между зрителями
+    WEBRTC_ADAPTIVE: bool = False
+    WEBRTC_LADDER: list[float] = [1.0, 0.5, 0.25]
+    # Битрейт полного размера, для ступеней пропорционально числу пикселей
+    WEBRTC_LADDER_BITRATE: int = 2_000_000
+
+    # Процессы-воркеры WebRTC (0 -- всё в текущем процессе). Предложения
+    # раскладываются по воркерам по хэшу адреса камеры, порты base_port + N
+    WEBRTC_WORKERS: int = 0
+    WEBRTC_WORKER_HOST: str = "127.0.0.1"
+    WEBRTC_WORKER_BASE_PORT: int = 8100
+    # Заполняются самим пулом для процессов-воркеров
+    WEBRTC_WORKER_INDEX: int = 0
+    WEBRTC_WORKER_COUNT: int = 1
+
+    # Как часто собирать статистику соединений (getStats) для /webrtc/metrics, секунды:
+    # сбор идёт в фоне, сам запрос метрик отдаёт последний снимок
+    WEBRTC_STATS_INTERVAL: float = 5.0
+
+    # Трассировка задержки кадра по этапам (приём, декодирование, очередь, кодирование,
+    # пакетизация), /webrtc/debug/traces. Выключенная почти ничего не стоит
+    WEBRTC_TRACE: bool = False
+    # Сколько последних кадров хранить на соединение
+    WEBRTC_TRACE_SAMPLES: int = 200
+
     model_config = SettingsConfigDict(
         env_prefix="",  # без префикса; можно задать "APP_"
         env_file=".env",
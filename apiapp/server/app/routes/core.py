@@ -1,16 +1,22 @@
 from typing import Optional
+import os
 import uuid
 import stat
+import time
 import shutil
+import asyncio
+import hashlib
 import zipfile
 import datetime
 import humanize
 
-from fastapi import APIRouter, UploadFile, File, HTTPException, Header, Query
+from fastapi import APIRouter, UploadFile, File, HTTPException, Header, Query, Request
 from fastapi.responses import FileResponse
+from starlette.requests import ClientDisconnect
 
 from app.configs.paths import DirectoryEnum, VALID_DIRECTORIES
 from app.configs.paths import ensure_session_dir, assert_safe_filename
+from app.configs.settings import get_settings
 
 router = APIRouter()
 
@@ -112,9 +118,10 @@ async def upload_file(
     assert_safe_filename(file.filename)
 
     file_path = directory_path / file.filename
+    # копирование -- в потоке: event loop (сигналинг WebRTC) не ждёт диск
+    loop = asyncio.get_running_loop()
     try:
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        await loop.run_in_executor(None, _copy_upload, file.file, file_path)
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=f"Permission denied: {e}")
     except OSError as e:
@@ -123,6 +130,136 @@ async def upload_file(
     return {"message": "File uploaded successfully", "path": str(file_path)}
 
 
+def _copy_upload(source, file_path):
+    with file_path.open("wb") as buffer:
+        shutil.copyfileobj(source, buffer)
+
+
+class _UploadWriter:
+    """
+    Пишет блоки тела запроса во временный файл рядом с целевым и считает
+    sha256 по ходу. Методы блокирующие: вызываются в потоке.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.part_path = file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex[:8]}.part")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.out = None
+
+    def open(self):
+        self.out = self.part_path.open("wb")
+
+    def write(self, data):
+        self.out.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def commit(self):
+        # файл появляется под своим именем только целиком
+        self.out.close()
+        os.replace(self.part_path, self.file_path)
+
+    def abort(self):
+        if self.out is not None:
+            self.out.close()
+        self.part_path.unlink(missing_ok=True)
+
+
+async def _receive_upload(request: Request, writer: _UploadWriter, chunk_bytes: int):
+    """
+    Тело запроса -- в writer блоками по chunk_bytes;
+    следующий блок принимается, пока пишется предыдущий.
+    """
+    loop = asyncio.get_running_loop()
+    pending = None
+    try:
+        buffer = bytearray()
+        async for chunk in request.stream():
+            buffer += chunk
+            if len(buffer) < chunk_bytes:
+                continue
+            if pending is not None:
+                await pending
+            pending = loop.run_in_executor(None, writer.write, buffer)
+            buffer = bytearray()
+        if pending is not None:
+            await pending
+        if buffer:
+            await loop.run_in_executor(None, writer.write, buffer)
+    finally:
+        # ошибка или обрыв: файл закрываем только после блока, который ещё пишется
+        if pending is not None and not pending.done():
+            await asyncio.wait([pending])
+
+
+@router.put("/upload/{directory}/{session_id}/{filename}/")
+async def upload_file_stream(
+    request: Request,
+    session_id: str,
+    directory: DirectoryEnum,
+    filename: str,
+    sha256: Optional[str] = None,
+):
+    """
+    Загрузить файл потоком: тело запроса -- содержимое файла (не multipart).
+    Для больших записей: без промежуточного временного файла, память постоянная,
+    запись на диск -- в потоке. Если передан sha256, он сверяется с полученным.
+    """
+    directory_path = ensure_session_dir(directory, session_id)
+    assert_safe_filename(filename)
+
+    file_path = directory_path / filename
+    loop = asyncio.get_running_loop()
+    writer = _UploadWriter(file_path)
+    started = time.perf_counter()
+    # open/commit в потоке: при отмене запроса поток доделывает своё
+    step = None
+    try:
+        step = loop.run_in_executor(None, writer.open)
+        # shield: отмена не должна отменять сам future, пока поток ещё работает
+        await asyncio.shield(step)
+        await _receive_upload(request, writer, get_settings().UPLOAD_CHUNK_BYTES)
+        checksum = writer.digest.hexdigest()
+        if sha256 is not None and sha256.lower() != checksum:
+            raise HTTPException(
+                status_code=400, detail=f"Checksum mismatch: received sha256 {checksum}"
+            )
+        step = loop.run_in_executor(None, writer.commit)
+        await asyncio.shield(step)
+    except asyncio.CancelledError:
+        # сервер останавливается или запрос снят: убираем за потоком, а не под ним;
+        # abort синхронно -- после отмены в executor уже не уйти
+        try:
+            if step is not None and not step.done():
+                await asyncio.wait([step])
+        finally:
+            writer.abort()
+        raise
+    except Exception as e:
+        await loop.run_in_executor(None, writer.abort)
+        if isinstance(e, ClientDisconnect):
+            raise HTTPException(status_code=400, detail="Upload interrupted by the client")
+        if isinstance(e, PermissionError):
+            raise HTTPException(status_code=403, detail=f"Permission denied: {e}")
+        if isinstance(e, OSError):
+            raise HTTPException(status_code=500, detail=f"Filesystem error: {e}")
+        raise
+
+    seconds = time.perf_counter() - started
+    rate = writer.size / seconds if seconds > 0 else 0.0
+    return {
+        "message": "File uploaded successfully",
+        "path": str(file_path),
+        "size": writer.size,
+        "sha256": checksum,
+        "seconds": round(seconds, 3),
+        "bytes_per_second": round(rate),
+        "throughput": f"{humanize.naturalsize(rate)}/s",
+    }
+
+
 @router.get("/download/{directory}/{session_id}/{filename}/")
 async def download_file(session_id: str, directory: DirectoryEnum, filename: str):
     """
@@ -0,0 +1,136 @@
+import asyncio
+import random
+import secrets
+import time
+from typing import Dict, Optional
+
+from fastapi import Request
+
+from app.services.sources import Source, SourceMode, SourceRegistry
+
+# Header with the token of the priority class (operator consoles)
+PRIORITY_HEADER = "X-Priority-Token"
+
+
+class Overloaded(Exception):
+    """The server is over its budget: the client has to come back later"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Server is overloaded ({reason}), retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class LoadMonitor:
+    """
+    Event loop lag and CPU of the process, sampled in the background.
+    Lag is how late a timer fires: every callback (signaling, RTP, RTCP)
+    is late by as much, so it is the most direct measure of overload.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.loop_lag = 0.0
+        self.cpu_percent = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        wall, cpu = time.monotonic(), time.process_time()
+        while True:
+            await asyncio.sleep(self.interval)
+            now, now_cpu = time.monotonic(), time.process_time()
+            lag = max(0.0, now - wall - self.interval)
+            # smoothed, so that a single slow callback does not shed load
+            self.loop_lag = 0.7 * self.loop_lag + 0.3 * lag
+            # percent of one core, as `top` shows it
+            self.cpu_percent = (now_cpu - cpu) / (now - wall) * 100
+            wall, cpu = now, now_cpu
+
+
+class AdmissionController:
+    """
+    Decides whether a new offer may be served. Normal offers are refused at
+    the limits; the priority class gets extra connections and passes the
+    lag/CPU shedding, so operators can still get in while the server sheds load.
+    A limit of 0 is no limit.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        max_connections: int = 0,
+        max_transcode_sources: int = 0,
+        max_loop_lag: float = 0.0,
+        max_cpu_percent: float = 0.0,
+        priority_token: str = "",
+        priority_connections: int = 0,
+        retry_after: int = 5,
+    ):
+        self.registry = registry
+        self.max_connections = max_connections
+        self.max_transcode_sources = max_transcode_sources
+        self.max_loop_lag = max_loop_lag
+        self.max_cpu_percent = max_cpu_percent
+        self.priority_token = priority_token
+        self.priority_connections = priority_connections
+        self.retry_after = retry_after
+        self.monitor = LoadMonitor()
+        self.rejected: Dict[str, int] = {}
+
+    def is_priority(self, request: Request) -> bool:
+        token = request.headers.get(PRIORITY_HEADER)
+        return bool(self.priority_token and token) and secrets.compare_digest(
+            token, self.priority_token
+        )
+
+    def admit(self, request: Request, connections: int):
+        """Raise Overloaded when a new peer connection is over budget"""
+        priority = self.is_priority(request)
+        if self.max_connections:
+            limit = self.max_connections + (self.priority_connections if priority else 0)
+            if connections >= limit:
+                self._reject("connections")
+        if priority:
+            return
+        if self.max_loop_lag and self.monitor.loop_lag > self.max_loop_lag:
+            self._reject("event loop lag")
+        if self.max_cpu_percent and self.monitor.cpu_percent > self.max_cpu_percent:
+            self._reject("cpu")
+
+    def admit_source(self, request: Request, source: Source):
+        """
+        Raise Overloaded when the viewer has just opened one transcoding source
+        too many (the mode of an `auto` source is known only once it is open).
+        """
+        if not self.max_transcode_sources or source.mode != SourceMode.transcode:
+            return
+        if source.refs > 1 or self.is_priority(request):
+            # joins a decode that runs anyway: costs almost nothing
+            return
+        transcoding = sum(
+            1
+            for s in self.registry.sources()
+            if s.mode == SourceMode.transcode and s.refs > 0
+        )
+        if transcoding > self.max_transcode_sources:
+            self._reject("transcoding sources")
+
+    def _reject(self, reason: str):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        # spread the retries: refused clients must not come back all at once
+        raise Overloaded(reason, random.randint(self.retry_after, 2 * self.retry_after))
+
+    def stats(self) -> dict:
+        return {
+            "loop_lag_ms": round(self.monitor.loop_lag * 1000, 1),
+            "cpu_percent": round(self.monitor.cpu_percent, 1),
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import logging
+import socket
+from typing import Callable, Iterable, Optional
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from app.services.state import StateBackend
+from app.services.whep import node_of_resource
+from app.services.workers import FORWARD_TIMEOUT, proxy
+
+# Set on requests passed between nodes: the receiving node serves them itself
+FORWARDED_HEADER = "X-WebRTC-Node"
+
+
+def source_key(url: str) -> str:
+    # hashed: RTSP URLs carry credentials
+    return "source:" + hashlib.sha1(url.encode()).hexdigest()
+
+
+class Cluster:
+    """
+    Sticky routing between the nodes of a deployment: apiapp replicas behind
+    a load balancer, sharing a state backend.
+
+    A camera belongs to the node that serves it: offers for it that land on
+    another node are passed to the owner, so the camera is still opened once.
+    A WHEP/WHIP session carries the id of its node in the resource id, so its
+    PATCH and DELETE reach the node that holds the peer connection.
+    Without WEBRTC_NODE_URL every request is served where it lands.
+    """
+
+    def __init__(
+        self,
+        state: StateBackend,
+        node_id: str = "",
+        node_url: str = "",
+        node_ttl: float = 10.0,
+        claim_ttl: float = 300.0,
+        holding: Optional[Callable[[], Iterable[str]]] = None,
+    ):
+        self.state = state
+        self.node_url = node_url.rstrip("/")
+        self.node_id = node_id or (socket.gethostname() if node_url else "")
+        self.node_ttl = node_ttl
+        self.claim_ttl = claim_ttl
+        # RTSP URLs of the cameras open here: kept claimed while they are
+        self.holding = holding
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.node_url)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT)
+        self._task = asyncio.ensure_future(self._run())
+        logging.info(f"WebRTC node {self.node_id} at {self.node_url}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.state.heartbeat(self.node_id, self.node_url, self.node_ttl)
+                for url in self.holding() if self.holding else ():
+                    await self.state.claim(source_key(url), self.node_id, self.claim_ttl)
+            except Exception as exc:
+                logging.warning(f"WebRTC node heartbeat failed: {exc!r}")
+            await asyncio.sleep(self.node_ttl / 3)
+
+    def _local(self, request: Request) -> bool:
+        return not self.enabled or FORWARDED_HEADER in request.headers
+
+    async def route_source(
+        self, request: Request, url: str, stream: bool = False
+    ) -> Optional[Response]:
+        """Answer of the node that owns the camera `url`; None when it is this one"""
+        if self._local(request):
+            return None
+        try:
+            owner = await self.state.claim(source_key(url), self.node_id, self.claim_ttl)
+            if owner == self.node_id:
+                return None
+            owner_url = await self.state.node_url(owner)
+        except Exception as exc:
+            # without the backend every node serves on its own
+            logging.warning(f"State backend is not available, serving here: {exc!r}")
+            return None
+        if owner_url is None:
+            return None
+        return await self.forward(request, owner, owner_url, stream=stream)
+
+    async def route_session(self, request: Request, resource_id: str) -> Optional[Response]:
+        """Answer of the node that holds the session; None when it is this one"""
+        node = node_of_resource(resource_id)
+        if self._local(request) or node is None or node == self.node_id:
+            return None
+        try:
+            owner_url = await self.state.node_url(node)
+        except Exception as exc:
+            raise HTTPException(status_code=503, detail=f"State backend is not available: {exc}")
+        if owner_url is None:
+            # the node is gone, and its peer connections with it
+            raise HTTPException(status_code=404, detail="Session not found")
+        return await self.forward(request, node, owner_url)
+
+    async def forward(
+        self, request: Request, node: str, url: str, stream: bool = False
+    ) -> Response:
+        return await proxy(
+            self._client,
+            request,
+            url + request.url.path,
+            f"WebRTC node {node}",
+            headers={FORWARDED_HEADER: self.node_id},
+            stream=stream,
+        )
@@ -0,0 +1,395 @@
+import asyncio
+import logging
+import secrets
+import struct
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, Iterator, Optional
+
+import av
+import numpy as np
+from av.frame import Frame
+from av.video.reformatter import VideoReformatter
+
+from app.services.sources import DecodeProfile, Source, SourceMode, SourceRegistry, public_url
+
+# Pixel formats of the rings, and their bytes per pixel
+TAP_FORMATS = {"rgb24": 3, "bgr24": 3, "gray": 1}
+
+RING_MAGIC = b"RTSPRING"
+RING_VERSION = 1
+# magic, version, slots, width, height, channels, frames written (the last field,
+# updated after each frame); padded to 64 bytes
+RING_HEADER = struct.Struct("<8sIIIIIQ")
+RING_HEADER_SIZE = 64
+RING_WRITTEN_OFFSET = RING_HEADER.size - 8
+# number of the frame in the slot (+1, 0 while it is written), pts, wall clock
+SLOT_HEADER = struct.Struct("<Qqd8x")
+SLOT_ALIGN = 64
+
+
+def _align(size: int) -> int:
+    return (size + SLOT_ALIGN - 1) // SLOT_ALIGN * SLOT_ALIGN
+
+
+class FrameRing:
+    """
+    Fixed-size ring of frames in shared memory, one writer and any number of
+    readers in other processes.
+
+    Layout: a header, then `slots` slots of a slot header and width*height*channels
+    bytes of pixels. A slot is marked invalid while written and stamped with
+    the number of its frame after, so readers detect a frame overwritten under
+    them (seqlock) instead of the writer ever waiting for them.
+    """
+
+    def __init__(self, name: str, slots: int, width: int, height: int, channels: int):
+        self.name = name
+        self.slots = slots
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.frame_size = width * height * channels
+        self.slot_size = _align(SLOT_HEADER.size + self.frame_size)
+        self.written = 0
+        self.shm = SharedMemory(
+            name=name, create=True, size=RING_HEADER_SIZE + slots * self.slot_size
+        )
+        RING_HEADER.pack_into(
+            self.shm.buf, 0, RING_MAGIC, RING_VERSION, slots, width, height, channels, 0
+        )
+
+    def write(self, pixels: np.ndarray, pts: Optional[int], wall: float):
+        number = self.written
+        offset = RING_HEADER_SIZE + (number % self.slots) * self.slot_size
+        buf = self.shm.buf
+        SLOT_HEADER.pack_into(buf, offset, 0, 0, 0.0)
+        start = offset + SLOT_HEADER.size
+        np.frombuffer(buf, np.uint8, self.frame_size, start)[:] = pixels.reshape(-1)
+        SLOT_HEADER.pack_into(buf, offset, number + 1, pts if pts is not None else -1, wall)
+        self.written = number + 1
+        struct.pack_into("<Q", buf, RING_WRITTEN_OFFSET, self.written)
+
+    def close(self):
+        # readers keep their mapping: the memory goes with the last of them
+        self.shm.close()
+        self.shm.unlink()
+
+
+class RingFrame:
+    """A frame read from a ring: `image` is a view into the shared memory, not a copy"""
+
+    def __init__(self, reader: "FrameRingReader", number: int, pts: int, wall: float, image):
+        self.reader = reader
+        self.number = number
+        self.pts = pts
+        self.time = wall
+        self.image = image
+
+    def valid(self) -> bool:
+        """Whether the writer has not overwritten the frame yet: check after using `image`"""
+        return self.reader._slot_number(self.number) == self.number + 1
+
+
+class FrameRingReader:
+    """
+    Reading side of a FrameRing, for analysis processes:
+
+        reader = FrameRingReader(ring["name"])
+        for frame in reader.frames(fps=5):
+            result = model(frame.image)
+            if not frame.valid():
+                continue  # overwritten meanwhile: the model saw a torn picture
+    """
+
+    def __init__(self, name: str, child: bool = False):
+        self.shm = SharedMemory(name=name)
+        if not child:
+            # attaching registers the segment for removal at our exit: it is the
+            # writer's. Processes the writer's process started share its resource
+            # tracker, where the registration is the writer's own: leave it be.
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+        magic, version, self.slots, self.width, self.height, self.channels, _ = (
+            RING_HEADER.unpack_from(self.shm.buf, 0)
+        )
+        if magic != RING_MAGIC or version != RING_VERSION:
+            self.shm.close()
+            raise ValueError(f"{name} is not a frame ring")
+        self.frame_size = self.width * self.height * self.channels
+        self.slot_size = _align(SLOT_HEADER.size + self.frame_size)
+
+    @property
+    def written(self) -> int:
+        return struct.unpack_from("<Q", self.shm.buf, RING_WRITTEN_OFFSET)[0]
+
+    def _slot_offset(self, number: int) -> int:
+        return RING_HEADER_SIZE + (number % self.slots) * self.slot_size
+
+    def _slot_number(self, number: int) -> int:
+        return struct.unpack_from("<Q", self.shm.buf, self._slot_offset(number))[0]
+
+    def read(self, number: int) -> Optional[RingFrame]:
+        """Frame `number` (0 based), None when it is not written or overwritten already"""
+        offset = self._slot_offset(number)
+        stamped, pts, wall = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+        if stamped != number + 1:
+            return None
+        image = np.frombuffer(
+            self.shm.buf, np.uint8, self.frame_size, offset + SLOT_HEADER.size
+        ).reshape(self.height, self.width, self.channels)
+        return RingFrame(self, number, pts, wall, image)
+
+    def latest(self) -> Optional[RingFrame]:
+        written = self.written
+        return self.read(written - 1) if written else None
+
+    def frames(self, fps: Optional[float] = None, poll: float = 0.005) -> Iterator[RingFrame]:
+        """The newest frame at most `fps` times a second; frames in between are skipped"""
+        last = -1
+        next_time = 0.0
+        while True:
+            if fps:
+                wait = next_time - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            frame = self.latest()
+            if frame is None or frame.number == last:
+                time.sleep(poll)
+                continue
+            last = frame.number
+            if fps:
+                next_time = max(next_time + 1 / fps, time.monotonic())
+            yield frame
+
+    def close(self):
+        self.shm.close()
+
+
+class FrameTap:
+    """
+    Decoded frames of a camera, scaled to one resolution and pixel format
+    and published into a FrameRing at most `fps` times a second, out of those
+    the `decode` profile has the source decode (of them every `every`-th).
+    Scaling and copying run in a thread of the tap: the source only hands the
+    frame over.
+    """
+
+    def __init__(
+        self,
+        source: Source,
+        width: int,
+        height: int,
+        pix_fmt: str,
+        fps: float,
+        slots: int,
+        decode: DecodeProfile = DecodeProfile.full,
+        every: int = 1,
+    ):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.fps = fps
+        self.decode = decode
+        self.every = every
+        self.ring = FrameRing(
+            f"rtsp-{secrets.token_hex(6)}", slots, width, height, TAP_FORMATS[pix_fmt]
+        )
+        self.subscribers = 0
+        self.watcher: Optional[asyncio.Task] = None
+        # called in the tap thread with the number of every frame written
+        self.on_written: Optional[Callable[[int], None]] = None
+        # frames are published only while it says so (motion, for analysis)
+        self.gate: Optional[Callable[[], bool]] = None
+        self.gated = 0
+        self._next_time = 0.0
+        # own scaler: the frames are shared with the other sinks of the source
+        self._reformatter = VideoReformatter()
+        self._frame: Optional[Frame] = None
+        self._quit = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(name="frame-tap", target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.source.add_frame_sink(self, self.decode, self.every)
+
+    def close(self):
+        self.source.remove_frame_sink(self)
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+
+    def submit(self, frame: Frame):
+        now = time.monotonic()
+        if now < self._next_time:
+            return
+        self._next_time = max(self._next_time + 1 / self.fps, now)
+        if self.gate is not None and not self.gate():
+            self.gated += 1
+            return
+        with self._cond:
+            self._frame = frame
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._frame is None and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    break
+                frame, self._frame = self._frame, None
+            try:
+                scaled = self._reformatter.reformat(
+                    frame, width=self.width, height=self.height, format=self.pix_fmt
+                )
+                self.ring.write(scaled.to_ndarray(), frame.pts, time.time())
+                if self.on_written is not None:
+                    self.on_written(self.ring.written - 1)
+            except (av.FFmpegError, ValueError) as exc:
+                logging.warning(f"Frame tap of {public_url(self.source.url)}: {exc!r}")
+        self.ring.close()
+
+    def describe(self) -> dict:
+        """What a reader needs: the ring name and the shape of its frames"""
+        return {
+            "name": self.ring.name,
+            "slots": self.ring.slots,
+            "width": self.width,
+            "height": self.height,
+            "format": self.pix_fmt,
+            "channels": self.ring.channels,
+            "fps": self.fps,
+            "decode": self.decode.value,
+            "every": self.every,
+        }
+
+
+class TapSubscription:
+    def __init__(self, tap: FrameTap, fps: float, lease: float):
+        self.tap = tap
+        self.fps = fps
+        self.expires = time.monotonic() + lease
+
+
+class FrameBus:
+    """
+    Frame taps of the cameras for analysis processes on this host: one ring
+    per camera, resolution and decode profile, shared by all subscribers of it, running at
+    the highest fps any of them asked for (readers skip down to theirs).
+    A subscription is a lease: renewed by its consumer, or dropped after
+    `lease` seconds, and the tap with its last subscriber.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        new_id: Callable[[], str],
+        slots: int = 8,
+        lease: float = 30.0,
+    ):
+        self.registry = registry
+        self.new_id = new_id
+        self.slots = slots
+        self.lease = lease
+        self._taps: Dict[tuple, FrameTap] = {}
+        self._subscriptions: Dict[str, TapSubscription] = {}
+        self._locks: Dict[tuple, asyncio.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._expire())
+
+    async def subscribe(
+        self,
+        url: str,
+        mode: SourceMode,
+        width: int,
+        height: int,
+        pix_fmt: str,
+        fps: float,
+        decode: DecodeProfile = DecodeProfile.full,
+        every: int = 1,
+    ) -> tuple[str, FrameTap]:
+        key = (url, width, height, pix_fmt, decode, every)
+        # one tap per key, however many subscribe at once
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            tap = self._taps.get(key)
+            if tap is None:
+                source = await self.registry.acquire(url, mode)
+                tap = FrameTap(source, width, height, pix_fmt, fps, self.slots, decode, every)
+                tap.start()
+                tap.watcher = asyncio.ensure_future(self._close_when_ended(tap))
+                self._taps[key] = tap
+        tap.subscribers += 1
+        tap.fps = max(tap.fps, fps)
+        subscription_id = self.new_id()
+        self._subscriptions[subscription_id] = TapSubscription(tap, fps, self.lease)
+        return subscription_id, tap
+
+    def renew(self, subscription_id: str) -> bool:
+        subscription = self._subscriptions.get(subscription_id)
+        if subscription is None:
+            return False
+        subscription.expires = time.monotonic() + self.lease
+        return True
+
+    def unsubscribe(self, subscription_id: str) -> bool:
+        subscription = self._subscriptions.pop(subscription_id, None)
+        if subscription is None:
+            return False
+        tap = subscription.tap
+        tap.subscribers -= 1
+        if tap.subscribers <= 0:
+            self._close(tap)
+        else:
+            tap.fps = max(s.fps for s in self._subscriptions.values() if s.tap is tap)
+        return True
+
+    async def _close_when_ended(self, tap: FrameTap):
+        await tap.source.ended.wait()
+        for subscription_id, subscription in list(self._subscriptions.items()):
+            if subscription.tap is tap:
+                del self._subscriptions[subscription_id]
+        self._close(tap)
+
+    def _close(self, tap: FrameTap):
+        for key, value in list(self._taps.items()):
+            if value is tap:
+                del self._taps[key]
+                self._locks.pop(key, None)
+                tap.close()
+                if tap.watcher is not None:
+                    tap.watcher.cancel()
+                self.registry.release(tap.source)
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            now = time.monotonic()
+            for subscription_id, subscription in list(self._subscriptions.items()):
+                if subscription.expires < now:
+                    logging.info(f"Frame tap subscription {subscription_id} expired")
+                    self.unsubscribe(subscription_id)
+
+    def close_all(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for tap in list(self._taps.values()):
+            self._close(tap)
+        self._subscriptions.clear()
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "url": public_url(tap.source.url),
+                "subscribers": tap.subscribers,
+                "written": tap.ring.written,
+                **tap.describe(),
+            }
+            for tap in self._taps.values()
+        ]
@@ -0,0 +1,431 @@
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import time
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional, Sequence
+
+import numpy as np
+
+from app.services.framebus import FrameRingReader, FrameTap
+from app.services.sources import DecodeProfile, Source, SourceRegistry, public_url, summarize
+
+# How often the scheduler looks for new and ended sources, seconds
+SYNC_INTERVAL = 1.0
+
+# Batches and frames the statistics are taken over
+STATS_SAMPLES = 500
+
+# Rings a worker process keeps attached without using them, seconds
+READER_IDLE = 60.0
+
+# How long shutdown waits for the batches in flight before killing the workers, seconds
+SHUTDOWN_TIMEOUT = 10.0
+
+
+class MeanBrightness:
+    """Model stub for tests and benchmarks: mean brightness of every frame, 0..1"""
+
+    def __call__(self, batch: np.ndarray) -> Sequence:
+        return (batch.reshape(len(batch), -1).mean(axis=1) / 255).round(4).tolist()
+
+
+class OnnxModel:
+    """An ONNX model on the CPU; its input is NCHW float32 in 0..1, as most vision models"""
+
+    def __init__(self, path: str):
+        # optional dependency: only deployments running ONNX models install it
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input = self.session.get_inputs()[0].name
+
+    def __call__(self, batch: np.ndarray) -> Sequence:
+        tensor = batch.transpose(0, 3, 1, 2).astype(np.float32) / 255
+        outputs = self.session.run(None, {self.input: tensor})
+        return [output.tolist() for output in outputs[0]]
+
+
+def load_model(spec: str) -> Callable[[np.ndarray], Sequence]:
+    """
+    A model from its spec: "onnx:<path to .onnx>", or "<module>:<factory>" for
+    anything else. A model takes a batch (N, H, W, C) of uint8 frames and
+    returns one JSON-serializable result per frame.
+    """
+    kind, _, target = spec.partition(":")
+    if kind == "onnx":
+        return OnnxModel(target)
+    return getattr(importlib.import_module(kind), target)()
+
+
+# ---------- worker processes ----------
+
+_model: Optional[Callable[[np.ndarray], Sequence]] = None
+# ring name -> reader, and when it was used last
+_readers: Dict[str, tuple[FrameRingReader, float]] = {}
+
+
+def _init_worker(spec: str):
+    global _model
+    _model = load_model(spec)
+
+
+def _reader(name: str) -> Optional[FrameRingReader]:
+    now = time.monotonic()
+    for other, (reader, used) in list(_readers.items()):
+        if now - used > READER_IDLE:
+            # the tap is gone (or idle): let its memory go
+            del _readers[other]
+            try:
+                reader.close()
+            except BufferError:
+                pass
+    if name in _readers:
+        reader = _readers[name][0]
+    else:
+        try:
+            reader = FrameRingReader(name, child=True)
+        except FileNotFoundError:
+            return None
+    _readers[name] = (reader, now)
+    return reader
+
+
+def _infer(items: list[tuple[str, int]]) -> tuple[list, float]:
+    """
+    Run the model on frames given as (ring, frame number): the pixels are read
+    from shared memory here, never sent between processes. A frame overwritten
+    before it was copied into the batch gets no result.
+    """
+    frames = []
+    for ring, number in items:
+        reader = _reader(ring)
+        frames.append(reader.read(number) if reader is not None else None)
+    present = [frame for frame in frames if frame is not None]
+    if not present:
+        return [None] * len(items), 0.0
+    batch = np.stack([frame.image for frame in present])
+    intact = [frame.valid() for frame in present]
+    started = time.perf_counter()
+    results = _model(batch)
+    took = time.perf_counter() - started
+    results = iter(zip(results, intact, present))
+    answers = []
+    for frame in frames:
+        if frame is None:
+            answers.append(None)
+            continue
+        result, ok, frame = next(results)
+        answers.append((result, frame.pts) if ok else None)
+    return answers, took
+
+
+# ---------- event loop ----------
+
+class PendingFrame:
+    def __init__(self, url: str, ring: str, number: int, arrived: float, deadline: float):
+        self.url = url
+        self.ring = ring
+        self.number = number
+        self.arrived = arrived
+        self.deadline = deadline
+
+
+class InferenceScheduler:
+    """
+    Runs a model on the frames of all active cameras, batched across cameras.
+
+    Every source gets a frame tap (without holding the source: it closes as
+    usual when its viewers leave); a new frame of a camera replaces its older
+    one still waiting; with a `gate`, cameras it calls idle send no frames.
+    Batches go to a pool of `workers` processes, which read the frames from
+    shared memory. A batch leaves when it is as large as the earliest deadline
+    allows (by the measured time per frame), or its oldest frame waited
+    `max_wait`; frames past their deadline are dropped unrun.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        model: str,
+        width: int = 224,
+        height: int = 224,
+        pix_fmt: str = "rgb24",
+        fps: float = 5.0,
+        max_batch: int = 16,
+        max_wait: float = 0.05,
+        deadline: float = 0.5,
+        workers: int = 2,
+        slots: int = 8,
+        decode: DecodeProfile = DecodeProfile.full,
+        every: int = 1,
+    ):
+        self.registry = registry
+        self.model = model
+        self.width = width
+        self.height = height
+        self.pix_fmt = pix_fmt
+        self.fps = fps
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.deadline = deadline
+        self.workers = workers
+        self.slots = slots
+        self.decode = decode
+        self.every = every
+        # latest result of every camera: {"result", "pts", "latency", "time"}
+        self.results: Dict[str, dict] = {}
+        self.on_result: Optional[Callable[[str, dict], None]] = None
+        # url -> whether the camera is worth running the model on (motion)
+        self.gate: Optional[Callable[[str], bool]] = None
+
+        self._feeds: Dict[Source, FrameTap] = {}
+        self._pending: Dict[str, PendingFrame] = {}
+        self._in_flight = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._wake = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        # seconds per frame of a batch, round trip to the pool included
+        self._per_frame = 0.0
+
+        self.batches = 0
+        self.frames = 0
+        self.superseded = 0
+        self.expired = 0
+        self.late = 0
+        self.torn = 0
+        self.errors = 0
+        self._gated_closed = 0
+        self.batch_sizes: deque = deque(maxlen=STATS_SAMPLES)
+        self.queue_waits: deque = deque(maxlen=STATS_SAMPLES)
+        self.batch_times: deque = deque(maxlen=STATS_SAMPLES)
+        self.model_times: deque = deque(maxlen=STATS_SAMPLES)
+
+    def start(self):
+        self._executor = self._new_executor()
+        self._tasks = [
+            asyncio.ensure_future(self._sync()),
+            asyncio.ensure_future(self._dispatch()),
+        ]
+        logging.info(f"Inference of {self.model} on {self.workers} processes")
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # spawned, not forked: the server process runs threads (sources, encoders)
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.model,),
+        )
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._pending.clear()
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            # joining the workers blocks: not on the event loop. A model stuck
+            # in a batch would hold it forever, so past the timeout they are killed
+            processes = list((executor._processes or {}).values())
+            loop = asyncio.get_running_loop()
+            shutdown = loop.run_in_executor(
+                None, partial(executor.shutdown, wait=True, cancel_futures=True)
+            )
+            try:
+                await asyncio.wait_for(asyncio.shield(shutdown), SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning("Inference workers did not stop in time, killing them")
+                for process in processes:
+                    process.kill()
+                await shutdown
+        # after the workers: a batch in flight still reads the rings
+        for source in list(self._feeds):
+            self._close_feed(source)
+
+    async def _sync(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sources = set(self.registry.sources())
+            for source in list(self._feeds):
+                if source not in sources or source.ended.is_set():
+                    self._close_feed(source)
+            for source in sources - set(self._feeds):
+                if source.ended.is_set() or not source.has_video:
+                    continue
+                feed = FrameTap(
+                    source,
+                    self.width,
+                    self.height,
+                    self.pix_fmt,
+                    self.fps,
+                    self.slots,
+                    self.decode,
+                    self.every,
+                )
+                if self.gate is not None:
+                    feed.gate = lambda url=source.url: self.gate(url)
+                feed.on_written = (
+                    lambda number, url=source.url, ring=feed.ring.name:
+                    loop.call_soon_threadsafe(self._arrived, url, ring, number)
+                )
+                feed.start()
+                self._feeds[source] = feed
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    def _close_feed(self, source: Source):
+        feed = self._feeds.pop(source)
+        feed.close()
+        self._gated_closed += feed.gated
+        self._pending.pop(source.url, None)
+
+    @property
+    def gated(self) -> int:
+        """Frames not taken because their camera was idle"""
+        return self._gated_closed + sum(feed.gated for feed in self._feeds.values())
+
+    def _arrived(self, url: str, ring: str, number: int):
+        now = time.monotonic()
+        if url in self._pending:
+            # not run yet, and a newer picture of the camera is here
+            self.superseded += 1
+        self._pending[url] = PendingFrame(url, ring, number, now, now + self.deadline)
+        self._wake.set()
+
+    def _fits(self, seconds: float) -> int:
+        """Frames a batch can hold and still be done in `seconds`"""
+        if self._per_frame <= 0:
+            return self.max_batch
+        return max(1, min(self.max_batch, int(seconds / self._per_frame)))
+
+    async def _dispatch(self):
+        while True:
+            timeout = None
+            if self._pending and self._in_flight < self.workers:
+                now = time.monotonic()
+                for url, frame in list(self._pending.items()):
+                    if frame.deadline <= now:
+                        # no use running it any more
+                        del self._pending[url]
+                        self.expired += 1
+                if self._pending:
+                    frames = sorted(self._pending.values(), key=lambda f: f.deadline)
+                    # the batch shrinks as the earliest deadline comes closer
+                    size = self._fits(frames[0].deadline - now)
+                    oldest = min(frame.arrived for frame in frames)
+                    if len(frames) >= size or now - oldest >= self.max_wait:
+                        self._send(frames[:size], now)
+                        continue
+                    timeout = oldest + self.max_wait - now
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _send(self, frames: list[PendingFrame], now: float):
+        for frame in frames:
+            del self._pending[frame.url]
+            self.queue_waits.append(now - frame.arrived)
+        self.batch_sizes.append(len(frames))
+        self._in_flight += 1
+        asyncio.ensure_future(self._run(frames))
+
+    async def _run(self, frames: list[PendingFrame]):
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        started = time.monotonic()
+        try:
+            answers, model_time = await loop.run_in_executor(
+                executor, _infer, [(frame.ring, frame.number) for frame in frames]
+            )
+        except BrokenProcessPool as exc:
+            self.errors += 1
+            # the other batches of the broken pool fail too: replace it once
+            if self._executor is executor:
+                logging.error(f"Inference workers died, starting new ones: {exc!r}")
+                self._executor = self._new_executor()
+            return
+        except Exception as exc:
+            self.errors += 1
+            logging.warning(f"Inference batch failed: {exc!r}")
+            return
+        finally:
+            self._in_flight -= 1
+            self._wake.set()
+
+        done = time.monotonic()
+        took = done - started
+        self.batch_times.append(took)
+        self.model_times.append(model_time)
+        per_frame = took / len(frames)
+        self._per_frame = (
+            0.8 * self._per_frame + 0.2 * per_frame if self._per_frame else per_frame
+        )
+        self.batches += 1
+        for frame, answer in zip(frames, answers):
+            if answer is None:
+                self.torn += 1
+                continue
+            self.frames += 1
+            if done > frame.deadline:
+                self.late += 1
+            result, pts = answer
+            self.results[frame.url] = {
+                "result": result,
+                "pts": pts,
+                "latency": round(done - frame.arrived, 4),
+                "time": time.time(),
+            }
+            if self.on_result is not None:
+                self.on_result(frame.url, self.results[frame.url])
+
+    def fill_rate(self) -> Optional[float]:
+        if not self.batch_sizes:
+            return None
+        return sum(self.batch_sizes) / len(self.batch_sizes) / self.max_batch
+
+    def stats(self) -> dict:
+        fill = self.fill_rate()
+        return {
+            "model": self.model,
+            "decode": self.decode.value,
+            "every": self.every,
+            "cameras": [public_url(source.url) for source in self._feeds],
+            "batches": self.batches,
+            "frames": self.frames,
+            "batch_fill_rate": round(fill, 3) if fill is not None else None,
+            "queue_wait": summarize(self.queue_waits),
+            "batch_time": summarize(self.batch_times),
+            "model_time": summarize(self.model_times),
+            "deadline_misses": {"expired": self.expired, "late": self.late},
+            "superseded": self.superseded,
+            "gated": self.gated,
+            "torn": self.torn,
+            "errors": self.errors,
+            "in_flight": self._in_flight,
+        }
+
+    def metrics(self) -> list[tuple]:
+        """(name, labels, value) samples for /webrtc/metrics"""
+        labels = {"model": self.model}
+        misses = "webrtc_inference_deadline_misses_total"
+        samples = [
+            ("webrtc_inference_batches_total", labels, self.batches),
+            ("webrtc_inference_frames_total", labels, self.frames),
+            ("webrtc_inference_superseded_total", labels, self.superseded),
+            ("webrtc_inference_gated_total", labels, self.gated),
+            (misses, {**labels, "reason": "expired"}, self.expired),
+            (misses, {**labels, "reason": "late"}, self.late),
+        ]
+        fill = self.fill_rate()
+        if fill is not None:
+            samples.append(("webrtc_inference_batch_fill_ratio", labels, round(fill, 4)))
+        if self.queue_waits:
+            wait = sum(self.queue_waits) / len(self.queue_waits)
+            samples.append(("webrtc_inference_queue_wait_seconds", labels, round(wait, 6)))
+        return samples
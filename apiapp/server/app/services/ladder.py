@@ -0,0 +1,191 @@
+import asyncio
+import fractions
+import logging
+import threading
+from typing import Callable, Optional
+
+import av
+from aiortc import RTCRtpSender
+from av.packet import Packet
+from av.video.reformatter import VideoReformatter
+
+# RTCP receiver reports carry the loss fraction as a fixed point number /256
+FRACTION_LOST_SCALE = 256
+
+# Thresholds of the adaptation loop
+LOSS_DOWN = 0.10  # step down when more than 10% of packets are lost
+LOSS_UP = 0.02  # consider stepping up below 2%
+RTT_DOWN = 0.5  # seconds
+RTT_UP = 0.25
+# Good reports in a row before stepping up (probing up is more expensive than down)
+GOOD_REPORTS_TO_UP = 3
+
+# Rungs below this bitrate are not worth encoding
+MIN_RUNG_BITRATE = 150_000
+
+
+def rung_bitrate(full_bitrate: int, scale: float) -> int:
+    """Bitrate of a rung: proportional to the number of pixels"""
+    return max(MIN_RUNG_BITRATE, int(full_bitrate * scale * scale))
+
+
+def next_rung(rung: int, rungs: int, loss: float, rtt: Optional[float], good: int) -> int:
+    """
+    Rung for the next interval: 0 is the full quality, `rungs - 1` the lowest.
+    `good` is the number of good reports in a row, including this one.
+    """
+    congested = loss > LOSS_DOWN or (rtt is not None and rtt > RTT_DOWN)
+    if congested:
+        return min(rung + 1, rungs - 1)
+    if good >= GOOD_REPORTS_TO_UP:
+        return max(rung - 1, 0)
+    return rung
+
+
+class RungEncoder:
+    """
+    One rung of the ladder: scales decoded frames of a source and encodes them
+    to H.264 once for all viewers of this rung. Runs in its own thread and
+    always encodes the latest frame, so a slow rung never holds the source.
+    """
+
+    def __init__(
+        self,
+        rung: int,
+        scale: float,
+        bitrate: int,
+        publish: Callable[[int, Packet], None],
+    ):
+        self.rung = rung
+        self.scale = scale
+        self.bitrate = bitrate
+        self._publish = publish
+        self._codec: Optional[av.CodecContext] = None
+        # frame.reformat() shares one scaler per frame, and a frame goes to
+        # every rung of the source, each in its thread: use our own
+        self._reformatter = VideoReformatter()
+        self._frame: Optional[av.VideoFrame] = None
+        self._force_keyframe = True
+        self._quit = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            name=f"ladder-rung-{rung}", target=self._run, daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+
+    def submit(self, frame: av.VideoFrame):
+        with self._cond:
+            self._frame = frame
+            self._cond.notify()
+
+    def request_keyframe(self):
+        """A viewer switches to this rung: let it start without waiting a GOP"""
+        self._force_keyframe = True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._frame is None and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    break
+                frame, self._frame = self._frame, None
+            try:
+                for packet in self._encode(frame):
+                    self._publish(self.rung, packet)
+            except av.FFmpegError as exc:
+                logging.warning(f"Ladder rung {self.rung} encode error: {exc!r}")
+                self._codec = None
+
+    def _encode(self, frame: av.VideoFrame) -> list[Packet]:
+        # H.264 needs even dimensions
+        width = max(2, int(frame.width * self.scale) // 2 * 2)
+        height = max(2, int(frame.height * self.scale) // 2 * 2)
+        if self._codec is None or self._codec.width != width or self._codec.height != height:
+            self._codec = av.CodecContext.create("libx264", "w")
+            self._codec.width = width
+            self._codec.height = height
+            self._codec.bit_rate = self.bitrate
+            self._codec.pix_fmt = "yuv420p"
+            self._codec.time_base = frame.time_base or fractions.Fraction(1, 90000)
+            # same profile as aiortc's own encoder: every browser decodes it
+            self._codec.options = {
+                "level": "31",
+                "tune": "zerolatency",
+                "preset": "ultrafast",
+            }
+            self._codec.profile = "Baseline"
+            self._force_keyframe = True
+
+        scaled = self._reformatter.reformat(frame, width=width, height=height, format="yuv420p")
+        scaled.pts = frame.pts
+        scaled.time_base = frame.time_base
+        if self._force_keyframe:
+            scaled.pict_type = av.video.frame.PictureType.I
+            self._force_keyframe = False
+        else:
+            scaled.pict_type = av.video.frame.PictureType.NONE
+
+        packets = self._codec.encode(scaled)
+        for packet in packets:
+            packet.time_base = self._codec.time_base
+        return packets
+
+
+class Adapter:
+    """
+    Adaptation loop of one viewer: reads RTCP receiver reports of the video
+    sender and moves the viewer along the ladder of its source.
+    """
+
+    def __init__(self, sender: RTCRtpSender, track, rungs: int, interval: float = 2.0):
+        self.sender = sender
+        self.track = track
+        self.rungs = rungs
+        self.interval = interval
+        self.loss: Optional[float] = None
+        self.rtt: Optional[float] = None
+        self._good = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            report = await self.sender.getStats()
+            remote = [s for s in report.values() if s.type == "remote-inbound-rtp"]
+            if not remote:
+                continue
+            self.loss = remote[-1].fractionLost / FRACTION_LOST_SCALE
+            self.rtt = remote[-1].roundTripTime
+            congested = self.loss > LOSS_UP or (self.rtt is not None and self.rtt > RTT_UP)
+            self._good = 0 if congested else self._good + 1
+
+            rung = next_rung(self.track.rung, self.rungs, self.loss, self.rtt, self._good)
+            if rung != self.track.rung and rung != self.track.pending_rung:
+                logging.info(
+                    f"Viewer moves to rung {rung} (loss {self.loss:.2f}, rtt {self.rtt})"
+                )
+                self.track.switch(rung)
+                self._good = 0
+
+    def stats(self) -> dict:
+        return {
+            "rung": self.track.rung,
+            "fraction_lost": self.loss,
+            "rtt": self.rtt,
+        }
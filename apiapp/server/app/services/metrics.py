@@ -0,0 +1,247 @@
+import asyncio
+import itertools
+import logging
+import time
+import weakref
+from typing import Callable, Dict, Iterable, Optional
+
+from aiortc import RTCPeerConnection, RTCRtpSender
+from aiortc.rtp import (
+    RTCP_PSFB_FIR,
+    RTCP_PSFB_PLI,
+    RTCP_RTPFB_NACK,
+    RtcpPsfbPacket,
+    RtcpRtpfbPacket,
+)
+
+from app.services.sources import SourceRegistry, public_url
+
+# RTP clock rates: receiver reports give jitter in timestamp units
+CLOCK_RATES = {"audio": 48000, "video": 90000}
+
+# name -> (type, help), in the order of the exposition
+METRICS = {
+    "webrtc_peer_connections": ("gauge", "Open peer connections"),
+    "webrtc_pc_info": ("gauge", "Peer connection state and source"),
+    "webrtc_pc_bytes_sent_total": ("counter", "RTP bytes sent"),
+    "webrtc_pc_packets_sent_total": ("counter", "RTP packets sent"),
+    "webrtc_pc_packets_lost_total": ("counter", "RTP packets lost, by receiver reports"),
+    "webrtc_pc_frames_sent_total": ("counter", "Frames handed to the encoder or packetizer"),
+    "webrtc_pc_frames_dropped_total": ("counter", "Frames dropped because the viewer lagged"),
+    "webrtc_pc_rtt_seconds": ("gauge", "Round-trip time, by receiver reports"),
+    "webrtc_pc_jitter_seconds": ("gauge", "Interarrival jitter, by receiver reports"),
+    "webrtc_pc_nack_total": ("counter", "Packets the receiver asked to retransmit (NACK)"),
+    "webrtc_pc_pli_total": ("counter", "Keyframe requests from the receiver (PLI/FIR)"),
+    "webrtc_pc_encode_seconds_per_frame": (
+        "gauge",
+        "Time the sender spends on a frame (encode/packetize/send), last interval",
+    ),
+    "webrtc_source_viewers": ("gauge", "Viewers of a source"),
+    "webrtc_source_input_fps": ("gauge", "Video frames received from the camera per second"),
+    "webrtc_source_decode_seconds_per_frame": ("gauge", "Decode time per frame, last interval"),
+    "webrtc_source_reconnects_total": ("counter", "Times the camera was connected again"),
+    "webrtc_time_to_first_frame_seconds_sum": (
+        "counter", "Time from a viewer's request to its first video frame, summed"
+    ),
+    "webrtc_time_to_first_frame_seconds_count": (
+        "counter", "Viewers that got their first video frame"
+    ),
+    "webrtc_inference_batches_total": ("counter", "Model runs of the inference scheduler"),
+    "webrtc_inference_frames_total": ("counter", "Frames the model gave a result for"),
+    "webrtc_inference_superseded_total": (
+        "counter", "Frames replaced by a newer one of the camera before a batch took them"
+    ),
+    "webrtc_inference_deadline_misses_total": (
+        "counter", "Frames dropped past their deadline (expired) or answered after it (late)"
+    ),
+    "webrtc_inference_batch_fill_ratio": ("gauge", "Mean batch size over the maximum"),
+    "webrtc_inference_queue_wait_seconds": ("gauge", "Mean wait of a frame for its batch"),
+    "webrtc_inference_gated_total": (
+        "counter", "Frames not sent to the model because their camera showed no motion"
+    ),
+    "webrtc_motion_score": ("gauge", "Share of the picture that changed, last sample"),
+    "webrtc_motion_active": ("gauge", "Whether motion is seen on the camera"),
+    "webrtc_motion_events_total": ("counter", "Periods of motion seen on the camera"),
+}
+
+
+class FeedbackCounters:
+    def __init__(self):
+        self.nack = 0
+        self.pli = 0
+
+
+# sender -> counters of RTCP feedback it received
+_feedback: "weakref.WeakKeyDictionary[RTCRtpSender, FeedbackCounters]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def count_feedback(sender: RTCRtpSender):
+    """
+    Count NACK and PLI/FIR packets received by the sender.
+    aiortc handles RTCP feedback inside the sender and keeps no counters,
+    so its handler is wrapped for this sender instance.
+    """
+    counters = _feedback.setdefault(sender, FeedbackCounters())
+    handle = sender._handle_rtcp_packet
+
+    async def _handle_rtcp_packet(packet):
+        if isinstance(packet, RtcpRtpfbPacket) and packet.fmt == RTCP_RTPFB_NACK:
+            counters.nack += len(packet.lost)
+        elif isinstance(packet, RtcpPsfbPacket) and packet.fmt in (RTCP_PSFB_FIR, RTCP_PSFB_PLI):
+            counters.pli += 1
+        await handle(packet)
+
+    sender._handle_rtcp_packet = _handle_rtcp_packet
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def render(samples: Iterable[tuple]) -> str:
+    """Prometheus text exposition of (name, labels, value) samples"""
+    by_name: Dict[str, list] = {name: [] for name in METRICS}
+    for name, labels, value in samples:
+        by_name[name].append((labels, value))
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        if not by_name[name]:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in by_name[name]:
+            lines.append(f"{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsCollector:
+    """
+    Gathers stats of peer connections (aiortc getStats) and sources
+    periodically in the background: a scrape only renders the last snapshot,
+    so it costs nothing to the media path however often it comes.
+    """
+
+    def __init__(self, pcs: set, players: dict, registry: SourceRegistry, interval: float = 5.0):
+        self.pcs = pcs
+        self.players = players
+        self.registry = registry
+        self.interval = interval
+        self.samples: list[tuple] = []
+        self._ids: "weakref.WeakKeyDictionary[RTCPeerConnection, str]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._counter = itertools.count(1)
+        # totals of the previous collection, to turn them into per interval values
+        self._previous: Dict[tuple, tuple] = {}
+        self._current: Dict[tuple, tuple] = {}
+        # more samples, from stages that count their own (inference, motion)
+        self.collectors: list[Callable[[], list[tuple]]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def pc_id(self, pc: RTCPeerConnection) -> str:
+        if pc not in self._ids:
+            self._ids[pc] = f"pc-{next(self._counter)}"
+        return self._ids[pc]
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.collect()
+            except Exception as exc:
+                logging.warning(f"Metrics collection failed: {exc!r}")
+            await asyncio.sleep(self.interval)
+
+    def _rate(self, key: tuple, total: float, count: float) -> Optional[float]:
+        """Growth of `total` per growth of `count` since the previous collection"""
+        self._current[key] = (total, count)
+        if key not in self._previous:
+            return None
+        previous_total, previous_count = self._previous[key]
+        if count <= previous_count:
+            return None
+        return (total - previous_total) / (count - previous_count)
+
+    async def collect(self):
+        samples = [("webrtc_peer_connections", {}, len(self.pcs))]
+        self._current = {}
+        now = time.monotonic()
+        for pc in list(self.pcs):
+            samples.extend(await self._collect_pc(pc))
+        for source in self.registry.sources():
+            labels = {"source": public_url(source.url), "mode": source.mode.value}
+            samples.append(("webrtc_source_viewers", labels, source.refs - int(source.pinned)))
+            fps = self._rate(("fps", source), source.frames_in, now)
+            if fps is not None:
+                samples.append(("webrtc_source_input_fps", labels, round(fps, 2)))
+            decode = self._rate(("decode", source), source.decode_time, source.frames_decoded)
+            if decode is not None:
+                samples.append(("webrtc_source_decode_seconds_per_frame", labels, decode))
+            samples.append(
+                ("webrtc_source_reconnects_total", labels, self.registry.reconnects(source))
+            )
+        # pinned: the camera was connected already, cold: the viewer opened it
+        for kind, (total, count) in self.registry.ttff_totals().items():
+            labels = {"start": kind}
+            samples.append(("webrtc_time_to_first_frame_seconds_sum", labels, round(total, 6)))
+            samples.append(("webrtc_time_to_first_frame_seconds_count", labels, count))
+        for collector in self.collectors:
+            samples.extend(collector())
+        # only what was seen now is kept: closed connections and sources go away
+        self._previous = self._current
+        self.samples = samples
+
+    async def _collect_pc(self, pc: RTCPeerConnection) -> list[tuple]:
+        pc_id = self.pc_id(pc)
+        subscription = self.players.get(pc)
+        source = public_url(subscription.source.url) if subscription else ""
+        samples = [("webrtc_pc_info", {"pc": pc_id, "state": pc.connectionState, "source": source}, 1)]
+
+        report = await pc.getStats()
+        for stats in report.values():
+            labels = {"pc": pc_id, "kind": getattr(stats, "kind", "")}
+            if stats.type == "outbound-rtp":
+                samples.append(("webrtc_pc_bytes_sent_total", labels, stats.bytesSent))
+                samples.append(("webrtc_pc_packets_sent_total", labels, stats.packetsSent))
+            elif stats.type == "remote-inbound-rtp":
+                samples.append(("webrtc_pc_packets_lost_total", labels, stats.packetsLost))
+                if stats.roundTripTime is not None:
+                    samples.append(("webrtc_pc_rtt_seconds", labels, stats.roundTripTime))
+                clock_rate = CLOCK_RATES.get(stats.kind)
+                if clock_rate:
+                    samples.append(("webrtc_pc_jitter_seconds", labels, stats.jitter / clock_rate))
+
+        for sender in pc.getSenders():
+            if sender.track is None:
+                continue
+            labels = {"pc": pc_id, "kind": sender.track.kind}
+            counters = _feedback.get(sender)
+            if counters is not None:
+                samples.append(("webrtc_pc_nack_total", labels, counters.nack))
+                samples.append(("webrtc_pc_pli_total", labels, counters.pli))
+            track = sender.track
+            if hasattr(track, "frames_sent"):
+                samples.append(("webrtc_pc_frames_sent_total", labels, track.frames_sent))
+                samples.append(("webrtc_pc_frames_dropped_total", labels, track.dropped))
+                busy = self._rate(("busy", track), track.busy_time, track.busy_frames)
+                if busy is not None:
+                    samples.append(("webrtc_pc_encode_seconds_per_frame", labels, busy))
+        return samples
+
+    def render(self) -> str:
+        return render(self.samples)
@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+import av
+import numpy as np
+from av.frame import Frame
+from av.video.reformatter import VideoReformatter
+
+from app.services.sources import DecodeProfile, Source, SourceRegistry, public_url, summarize
+
+# Formats whose first plane is 8-bit luma: read as is, nothing converted
+LUMA_FORMATS = {
+    "yuv420p", "yuvj420p", "yuv422p", "yuvj422p", "yuv444p", "yuvj444p",
+    "nv12", "nv21", "gray",
+}
+
+# How often the monitor looks for new and ended sources, seconds
+SYNC_INTERVAL = 1.0
+
+# Activity events kept per camera
+EVENTS_KEPT = 50
+
+# Samples the analysis time is taken over
+STATS_SAMPLES = 500
+
+
+def luma(frame: Frame, reformatter: VideoReformatter) -> np.ndarray:
+    """The luma plane of a frame, a view of the frame's memory when its format allows"""
+    if frame.format.name not in LUMA_FORMATS:
+        return reformatter.reformat(frame, format="gray").to_ndarray()
+    plane = frame.planes[0]
+    pixels = np.frombuffer(plane, np.uint8, plane.line_size * plane.height)
+    return pixels.reshape(plane.height, plane.line_size)[:, : plane.width]
+
+
+def downscale(plane: np.ndarray, width: int) -> np.ndarray:
+    """
+    Every k-th pixel of the plane (k to get about `width` columns), each the
+    mean of its 2x2 box against noise: a few small strided reads instead of
+    averaging the whole picture.
+    """
+    step = plane.shape[1] // width
+    if step < 2:
+        return plane.astype(np.float32)
+    rows = (plane.shape[0] - 1) // step * step
+    columns = (plane.shape[1] - 1) // step * step
+    total = plane[0:rows:step, 0:columns:step].astype(np.uint16)
+    total += plane[1 : rows + 1 : step, 0:columns:step]
+    total += plane[0:rows:step, 1 : columns + 1 : step]
+    total += plane[1 : rows + 1 : step, 1 : columns + 1 : step]
+    return total.astype(np.float32) / 4
+
+
+class MotionDetector:
+    """
+    Activity of one camera by frame differencing: at most `fps` times a second
+    the luma plane of a decoded frame is sampled down to about `width` columns
+    and compared with the previous sample. The score is the share of pixels
+    that changed by more than `threshold` levels; the camera is active from a
+    score of `min_area` until `hold` seconds without one. Runs in a thread of
+    its own: the source only hands the frame over. Motion shows as well on
+    frames decoded with skip flags (`decode`), or on every `every`-th of
+    them, at a fraction of the cost.
+    """
+
+    def __init__(
+        self,
+        source: Source,
+        fps: float = 5.0,
+        width: int = 160,
+        threshold: float = 20.0,
+        min_area: float = 0.01,
+        hold: float = 3.0,
+        decode: DecodeProfile = DecodeProfile.reduced,
+        every: int = 1,
+    ):
+        self.source = source
+        self.fps = fps
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area
+        self.hold = hold
+        self.decode = decode
+        self.every = every
+        self.active = False
+        self.score = 0.0
+        self.samples = 0
+        self.events: deque = deque(maxlen=EVENTS_KEPT)
+        self.event_count = 0
+        self.analysis_times: deque = deque(maxlen=STATS_SAMPLES)
+        # called in the detector thread after every sample with motion, and
+        # when the camera goes quiet
+        self.on_activity: Optional[Callable[["MotionDetector"], None]] = None
+        self._previous: Optional[np.ndarray] = None
+        self._last_motion = 0.0
+        self._next_time = 0.0
+        # own scaler: the frames are shared with the other sinks of the source
+        self._reformatter = VideoReformatter()
+        self._frame: Optional[Frame] = None
+        self._quit = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(name="motion", target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.source.add_frame_sink(self, self.decode, self.every)
+
+    def close(self):
+        self.source.remove_frame_sink(self)
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+
+    def submit(self, frame: Frame):
+        now = time.monotonic()
+        if now < self._next_time:
+            return
+        self._next_time = max(self._next_time + 1 / self.fps, now)
+        with self._cond:
+            self._frame = frame
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._frame is None and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    break
+                frame, self._frame = self._frame, None
+            started = time.perf_counter()
+            try:
+                sample = downscale(luma(frame, self._reformatter), self.width)
+            except (av.FFmpegError, ValueError) as exc:
+                logging.warning(f"Motion detector of {public_url(self.source.url)}: {exc!r}")
+                continue
+            self._update(sample)
+            self.analysis_times.append(time.perf_counter() - started)
+
+    def _update(self, sample: np.ndarray):
+        previous, self._previous = self._previous, sample
+        if previous is None or previous.shape != sample.shape:
+            # first frame, or the camera changed its resolution
+            return
+        changed = np.count_nonzero(np.abs(sample - previous) > self.threshold)
+        self.score = changed / sample.size
+        self.samples += 1
+        now = time.monotonic()
+        if self.score >= self.min_area:
+            self._last_motion = now
+            if not self.active:
+                self.active = True
+                self.event_count += 1
+                self.events.append({"start": time.time(), "end": None, "peak": self.score})
+            event = self.events[-1]
+            event["peak"] = round(max(event["peak"], self.score), 4)
+        elif self.active and now - self._last_motion >= self.hold:
+            self.active = False
+            self.events[-1]["end"] = time.time()
+        else:
+            return
+        if self.on_activity is not None:
+            self.on_activity(self)
+
+    def is_active(self) -> bool:
+        # no verdict before the first comparison: let everything through
+        return self.active or self.samples == 0
+
+    def stats(self) -> dict:
+        return {
+            "url": public_url(self.source.url),
+            "active": self.active,
+            "score": round(self.score, 4),
+            "samples": self.samples,
+            "events": self.event_count,
+            "analysis_time": summarize(self.analysis_times),
+        }
+
+
+class ActivityMonitor:
+    """
+    A motion detector on every source (without holding it: a source closes as
+    usual when its viewers leave). Its verdict gates the work behind it:
+    `is_active(url)` for analysis, `on_activity(url, active)` on the event loop
+    for recording around motion.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        fps: float = 5.0,
+        width: int = 160,
+        threshold: float = 20.0,
+        min_area: float = 0.01,
+        hold: float = 3.0,
+        decode: DecodeProfile = DecodeProfile.reduced,
+        every: int = 1,
+    ):
+        self.registry = registry
+        self.fps = fps
+        self.width = width
+        self.threshold = threshold
+        self.min_area = min_area
+        self.hold = hold
+        self.decode = decode
+        self.every = every
+        self.on_activity: Optional[Callable[[str, bool], None]] = None
+        self._detectors: Dict[Source, MotionDetector] = {}
+        # the same by url, for lookups from reader threads (the gate)
+        self._by_url: Dict[str, MotionDetector] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._sync())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for detector in self._detectors.values():
+            detector.close()
+        self._detectors.clear()
+        self._by_url.clear()
+
+    async def _sync(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            sources = set(self.registry.sources())
+            for source in list(self._detectors):
+                if source not in sources or source.ended.is_set():
+                    detector = self._detectors.pop(source)
+                    detector.close()
+                    if self._by_url.get(source.url) is detector:
+                        del self._by_url[source.url]
+            for source in sources - set(self._detectors):
+                if source.ended.is_set() or not source.has_video:
+                    continue
+                detector = MotionDetector(
+                    source,
+                    self.fps,
+                    self.width,
+                    self.threshold,
+                    self.min_area,
+                    self.hold,
+                    self.decode,
+                    self.every,
+                )
+                detector.on_activity = lambda d: loop.call_soon_threadsafe(self._activity, d)
+                detector.start()
+                self._detectors[source] = detector
+                self._by_url[source.url] = detector
+            await asyncio.sleep(SYNC_INTERVAL)
+
+    def _activity(self, detector: MotionDetector):
+        if self.on_activity is not None:
+            self.on_activity(detector.source.url, detector.active)
+
+    def detector(self, url: str) -> Optional[MotionDetector]:
+        return self._by_url.get(url)
+
+    def is_active(self, url: str) -> bool:
+        """Whether the camera moves; cameras without a detector (yet) count as active"""
+        detector = self.detector(url)
+        return detector is None or detector.is_active()
+
+    def stats(self) -> list[dict]:
+        return [detector.stats() for detector in self._detectors.values()]
+
+    def metrics(self) -> list[tuple]:
+        """(name, labels, value) samples for /webrtc/metrics"""
+        samples = []
+        for detector in self._detectors.values():
+            labels = {"source": public_url(detector.source.url)}
+            samples.append(("webrtc_motion_score", labels, round(detector.score, 4)))
+            samples.append(("webrtc_motion_active", labels, int(detector.active)))
+            samples.append(("webrtc_motion_events_total", labels, detector.event_count))
+        return samples
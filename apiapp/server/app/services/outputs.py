@@ -0,0 +1,555 @@
+import asyncio
+import io
+import logging
+import math
+import struct
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, Optional
+
+import av
+from av.frame import Frame
+from av.packet import Packet
+
+from app.services.snapshots import encode_picture
+from app.services.sources import Source, SourceMode, SourceOpenError, SourceRegistry, public_url
+
+# Video codecs HLS players take in fMP4; others are watched over WebRTC or MJPEG
+HLS_CODECS = {"h264", "hevc"}
+
+# Fragments of the muxer: a new one on every keyframe (segments start there)
+# and after frag_duration (parts)
+HLS_MOVFLAGS = "frag_keyframe+empty_moov+default_base_moof"
+
+# Segments listed together with their parts: the last ones, as the spec advises
+HLS_PART_SEGMENTS = 3
+
+# How long a new output may take to produce its first segment, seconds
+HLS_START_TIMEOUT = 15.0
+
+MJPEG_BOUNDARY = "frame"
+
+
+class MemoryFile(io.RawIOBase):
+    """What the MP4 muxer writes, taken out box by box"""
+
+    def __init__(self):
+        super().__init__()
+        self._data = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._data += data
+        return len(data)
+
+    def take_boxes(self) -> list[tuple[bytes, bytes]]:
+        """Complete top-level boxes written so far, as (type, box)"""
+        boxes = []
+        offset = 0
+        while offset + 8 <= len(self._data):
+            size, kind = struct.unpack_from(">I4s", self._data, offset)
+            if size < 8 or offset + size > len(self._data):
+                break
+            boxes.append((kind, bytes(self._data[offset:offset + size])))
+            offset += size
+        del self._data[:offset]
+        return boxes
+
+
+class HlsPart:
+    def __init__(self, data: bytes, duration: float, independent: bool):
+        self.data = data
+        self.duration = duration
+        self.independent = independent
+
+
+class HlsSegment:
+    def __init__(self, sequence: int, init: int, discontinuity: bool):
+        self.sequence = sequence
+        self.init = init
+        self.discontinuity = discontinuity
+        self.parts: list[HlsPart] = []
+        self.complete = False
+
+    @property
+    def duration(self) -> float:
+        return sum(part.duration for part in self.parts)
+
+    @property
+    def data(self) -> bytes:
+        return b"".join(part.data for part in self.parts)
+
+
+class HlsOutput:
+    """
+    Low-latency HLS of a camera: its video remuxed (not encoded) to fMP4,
+    in parts of about `part_target` seconds and segments that start on a
+    keyframe after `segment_target`. The last `window` segments stay in memory.
+
+    The muxer runs in the reader thread of the source (it copies bytes only);
+    the segments and the playlist live on the event loop.
+    """
+
+    def __init__(
+        self,
+        source: Source,
+        output_id: str,
+        part_target: float = 0.5,
+        segment_target: float = 2.0,
+        window: int = 6,
+    ):
+        self.source = source
+        self.id = output_id
+        self.part_target = part_target
+        self.segment_target = segment_target
+        self.window = window
+        self.last_access = time.monotonic()
+        self.closed = False
+        self.watcher: Optional[asyncio.Task] = None
+        self._loop = asyncio.get_running_loop()
+
+        # reader thread; close() takes the muxer under the lock
+        self._lock = threading.Lock()
+        self._input = None
+        self._file: Optional[MemoryFile] = None
+        self._muxer = None
+        self._stream = None
+        # start (seconds) of the fragment being muxed, and whether it starts on a keyframe
+        self._fragment: Optional[tuple[float, bool]] = None
+        self._last_dts: Optional[int] = None
+
+        # event loop
+        self.inits: Dict[int, bytes] = {}
+        self.segments: deque[HlsSegment] = deque()
+        self._init = 0
+        self._discontinuity_sequence = 0
+        self._changed = asyncio.Event()
+
+    def start(self):
+        self.source.add_packet_sink(self)
+
+    def close(self):
+        self.closed = True
+        self.source.remove_packet_sink(self)
+        # the reader thread may be muxing right now: close the muxer after it
+        with self._lock:
+            self._close_muxer()
+        self._notify()
+
+    # ---------- reader thread of the source ----------
+
+    def submit(self, packet: Packet, video_stream, audio_stream):
+        if packet.stream is not video_stream:
+            return
+        with self._lock:
+            # a packet of the sinks taken before close()
+            if not self.closed:
+                self._submit(packet, video_stream)
+
+    def _submit(self, packet: Packet, video_stream):
+        if video_stream is not self._input:
+            # a new connection: a new muxer and init segment, a discontinuity
+            self._input = video_stream
+            self._restart(video_stream)
+        if self._muxer is None or (self._fragment is None and not packet.is_keyframe):
+            return
+        dts = packet.dts if packet.dts is not None else packet.pts
+        if self._last_dts is not None and dts <= self._last_dts:
+            return
+        self._last_dts = dts
+
+        copy = Packet(bytes(packet))
+        copy.pts = packet.pts
+        copy.dts = packet.dts
+        copy.time_base = packet.time_base
+        copy.is_keyframe = packet.is_keyframe
+        copy.stream = self._stream
+        try:
+            self._muxer.mux(copy)
+        except av.FFmpegError as exc:
+            logging.warning(f"HLS of {public_url(self.source.url)} stopped: {exc!r}")
+            self._close_muxer()
+            return
+
+        seconds = float(dts * packet.time_base)
+        boxes = self._file.take_boxes()
+        init = b"".join(box for kind, box in boxes if kind in (b"ftyp", b"moov"))
+        fragment = b"".join(box for kind, box in boxes if kind in (b"moof", b"mdat"))
+        if init:
+            self._loop.call_soon_threadsafe(self._add_init, init)
+        if fragment and self._fragment is not None:
+            # the muxer flushed what came before this packet: it starts the next fragment
+            start, independent = self._fragment
+            self._loop.call_soon_threadsafe(
+                self._add_part, fragment, seconds - start, independent, packet.is_keyframe
+            )
+        if fragment or self._fragment is None:
+            self._fragment = (seconds, packet.is_keyframe)
+
+    def _restart(self, video_stream):
+        self._close_muxer()
+        self._fragment = None
+        self._last_dts = None
+        codec = video_stream.codec_context.name
+        if codec not in HLS_CODECS:
+            logging.warning(f"HLS of {public_url(self.source.url)}: {codec} is not supported")
+            return
+        self._file = MemoryFile()
+        # parts a little shorter than the target: a frame more must still fit in it
+        self._muxer = av.open(self._file, mode="w", format="mp4", options={
+            "movflags": HLS_MOVFLAGS,
+            "frag_duration": str(int(self.part_target * 0.9 * 1_000_000)),
+        })
+        self._stream = self._muxer.add_stream_from_template(video_stream)
+
+    def _close_muxer(self):
+        if self._muxer is None:
+            return
+        muxer, self._muxer = self._muxer, None
+        try:
+            muxer.close()
+        except av.FFmpegError as exc:
+            # the trailer of a muxer that failed or got nothing yet: nobody reads it
+            logging.debug(f"HLS muxer of {public_url(self.source.url)} not closed cleanly: {exc!r}")
+
+    # ---------- event loop ----------
+
+    def _add_init(self, data: bytes):
+        self._init += 1
+        self.inits[self._init] = data
+        current = self.segments[-1] if self.segments else None
+        if current is not None and not current.parts:
+            current.init = self._init
+            current.discontinuity = len(self.segments) > 1
+        else:
+            if current is not None:
+                current.complete = True
+            self._start_segment(discontinuity=current is not None)
+        self._notify()
+
+    def _add_part(self, data: bytes, duration: float, independent: bool, next_keyframe: bool):
+        if not self.segments:
+            return
+        segment = self.segments[-1]
+        segment.parts.append(HlsPart(data, duration, independent))
+        # a keyframe a frame or two early still ends the segment
+        if next_keyframe and segment.duration >= self.segment_target * 0.9:
+            segment.complete = True
+            self._start_segment(discontinuity=False)
+        self._notify()
+
+    def _start_segment(self, discontinuity: bool):
+        sequence = self.segments[-1].sequence + 1 if self.segments else 0
+        self.segments.append(HlsSegment(sequence, self._init, discontinuity))
+        while len(self.segments) > self.window + 1:
+            dropped = self.segments.popleft()
+            if self.segments[0].discontinuity:
+                self._discontinuity_sequence += 1
+            if all(segment.init != dropped.init for segment in self.segments):
+                self.inits.pop(dropped.init, None)
+
+    def _notify(self):
+        # waiters hold the old event: set it, and the next change sets a new one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_for(self, ready: Callable[[], bool], timeout: float) -> bool:
+        deadline = self._loop.time() + timeout
+        while not ready():
+            left = deadline - self._loop.time()
+            if self.closed or left <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self._changed.wait(), left)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def started(self) -> bool:
+        """A segment is complete: players can start"""
+        return any(segment.complete for segment in self.segments)
+
+    def has_part(self, sequence: int, part: Optional[int]) -> bool:
+        """Segment `sequence` is complete, or has part `part` (blocking playlist reloads)"""
+        if not self.segments:
+            return False
+        current = self.segments[-1]
+        if sequence < current.sequence:
+            return True
+        if sequence > current.sequence or part is None:
+            return False
+        return len(current.parts) > part
+
+    def segment(self, sequence: int) -> Optional[HlsSegment]:
+        if not self.segments:
+            return None
+        index = sequence - self.segments[0].sequence
+        if 0 <= index < len(self.segments):
+            return self.segments[index]
+        return None
+
+    def playlist(self) -> str:
+        segments = list(self.segments)
+        target = max(
+            [math.ceil(segment.duration) for segment in segments if segment.complete]
+            + [math.ceil(self.segment_target)]
+        )
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:9",
+            f"#EXT-X-TARGETDURATION:{target}",
+            "#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,"
+            f"PART-HOLD-BACK={3 * self.part_target:.3f}",
+            f"#EXT-X-PART-INF:PART-TARGET={self.part_target:.3f}",
+            f"#EXT-X-MEDIA-SEQUENCE:{segments[0].sequence}",
+            f"#EXT-X-DISCONTINUITY-SEQUENCE:{self._discontinuity_sequence}",
+        ]
+        init = None
+        last = segments[-1]
+        for index, segment in enumerate(segments):
+            if segment.discontinuity and index:
+                lines.append("#EXT-X-DISCONTINUITY")
+            if segment.init != init:
+                init = segment.init
+                lines.append(f'#EXT-X-MAP:URI="hls/{self.id}/init/{init}.mp4"')
+            if segment.sequence > last.sequence - HLS_PART_SEGMENTS:
+                for number, part in enumerate(segment.parts):
+                    lines.append(
+                        f"#EXT-X-PART:DURATION={part.duration:.3f},"
+                        f'URI="hls/{self.id}/part/{segment.sequence}.{number}.m4s"'
+                        + (",INDEPENDENT=YES" if part.independent else "")
+                    )
+            if segment.complete:
+                lines.append(f"#EXTINF:{segment.duration:.3f},")
+                lines.append(f"hls/{self.id}/segment/{segment.sequence}.m4s")
+        hint = f"hls/{self.id}/part/{last.sequence}.{len(last.parts)}.m4s"
+        lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{hint}"')
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "url": public_url(self.source.url),
+            "segments": len(self.segments),
+            "bytes": sum(len(segment.data) for segment in self.segments),
+            "idle": round(time.monotonic() - self.last_access, 1),
+        }
+
+
+class MjpegOutput:
+    """
+    Multipart JPEG of a camera for clients without WebRTC or HLS: decoded
+    frames encoded in a thread of its own, at most `fps` a second, once for
+    all clients. Clients always get the latest picture, a slow one skips some.
+    """
+
+    def __init__(self, source: Source, fps: float = 5.0, width: int = 640, quality: int = 70):
+        self.source = source
+        self.fps = fps
+        self.width = width
+        self.quality = quality
+        self.clients = 0
+        self.closed = False
+        self.jpeg: Optional[bytes] = None
+        self.watcher: Optional[asyncio.Task] = None
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._frame: Optional[Frame] = None
+        self._quit = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(name="mjpeg", target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self.source.add_frame_sink(self)
+
+    def close(self):
+        self.closed = True
+        self.source.remove_frame_sink(self)
+        with self._cond:
+            self._quit = True
+            self._cond.notify()
+        self._notify()
+
+    def submit(self, frame: Frame):
+        with self._cond:
+            self._frame = frame
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._frame is None and not self._quit:
+                    self._cond.wait()
+                if self._quit:
+                    break
+                frame, self._frame = self._frame, None
+            started = time.monotonic()
+            try:
+                jpeg = encode_picture(frame, None, "jpeg", self.width or None, self.quality)
+            except (av.FFmpegError, SourceOpenError) as exc:
+                logging.warning(f"MJPEG of {public_url(self.source.url)} encode error: {exc!r}")
+                continue
+            self._loop.call_soon_threadsafe(self._deliver, jpeg)
+            # frames arriving meanwhile are replaced by the latest one
+            with self._cond:
+                self._cond.wait_for(lambda: self._quit, 1 / self.fps - (time.monotonic() - started))
+
+    def _deliver(self, jpeg: bytes):
+        self.jpeg = jpeg
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def frames(self) -> AsyncIterator[bytes]:
+        """Parts of the multipart stream: the current picture, then every new one"""
+        while not self.closed:
+            if self.jpeg is not None:
+                yield (
+                    f"--{MJPEG_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                    f"Content-Length: {len(self.jpeg)}\r\n\r\n"
+                ).encode() + self.jpeg + b"\r\n"
+            await self._changed.wait()
+
+    def stats(self) -> dict:
+        return {"url": public_url(self.source.url), "clients": self.clients}
+
+
+class OutputRegistry:
+    """
+    HLS and MJPEG outputs of the cameras, fed by the same shared sources as
+    the WebRTC tracks: at most one of each per camera, however many clients.
+    An HLS output goes after `idle` seconds without requests, an MJPEG one
+    with its last client; both go with their source.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        new_id: Callable[[], str],
+        part_target: float = 0.5,
+        segment_target: float = 2.0,
+        window: int = 6,
+        idle: float = 30.0,
+        mjpeg_fps: float = 5.0,
+        mjpeg_width: int = 640,
+        mjpeg_quality: int = 70,
+    ):
+        self.registry = registry
+        self.new_id = new_id
+        self.part_target = part_target
+        self.segment_target = segment_target
+        self.window = window
+        self.idle = idle
+        self.mjpeg_fps = mjpeg_fps
+        self.mjpeg_width = mjpeg_width
+        self.mjpeg_quality = mjpeg_quality
+        self._hls: Dict[str, HlsOutput] = {}
+        self._hls_ids: Dict[str, HlsOutput] = {}
+        self._mjpeg: Dict[str, MjpegOutput] = {}
+        # outputs being opened: clients of the same camera wait for the same one
+        self._opening: Dict[tuple, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._close_idle())
+
+    async def hls(self, url: str, mode: SourceMode = SourceMode.auto) -> HlsOutput:
+        output = self._hls.get(url)
+        if output is None:
+            output = await self._open("hls", url, mode)
+        output.last_access = time.monotonic()
+        return output
+
+    def hls_output(self, output_id: str) -> Optional[HlsOutput]:
+        output = self._hls_ids.get(output_id)
+        if output is not None:
+            output.last_access = time.monotonic()
+        return output
+
+    async def mjpeg(self, url: str, mode: SourceMode = SourceMode.auto) -> MjpegOutput:
+        """The MJPEG output of the camera, with one more client: release_mjpeg() it"""
+        output = self._mjpeg.get(url)
+        if output is None:
+            output = await self._open("mjpeg", url, mode)
+        output.clients += 1
+        return output
+
+    def release_mjpeg(self, output: MjpegOutput):
+        output.clients -= 1
+        if output.clients <= 0 and not output.closed:
+            self._close(output)
+
+    async def _open(self, kind: str, url: str, mode: SourceMode):
+        key = (kind, url)
+        pending = self._opening.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._create(kind, url, mode))
+            self._opening[key] = pending
+            pending.add_done_callback(lambda _: self._opening.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _create(self, kind: str, url: str, mode: SourceMode):
+        source = await self.registry.acquire(url, mode)
+        if kind == "hls":
+            output = HlsOutput(
+                source, self.new_id(), self.part_target, self.segment_target, self.window
+            )
+            self._hls[url] = self._hls_ids[output.id] = output
+        else:
+            output = MjpegOutput(source, self.mjpeg_fps, self.mjpeg_width, self.mjpeg_quality)
+            self._mjpeg[url] = output
+        output.start()
+        # a camera gone for good takes its outputs along
+        output.watcher = asyncio.ensure_future(self._close_when_ended(output))
+        return output
+
+    async def _close_when_ended(self, output):
+        await output.source.ended.wait()
+        if not output.closed:
+            self._close(output)
+
+    def _close(self, output):
+        output.close()
+        if output.watcher is not None:
+            output.watcher.cancel()
+        url = output.source.url
+        if isinstance(output, HlsOutput):
+            if self._hls.get(url) is output:
+                del self._hls[url]
+            self._hls_ids.pop(output.id, None)
+        elif self._mjpeg.get(url) is output:
+            del self._mjpeg[url]
+        self.registry.release(output.source)
+
+    async def _close_idle(self):
+        while True:
+            await asyncio.sleep(self.idle / 2)
+            now = time.monotonic()
+            for output in list(self._hls.values()):
+                if now - output.last_access > self.idle:
+                    logging.info(f"HLS of {public_url(output.source.url)} closed: no requests")
+                    self._close(output)
+
+    def close_all(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for output in [*self._hls.values(), *self._mjpeg.values()]:
+            output.close()
+            if output.watcher is not None:
+                output.watcher.cancel()
+        self._hls.clear()
+        self._hls_ids.clear()
+        self._mjpeg.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hls": [output.stats() for output in self._hls.values()],
+            "mjpeg": [output.stats() for output in self._mjpeg.values()],
+        }
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+import weakref
+from typing import Awaitable, Callable, Optional
+
+from aiortc import RTCPeerConnection
+
+
+class PeerReaper:
+    """
+    Closes peer connections that will never be useful: offers abandoned
+    mid-ICE (a closed tab), connections stuck in DTLS setup and connected
+    ones without media in either direction. Each holds a viewer of a camera,
+    so without the reaper they would keep RTSP sessions and decoders forever.
+    """
+
+    def __init__(
+        self,
+        pcs: set,
+        close: Callable[[RTCPeerConnection], Awaitable[None]],
+        ice_timeout: float = 15.0,
+        connect_timeout: float = 30.0,
+        media_timeout: float = 30.0,
+        interval: float = 5.0,
+    ):
+        self.pcs = pcs
+        self.close = close
+        self.ice_timeout = ice_timeout
+        self.connect_timeout = connect_timeout
+        self.media_timeout = media_timeout
+        self.interval = interval
+        self.reaped = 0
+        self._created: "weakref.WeakKeyDictionary[RTCPeerConnection, float]" = (
+            weakref.WeakKeyDictionary()
+        )
+        # pc -> (bytes sent and received, when they last changed)
+        self._traffic: "weakref.WeakKeyDictionary[RTCPeerConnection, tuple]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._task: Optional[asyncio.Task] = None
+
+    def watch(self, pc: RTCPeerConnection):
+        """Start the setup deadlines of a new connection"""
+        self._created[pc] = time.monotonic()
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for pc in list(self.pcs):
+                try:
+                    reason = await self._stale(pc)
+                except Exception as exc:
+                    logging.warning(f"Reaper failed to check a connection: {exc!r}")
+                    continue
+                if reason is not None:
+                    logging.info(f"Closing stale peer connection: {reason}")
+                    self.reaped += 1
+                    await self.close(pc)
+
+    async def _stale(self, pc: RTCPeerConnection) -> Optional[str]:
+        now = time.monotonic()
+        age = now - self._created.setdefault(pc, now)
+        if pc.connectionState in ("failed", "closed"):
+            return f"connection {pc.connectionState}"
+        if pc.iceConnectionState not in ("connected", "completed"):
+            if age > self.ice_timeout:
+                return f"ICE not connected in {self.ice_timeout:g}s"
+            return None
+        if pc.connectionState != "connected":
+            if age > self.connect_timeout:
+                return f"DTLS not connected in {self.connect_timeout:g}s"
+            return None
+
+        report = await pc.getStats()
+        traffic = sum(
+            getattr(stats, "bytesSent", 0) + getattr(stats, "bytesReceived", 0)
+            for stats in report.values()
+            if stats.type in ("outbound-rtp", "inbound-rtp")
+        )
+        previous, changed_at = self._traffic.get(pc, (None, now))
+        if traffic != previous:
+            self._traffic[pc] = (traffic, now)
+        elif now - changed_at > self.media_timeout:
+            return f"no media for {self.media_timeout:g}s"
+        return None
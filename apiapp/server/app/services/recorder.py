@@ -0,0 +1,367 @@
+import asyncio
+import datetime
+import io
+import logging
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Dict, Optional
+
+import av
+from av.packet import Packet
+
+from app.services.sources import (
+    PIN_RETRY_INTERVAL, SourceMode, SourceModeError, SourceOpenError, SourceRegistry, public_url
+)
+
+# Fragmented MP4: every keyframe starts a fragment, a segment cut short
+# (crash, full disk) is still playable up to its last fragment
+SEGMENT_OPTIONS = {"movflags": "frag_keyframe+empty_moov+default_base_moof"}
+
+# Audio codecs MP4 can carry; others (G.711 of many cameras) are left out
+MP4_AUDIO_CODECS = {"aac", "mp3", "opus", "ac3", "eac3", "alac", "flac"}
+
+# Upper bound of the pre-event buffer, whatever its length in seconds
+PRE_EVENT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def recording_name(url: str) -> str:
+    """File name prefix of a camera: its URL without credentials, made safe"""
+    return re.sub(r"[^A-Za-z0-9]+", "-", public_url(url)).strip("-")[-48:] or "camera"
+
+
+class Recorder:
+    """
+    Writes a camera into fragmented MP4 segments, remuxed without re-encoding.
+
+    The reader thread of the source hands over every demuxed packet; a writer
+    thread of its own does the file I/O behind a queue bounded in bytes, so a
+    slow disk drops recorded video (to the next keyframe) instead of stalling
+    the viewers. Segments are cut on a keyframe after `segment_seconds` of
+    media or `segment_bytes`. With `pre_event` the last seconds are kept in
+    memory, and an event (trigger) writes them together with what follows;
+    `continuous` records all the time.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        name: str,
+        continuous: bool = True,
+        pre_event: float = 0.0,
+        segment_seconds: float = 60.0,
+        segment_bytes: int = 256 * 1024 * 1024,
+        queue_bytes: int = 16 * 1024 * 1024,
+    ):
+        self.directory = directory
+        self.name = name
+        self.continuous = continuous
+        self.pre_event = pre_event
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.queue_bytes = queue_bytes
+        self.segments: deque = deque(maxlen=100)
+        self.bytes_written = 0
+        self.dropped = 0
+        self.error: Optional[str] = None
+
+        # reader thread -> writer thread
+        self._queue: deque = deque()
+        self._queued_bytes = 0
+        self._ready = threading.Condition()
+        self._skip_to_keyframe = False
+        # input streams of the connection being read, and their copies
+        # that outlive the connection (templates of the segment streams)
+        self._inputs: tuple = (None, None)
+        self._input_templates: dict = {}
+        self._thread: Optional[threading.Thread] = None
+
+        # writer thread only
+        self._templates: Dict[str, av.stream.Stream] = {}
+        self._template_container = None
+        self._recording_until = float("inf") if continuous else 0.0
+        self._ring: deque = deque()
+        self._ring_keyframes: deque = deque()
+        self._ring_bytes = 0
+        self._output = None
+        self._streams: Dict[str, av.stream.Stream] = {}
+        self._segment_path: Optional[Path] = None
+        self._segment_start: Optional[float] = None
+        self._segment_bytes = 0
+        self._last_dts: Dict[str, int] = {}
+
+    def start(self):
+        self._thread = threading.Thread(
+            name=f"recorder {self.name}", target=self._run, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Finish the current segment and end the writer thread (not waiting for it)"""
+        with self._ready:
+            self._queue.append(None)
+            self._ready.notify()
+
+    def trigger(self, seconds: float):
+        """An event: record from `pre_event` seconds ago to `seconds` from now"""
+        with self._ready:
+            self._queue.append(("event", time.monotonic() + seconds))
+            self._ready.notify()
+
+    # ---------- reader thread of the source ----------
+
+    def submit(self, packet: Packet, video_stream, audio_stream):
+        if (video_stream, audio_stream) != self._inputs:
+            # a new connection to the camera: its timeline starts anew
+            self._inputs = (video_stream, audio_stream)
+            self._enqueue(("streams", self._copy_streams(video_stream, audio_stream)), 0)
+        if packet.stream is video_stream:
+            kind = "video"
+        elif packet.stream is audio_stream and "audio" in self._input_templates:
+            kind = "audio"
+        else:
+            return
+        if kind == "video" and self._skip_to_keyframe:
+            if not packet.is_keyframe:
+                self.dropped += 1
+                return
+            self._skip_to_keyframe = False
+        if self._queued_bytes + packet.size > self.queue_bytes:
+            # the disk does not keep up: the next keyframe is the next point to resume
+            self.dropped += 1
+            self._skip_to_keyframe = True
+            return
+        copy = Packet(bytes(packet))
+        copy.pts = packet.pts
+        copy.dts = packet.dts
+        copy.time_base = packet.time_base
+        copy.is_keyframe = packet.is_keyframe
+        self._enqueue((kind, copy), packet.size)
+
+    def _copy_streams(self, video_stream, audio_stream) -> Dict[str, av.stream.Stream]:
+        """
+        Codec parameters of the connection, copied into a container that is
+        never written: the connection itself is closed by the source at its end.
+        """
+        container = av.open(io.BytesIO(), mode="w", format="mp4")
+        templates = {}
+        if video_stream is not None:
+            templates["video"] = container.add_stream_from_template(video_stream)
+        if audio_stream is not None and audio_stream.codec_context.name in MP4_AUDIO_CODECS:
+            templates["audio"] = container.add_stream_from_template(audio_stream)
+        templates["container"] = container
+        self._input_templates = templates
+        return templates
+
+    def _enqueue(self, item, size: int):
+        with self._ready:
+            self._queue.append(item)
+            self._queued_bytes += size
+            self._ready.notify()
+
+    # ---------- writer thread ----------
+
+    def _run(self):
+        try:
+            while True:
+                with self._ready:
+                    while not self._queue:
+                        self._ready.wait()
+                    item = self._queue.popleft()
+                    if item is not None and item[0] in ("video", "audio"):
+                        self._queued_bytes -= item[1].size
+                if item is None:
+                    break
+                kind, data = item
+                if kind == "streams":
+                    self._new_connection(data)
+                elif kind == "event":
+                    self._recording_until = max(self._recording_until, data)
+                elif self.error is None:
+                    self._packet(kind, data)
+        finally:
+            self._close_segment()
+
+    def _new_connection(self, templates: dict):
+        self._close_segment()
+        self._ring.clear()
+        self._ring_keyframes.clear()
+        self._ring_bytes = 0
+        self._templates = templates
+        self._template_container = templates.pop("container")
+
+    def _packet(self, kind: str, packet: Packet):
+        now = time.monotonic()
+        recording = now < self._recording_until
+        if not recording and self._output is not None:
+            self._close_segment()
+        if self.pre_event > 0:
+            self._remember(kind, packet, now)
+            if recording and self._output is None and self._ring:
+                # the event starts with what happened before it
+                for ring_kind, ring_packet in list(self._ring):
+                    self._write(ring_kind, ring_packet)
+                self._ring.clear()
+                self._ring_keyframes.clear()
+                self._ring_bytes = 0
+                return
+        if recording:
+            self._write(kind, packet)
+
+    def _remember(self, kind: str, packet: Packet, now: float):
+        """Keep the last `pre_event` seconds, from a keyframe on"""
+        is_keyframe = kind == "video" and packet.is_keyframe
+        if not self._ring and not is_keyframe:
+            return
+        self._ring.append((kind, packet))
+        self._ring_bytes += packet.size
+        if is_keyframe:
+            self._ring_keyframes.append(now)
+        # drop whole GOPs from the front while the next one still covers pre_event
+        while len(self._ring_keyframes) > 1 and (
+            self._ring_keyframes[1] <= now - self.pre_event
+            or self._ring_bytes > PRE_EVENT_MAX_BYTES
+        ):
+            self._ring_keyframes.popleft()
+            _, dropped = self._ring.popleft()
+            self._ring_bytes -= dropped.size
+            while not (self._ring[0][0] == "video" and self._ring[0][1].is_keyframe):
+                _, dropped = self._ring.popleft()
+                self._ring_bytes -= dropped.size
+
+    def _write(self, kind: str, packet: Packet):
+        media_time = float(packet.pts * packet.time_base)
+        is_keyframe = kind == "video" and packet.is_keyframe
+        if self._output is not None and is_keyframe and (
+            media_time - self._segment_start >= self.segment_seconds
+            or self._segment_bytes >= self.segment_bytes
+        ):
+            self._close_segment()
+        if self._output is None:
+            if "video" in self._templates and not is_keyframe:
+                # a segment must be playable from its start
+                return
+            try:
+                self._open_segment(media_time)
+            except (OSError, av.FFmpegError) as exc:
+                self._fail(exc)
+                return
+
+        # every segment starts at 0, audio and video shifted alike
+        shift = round(self._segment_start / packet.time_base)
+        packet.pts -= shift
+        if packet.dts is not None:
+            packet.dts -= shift
+            if packet.dts <= self._last_dts.get(kind, -1 << 62):
+                # out of order after a hiccup of the camera: the muxer would refuse it
+                self.dropped += 1
+                return
+            self._last_dts[kind] = packet.dts
+        packet.stream = self._streams[kind]
+        try:
+            self._output.mux(packet)
+        except (OSError, av.FFmpegError) as exc:
+            self._fail(exc)
+            return
+        self._segment_bytes += packet.size
+        self.bytes_written += packet.size
+
+    def _open_segment(self, media_time: float):
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")[:-3]
+        path = self.directory / f"{self.name}_{stamp}.mp4"
+        output = av.open(str(path), mode="w", format="mp4", options=SEGMENT_OPTIONS)
+        self._streams = {
+            kind: output.add_stream_from_template(template)
+            for kind, template in self._templates.items()
+        }
+        self._output = output
+        self._segment_path = path
+        self._segment_start = media_time
+        self._segment_bytes = 0
+        self._last_dts = {}
+
+    def _close_segment(self):
+        if self._output is None:
+            return
+        try:
+            self._output.close()
+        except (OSError, av.FFmpegError) as exc:
+            logging.warning(f"Recording {self.name}: segment not finished: {exc!r}")
+        self.segments.append(self._segment_path.name)
+        self._output = None
+        self._segment_path = None
+
+    def _fail(self, exc: Exception):
+        # a full or gone disk: stop writing, the source goes on
+        self.error = repr(exc)
+        logging.error(f"Recording {self.name} failed: {exc!r}")
+        self._close_segment()
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "directory": str(self.directory),
+            "continuous": self.continuous,
+            "pre_event": self.pre_event,
+            "recording": self._output is not None,
+            "segment": self._segment_path.name if self._segment_path else None,
+            "segments": list(self.segments),
+            "bytes_written": self.bytes_written,
+            "queued_bytes": self._queued_bytes,
+            "dropped": self.dropped,
+            "error": self.error,
+        }
+
+
+class Recording:
+    """
+    A recorder attached to the source of a camera, for as long as the recording
+    runs. With `motion` its events come from the motion detector of the camera.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        url: str,
+        mode: SourceMode,
+        recorder: Recorder,
+        motion: bool = False,
+    ):
+        self.registry = registry
+        self.url = url
+        self.mode = mode
+        self.recorder = recorder
+        self.motion = motion
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.recorder.start()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.recorder.stop()
+
+    async def _run(self):
+        # like a pinned camera: the source is held, and opened again when it ends
+        while True:
+            try:
+                source = await self.registry.acquire(self.url, self.mode)
+            except (SourceOpenError, SourceModeError) as exc:
+                logging.warning(f"Recording {self.recorder.name}: {exc}")
+                await asyncio.sleep(PIN_RETRY_INTERVAL)
+                continue
+            source.add_packet_sink(self.recorder)
+            try:
+                await source.ended.wait()
+            finally:
+                source.remove_packet_sink(self.recorder)
+                self.registry.release(source)
+            await asyncio.sleep(PIN_RETRY_INTERVAL)
+
+    def stats(self) -> dict:
+        return {"url": public_url(self.url), "motion": self.motion, **self.recorder.stats()}
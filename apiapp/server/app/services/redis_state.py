@@ -0,0 +1,159 @@
+import asyncio
+import json
+from typing import AsyncIterator, Optional
+
+import redis.asyncio as redis
+
+from app.services.signaling import MAX_LONG_POLL, check_message, snapshot
+from app.services.state import DEFAULT_TURN_SERVERS, StateBackend
+
+PREFIX = "webrtc:"
+
+# Owner of a key, unless another live node owns it already: in one step,
+# so that two nodes can't both take a camera
+CLAIM_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] and redis.call('EXISTS', ARGV[3] .. owner) == 1 then
+    return owner
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return ARGV[1]
+"""
+
+
+class RedisSignalingStore:
+    """
+    SignalingStore in Redis: rooms are a hash (offer, answer, stream_path)
+    and a list of candidates per role, expiring `ttl` seconds after the last
+    activity; messages are pushed to the subscribers of every node over pub/sub.
+    """
+
+    def __init__(self, client: "redis.Redis", ttl: float = 300.0):
+        self.redis = client
+        self.ttl = ttl
+        self._subscribers = 0
+
+    def _keys(self, name: str) -> tuple[str, str, str]:
+        room = f"{PREFIX}signaling:{name}"
+        return room, room + ":candidates:offer", room + ":candidates:answer"
+
+    def _channel(self, name: str) -> str:
+        return f"{PREFIX}signaling:{name}:events"
+
+    async def publish(self, name: str, message: dict):
+        """Store an offer/answer/candidate/clear message and push it to the room"""
+        kind = check_message(message)
+        room, offer_candidates, answer_candidates = keys = self._keys(name)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if kind == "offer":
+                # a new offer starts a new negotiation
+                pipe.delete(*keys)
+                pipe.hset(room, mapping={
+                    "offer": json.dumps({"type": "offer", "sdp": message.get("sdp")}),
+                    "stream_path": json.dumps(message.get("stream_path")),
+                })
+            elif kind == "answer":
+                pipe.hset(room, "answer", json.dumps({"type": "answer", "sdp": message.get("sdp")}))
+            elif kind == "candidate":
+                role_key = answer_candidates if message.get("role") == "answer" else offer_candidates
+                pipe.rpush(role_key, json.dumps(message.get("candidate")))
+            else:
+                pipe.delete(*keys)
+            for key in keys:
+                pipe.expire(key, int(self.ttl))
+            pipe.publish(self._channel(name), json.dumps(message))
+            await pipe.execute()
+
+    async def state(self, name: str) -> dict:
+        """Offer, answer, stream_path and candidates of the room"""
+        room, offer_candidates, answer_candidates = self._keys(name)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(room)
+            pipe.lrange(offer_candidates, 0, -1)
+            pipe.lrange(answer_candidates, 0, -1)
+            fields, offer, answer = await pipe.execute()
+        return {
+            "offer": json.loads(fields["offer"]) if "offer" in fields else None,
+            "answer": json.loads(fields["answer"]) if "answer" in fields else None,
+            "stream_path": json.loads(fields.get("stream_path", "null")),
+            "candidates": {
+                "offer": [json.loads(c) for c in offer],
+                "answer": [json.loads(c) for c in answer],
+            },
+        }
+
+    async def _messages(self, pubsub) -> AsyncIterator[dict]:
+        async for item in pubsub.listen():
+            if item["type"] == "message":
+                yield json.loads(item["data"])
+
+    async def wait_for(self, name: str, key: str, timeout: float) -> Optional[dict]:
+        """Value of `key` ("offer"/"answer"), waiting up to `timeout` for it to appear"""
+        pubsub = self.redis.pubsub()
+        # subscribed before the check: a message between the two is not lost
+        await pubsub.subscribe(self._channel(name))
+        try:
+            value = (await self.state(name))[key]
+            if value is not None or timeout <= 0:
+                return value
+
+            async def appears():
+                async for message in self._messages(pubsub):
+                    if message.get("type") == key:
+                        return
+
+            try:
+                await asyncio.wait_for(appears(), min(timeout, MAX_LONG_POLL))
+            except asyncio.TimeoutError:
+                pass
+            return (await self.state(name))[key]
+        finally:
+            await pubsub.aclose()
+
+    async def subscribe(self, name: str) -> AsyncIterator[dict]:
+        """Messages of the room: the current state first, then every new one"""
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self._channel(name))
+        self._subscribers += 1
+        try:
+            for message in snapshot(await self.state(name)):
+                yield message
+            async for message in self._messages(pubsub):
+                yield message
+        finally:
+            self._subscribers -= 1
+            await pubsub.aclose()
+
+    def stats(self) -> dict:
+        # rooms live in Redis; the subscribers are the ones of this node
+        return {"backend": "redis", "subscribers": self._subscribers}
+
+
+class RedisState(StateBackend):
+    """State shared by all nodes through Redis (or any server speaking its protocol)"""
+
+    def __init__(self, url: str, signaling_ttl: float = 300.0):
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.signaling = RedisSignalingStore(self.redis, signaling_ttl)
+        self._claim = self.redis.register_script(CLAIM_SCRIPT)
+
+    async def turn_servers(self) -> list:
+        servers = await self.redis.get(PREFIX + "turn")
+        return DEFAULT_TURN_SERVERS if servers is None else json.loads(servers)
+
+    async def set_turn_servers(self, servers: list):
+        await self.redis.set(PREFIX + "turn", json.dumps(servers))
+
+    async def heartbeat(self, node: str, url: str, ttl: float):
+        await self.redis.set(f"{PREFIX}node:{node}", url, px=int(ttl * 1000))
+
+    async def node_url(self, node: str) -> Optional[str]:
+        return await self.redis.get(f"{PREFIX}node:{node}")
+
+    async def claim(self, key: str, node: str, ttl: float) -> str:
+        return await self._claim(
+            keys=[f"{PREFIX}claim:{key}"], args=[node, int(ttl * 1000), f"{PREFIX}node:"]
+        )
+
+    async def close(self):
+        await self.redis.aclose()
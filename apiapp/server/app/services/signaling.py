@@ -0,0 +1,149 @@
+import asyncio
+import time
+from typing import AsyncIterator, Dict, Optional
+
+# Room of the legacy endpoints that don't name one
+DEFAULT_ROOM = "default"
+
+# Messages a subscriber may lag behind before the oldest are dropped
+SUBSCRIBER_QUEUE = 100
+
+# Longest wait of a long-poll request, seconds
+MAX_LONG_POLL = 30.0
+
+MESSAGE_TYPES = ("offer", "answer", "candidate", "clear")
+
+
+def check_message(message) -> str:
+    """Type of a signaling message; ValueError when it is not one"""
+    if not isinstance(message, dict):
+        raise ValueError("Signaling message must be an object")
+    kind = message.get("type")
+    if kind not in MESSAGE_TYPES:
+        raise ValueError(f"Unknown signaling message '{kind}'")
+    return kind
+
+
+def snapshot(state: dict) -> list[dict]:
+    """What a new subscriber of a room with this state has missed, as messages"""
+    messages = []
+    if state["offer"] is not None:
+        messages.append({**state["offer"], "stream_path": state["stream_path"]})
+    if state["answer"] is not None:
+        messages.append(state["answer"])
+    for role, candidates in state["candidates"].items():
+        messages.extend({"type": "candidate", "role": role, "candidate": c} for c in candidates)
+    return messages
+
+
+class Room:
+    """Signaling state of one session: the last offer and answer, and candidates"""
+
+    def __init__(self):
+        self.offer: Optional[dict] = None
+        self.answer: Optional[dict] = None
+        self.stream_path: Optional[str] = None
+        # candidates by the role that sent them ("offer" or "answer" side)
+        self.candidates: Dict[str, list] = {"offer": [], "answer": []}
+        self.touched = time.monotonic()
+        self.changed = asyncio.Condition()
+        self.subscribers: set[asyncio.Queue] = set()
+
+
+class SignalingStore:
+    """
+    Offers, answers and ICE candidates by room, kept for `ttl` seconds after
+    the last activity. Peers get them pushed (subscribe: WebSocket/SSE) or
+    wait for them in one request (wait_for: long-poll) instead of polling.
+    """
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._rooms: Dict[str, Room] = {}
+        self._purged = time.monotonic()
+
+    def room(self, name: str) -> Room:
+        self._purge()
+        room = self._rooms.get(name)
+        if room is None:
+            room = self._rooms[name] = Room()
+        room.touched = time.monotonic()
+        return room
+
+    def _purge(self):
+        now = time.monotonic()
+        if now - self._purged < self.ttl / 4:
+            return
+        self._purged = now
+        for name, room in list(self._rooms.items()):
+            if not room.subscribers and now - room.touched > self.ttl:
+                del self._rooms[name]
+
+    async def publish(self, name: str, message: dict):
+        """Store an offer/answer/candidate/clear message and push it to the room"""
+        kind = check_message(message)
+        room = self.room(name)
+        if kind == "offer":
+            room.offer = {"type": "offer", "sdp": message.get("sdp")}
+            room.stream_path = message.get("stream_path")
+            # a new offer starts a new negotiation
+            room.answer = None
+            room.candidates = {"offer": [], "answer": []}
+        elif kind == "answer":
+            room.answer = {"type": "answer", "sdp": message.get("sdp")}
+        elif kind == "candidate":
+            role = "answer" if message.get("role") == "answer" else "offer"
+            room.candidates[role].append(message.get("candidate"))
+        else:
+            room.offer = room.answer = room.stream_path = None
+            room.candidates = {"offer": [], "answer": []}
+
+        for queue in room.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        async with room.changed:
+            room.changed.notify_all()
+
+    async def state(self, name: str) -> dict:
+        """Offer, answer, stream_path and candidates of the room"""
+        room = self.room(name)
+        return {
+            "offer": room.offer,
+            "answer": room.answer,
+            "stream_path": room.stream_path,
+            "candidates": room.candidates,
+        }
+
+    async def wait_for(self, name: str, key: str, timeout: float) -> Optional[dict]:
+        """Value of `key` ("offer"/"answer"), waiting up to `timeout` for it to appear"""
+        room = self.room(name)
+        try:
+            async with room.changed:
+                await asyncio.wait_for(
+                    room.changed.wait_for(lambda: getattr(room, key) is not None),
+                    min(timeout, MAX_LONG_POLL),
+                )
+        except asyncio.TimeoutError:
+            pass
+        return getattr(room, key)
+
+    async def subscribe(self, name: str) -> AsyncIterator[dict]:
+        """Messages of the room: the current state first, then every new one"""
+        room = self.room(name)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+        room.subscribers.add(queue)
+        try:
+            for message in snapshot(await self.state(name)):
+                yield message
+            while True:
+                yield await queue.get()
+        finally:
+            room.subscribers.discard(queue)
+            room.touched = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "subscribers": sum(len(room.subscribers) for room in self._rooms.values()),
+        }
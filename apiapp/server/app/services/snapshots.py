@@ -0,0 +1,216 @@
+import asyncio
+import fractions
+import hashlib
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
+
+import av
+from av.frame import Frame
+from av.packet import Packet
+from av.video.reformatter import VideoReformatter
+
+from app.services.sources import SourceOpenError, SourceRegistry, public_url
+
+# Image formats: PyAV encoder and the pixel format it takes
+SNAPSHOT_FORMATS = {
+    "jpeg": ("mjpeg", "yuvj420p", "image/jpeg"),
+    "webp": ("libwebp", "yuv420p", "image/webp"),
+}
+
+
+class Snapshot:
+    """An encoded picture of a camera"""
+
+    def __init__(self, data: bytes, pts: Optional[int]):
+        self.data = data
+        self.etag = '"' + hashlib.sha1(data).hexdigest()[:16] + '"'
+        # wall clock, for Last-Modified
+        self.modified = time.time()
+        # pts of the picture it was encoded from: the same picture is not encoded twice
+        self.pts = pts
+        self.taken = time.monotonic()
+
+    @property
+    def last_modified(self) -> str:
+        return formatdate(self.modified, usegmt=True)
+
+    def matches(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        """Whether the client has this picture already (a conditional GET gets 304)"""
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag in tags
+        if if_modified_since is not None:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= int(self.modified)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+def encode_picture(
+    picture: Union[Frame, Packet],
+    codec: Optional[str],
+    image_format: str,
+    width: Optional[int],
+    quality: int,
+) -> bytes:
+    """
+    JPEG/WebP of a decoded frame, or of an encoded keyframe (passthrough
+    sources keep those). Blocking: run it in a worker thread.
+    """
+    if isinstance(picture, Packet):
+        decoder = av.CodecContext.create(codec, "r")
+        frames = decoder.decode(Packet(bytes(picture))) + decoder.decode(None)
+        if not frames:
+            raise SourceOpenError("The last keyframe of the camera can't be decoded")
+        picture = frames[-1]
+
+    encoder_name, pix_fmt, _ = SNAPSHOT_FORMATS[image_format]
+    out_width, out_height = picture.width, picture.height
+    if width and width < picture.width:
+        out_width = width - width % 2
+        out_height = max(2, round(picture.height * width / picture.width / 2) * 2)
+    encoder = av.CodecContext.create(encoder_name, "w")
+    encoder.width = out_width
+    encoder.height = out_height
+    encoder.pix_fmt = pix_fmt
+    encoder.time_base = fractions.Fraction(1, 1)
+    if image_format == "jpeg":
+        # quality 1..100 to the mjpeg quantizer 31..2
+        encoder.qmin = encoder.qmax = round(31 - quality / 100 * 29)
+    else:
+        encoder.options = {"quality": str(quality)}
+    # not picture.reformat(): the frame may be scaled in other threads at the same time
+    frame = VideoReformatter().reformat(
+        picture, width=out_width, height=out_height, format=pix_fmt
+    )
+    frame.pts = 0
+    return b"".join(bytes(packet) for packet in encoder.encode(frame) + encoder.encode(None))
+
+
+def pull_keyframe(url: str, timeout: float) -> Frame:
+    """
+    Connect to a camera nobody watches, decode its first keyframe and
+    disconnect. Blocking: run it in a worker thread.
+    """
+    try:
+        container = av.open(url, mode="r", timeout=(timeout, timeout))
+    except av.FFmpegError as exc:
+        raise SourceOpenError(f"Camera {public_url(url)} is not available: {exc.strerror}")
+    try:
+        stream = next(iter(container.streams.video), None)
+        if stream is None:
+            raise SourceOpenError(f"Camera {public_url(url)} has no video")
+        # the decoder skips everything but keyframes
+        stream.codec_context.skip_frame = "NONKEY"
+        deadline = time.monotonic() + timeout
+        for packet in container.demux(stream):
+            if time.monotonic() > deadline:
+                break
+            if not packet.is_keyframe:
+                continue
+            frames = packet.decode()
+            if not frames:
+                # frame threading holds the picture back: drain the decoder
+                frames = stream.codec_context.decode(None)
+            if not frames:
+                raise SourceOpenError(f"The keyframe of camera {public_url(url)} can't be decoded")
+            return frames[0]
+    except av.FFmpegError as exc:
+        raise SourceOpenError(f"Camera {public_url(url)} is not available: {exc.strerror}")
+    finally:
+        container.close()
+    raise SourceOpenError(f"Camera {public_url(url)} sent no keyframe in {timeout:g}s")
+
+
+class SnapshotCache:
+    """
+    Still pictures of cameras for dashboards. A camera with viewers gives its
+    latest keyframe (decoded frame in transcode mode); one without is
+    connected for a keyframe only. A picture is encoded at most once per
+    `interval` whatever the number of clients, and kept in an LRU bounded
+    to `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        registry: SourceRegistry,
+        interval: float = 2.0,
+        max_bytes: int = 32 * 1024 * 1024,
+        quality: int = 80,
+        pull_timeout: float = 5.0,
+    ):
+        self.registry = registry
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.pull_timeout = pull_timeout
+        self._cache: "OrderedDict[tuple, Snapshot]" = OrderedDict()
+        self._size = 0
+        # snapshots being taken: clients of the same camera share the work
+        self._pending: Dict[tuple, asyncio.Future] = {}
+        # encoding and keyframe pulls must not take the threads of the sources
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="snapshot")
+
+    async def get(self, url: str, image_format: str = "jpeg", width: Optional[int] = None) -> Snapshot:
+        key = (url, image_format, width)
+        cached = self._cache.get(key)
+        if cached is not None and time.monotonic() - cached.taken < self.interval:
+            self._cache.move_to_end(key)
+            return cached
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._take(key, cached))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        # shield: a client that went away must not cancel the others' snapshot
+        return await asyncio.shield(pending)
+
+    async def _take(self, key: Tuple[str, str, Optional[int]], cached: Optional[Snapshot]) -> Snapshot:
+        url, image_format, width = key
+        loop = asyncio.get_running_loop()
+        source = self.registry.find(url)
+        if source is not None:
+            picture = source.picture()
+            if picture is None:
+                raise SourceOpenError(f"Camera {public_url(url)} has no picture yet")
+            if cached is not None and cached.pts == picture.pts:
+                # nothing new since: same bytes, same ETag
+                cached.taken = time.monotonic()
+                return cached
+            codec = source.codec
+        else:
+            try:
+                picture = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, pull_keyframe, url, self.pull_timeout),
+                    self.pull_timeout * 2 + 1,
+                )
+            except asyncio.TimeoutError:
+                raise SourceOpenError(f"Camera {public_url(url)} did not answer in time")
+            codec = None
+        data = await loop.run_in_executor(
+            self._executor, encode_picture, picture, codec, image_format, width, self.quality
+        )
+        snapshot = Snapshot(data, picture.pts if source is not None else None)
+        self._store(key, snapshot)
+        return snapshot
+
+    def _store(self, key: tuple, snapshot: Snapshot):
+        previous = self._cache.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous.data)
+        self._cache[key] = snapshot
+        self._size += len(snapshot.data)
+        while self._size > self.max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._size -= len(evicted.data)
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "bytes": self._size}
+
+    def clear(self):
+        self._cache.clear()
+        self._size = 0
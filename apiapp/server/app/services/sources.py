@@ -0,0 +1,1231 @@
+import asyncio
+import errno
+import fractions
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Callable, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit, urlunsplit
+
+import av
+from aiortc import MediaStreamTrack, RTCRtpSender
+from aiortc.contrib.media import REAL_TIME_FORMATS
+from aiortc.mediastreams import MediaStreamError
+from av.frame import Frame
+from av.packet import Packet
+
+from app.configs.settings import get_settings
+from app.services.ladder import Adapter, RungEncoder, rung_bitrate
+from app.services.tracing import SourceTimings, tracer
+from app.services.workers import shard_of
+
+AUDIO_PTIME = 0.020  # 20ms audio packetization
+AUDIO_SAMPLE_RATE = 48000
+
+# Video codecs the RTP packetizer accepts as is (no decode/re-encode)
+PASSTHROUGH_CODECS = {"h264"}
+
+# NAL unit types of H.264: coded slices and sequence parameter set
+H264_NAL_SLICE = 1
+H264_NAL_IDR = 5
+H264_NAL_SPS = 7
+
+# Upper bound of the cached GOP: a camera with a huge keyframe interval
+# must not grow the cache without limit
+GOP_CACHE_MAX_PACKETS = 600
+
+# Pause between attempts to (re)connect a pinned camera, seconds
+PIN_RETRY_INTERVAL = 5.0
+
+# How many recent time-to-first-frame samples are kept per source
+TTFF_SAMPLES = 100
+
+# States of a source: reading the camera, or waiting to connect it again
+SOURCE_CONNECTED = "connected"
+SOURCE_RECONNECTING = "reconnecting"
+
+
+class SourceMode(str, Enum):
+    auto = "auto"
+    passthrough = "passthrough"
+    transcode = "transcode"
+
+
+class DecodeProfile(str, Enum):
+    """How much of the video a consumer of decoded frames needs"""
+
+    full = "full"
+    # decoder skip flags: non-reference frames and deblocking are skipped
+    reduced = "reduced"
+    # keyframes only: other packets never reach the decoder
+    keyframes = "keyframes"
+
+
+# Cheapest first: a source decodes for the most demanding of its consumers
+DECODE_ORDER = [DecodeProfile.keyframes, DecodeProfile.reduced, DecodeProfile.full]
+
+# Frames the decoder itself skips (AVCodecContext.skip_frame) for a profile
+DECODE_SKIP_FRAME = {
+    DecodeProfile.full: "DEFAULT",
+    DecodeProfile.reduced: "NONREF",
+    DecodeProfile.keyframes: "NONKEY",
+}
+
+
+def decode_demand(consumers) -> DecodeProfile:
+    """The profile that serves all `consumers` (ladder rungs need every frame)"""
+    return max(
+        (getattr(consumer, "profile", DecodeProfile.full) for consumer in consumers),
+        key=DECODE_ORDER.index,
+        default=DecodeProfile.full,
+    )
+
+
+class FrameSink:
+    """A consumer of decoded frames and its share of them: keyframes, every Nth frame"""
+
+    def __init__(self, sink, profile: DecodeProfile = DecodeProfile.full, every: int = 1):
+        self.sink = sink
+        self.profile = profile
+        self.every = max(1, every)
+        self._skipped = 0
+
+    def submit(self, frame: Frame):
+        if self.profile == DecodeProfile.keyframes and not frame.key_frame:
+            # decoded for a more demanding consumer
+            return
+        self._skipped += 1
+        if self._skipped >= self.every:
+            self._skipped = 0
+            self.sink.submit(frame)
+
+
+class SourceModeError(ValueError):
+    """Requested mode is not possible for the camera codec"""
+
+
+class SourceOpenError(Exception):
+    """Camera did not answer in time or refused the connection"""
+
+
+def public_url(url: str) -> str:
+    """URL without credentials, safe for logs and API responses"""
+    parts = urlsplit(url)
+    if not parts.password and not parts.username:
+        return url
+    netloc = parts.hostname or ""
+    if parts.port:
+        netloc = f"{netloc}:{parts.port}"
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+def _is_annexb(data: bytes) -> bool:
+    return data.startswith(b"\x00\x00\x01") or data.startswith(b"\x00\x00\x00\x01")
+
+
+def _has_sps(data: bytes) -> bool:
+    """Whether an Annex B access unit carries its own SPS"""
+    start = data.find(b"\x00\x00\x01")
+    while start != -1 and start + 3 < len(data):
+        if data[start + 3] & 0x1F == H264_NAL_SPS:
+            return True
+        start = data.find(b"\x00\x00\x01", start + 3)
+    return False
+
+
+def _is_reference(data: bytes) -> bool:
+    """
+    Whether other frames may depend on this Annex B access unit
+    (nal_ref_idc of its first slice is not zero).
+    """
+    start = data.find(b"\x00\x00\x01")
+    while start != -1 and start + 3 < len(data):
+        header = data[start + 3]
+        if H264_NAL_SLICE <= header & 0x1F <= H264_NAL_IDR:
+            return bool(header & 0x60)
+        start = data.find(b"\x00\x00\x01", start + 3)
+    return True
+
+
+def summarize(values) -> Optional[dict]:
+    """Count/avg/p50/max of recent samples in milliseconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "avg_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+        "max_ms": round(ordered[-1] * 1000, 1),
+    }
+
+
+class SourceTrack(MediaStreamTrack):
+    """
+    Track of one viewer, fed by the reader of the shared source.
+
+    Every viewer has its own bounded queue, so a slow network or encoder
+    only makes that viewer skip frames, never adds latency or stalls the source:
+    - decoded video keeps only the latest frame;
+    - encoded video drops non-reference frames first, then skips to the newest
+      keyframe, and as a last resort waits for the next one;
+    - audio drops the oldest frames.
+    Encoded video starts from a keyframe: without it nothing can be decoded.
+
+    With the ladder enabled the track can be moved to a lower rung (a scaled
+    copy encoded once by the source): the switch happens on a keyframe of
+    the new rung, so the receiver never gets an undecodable picture. Back
+    on the decoded frames of a transcoded source, the sender's encoder is
+    asked for a keyframe (`request_keyframe`) for the same reason.
+    """
+
+    def __init__(
+        self,
+        source: "Source",
+        kind: str,
+        requested_at: Optional[float] = None,
+        max_queue: int = 10,
+    ):
+        super().__init__()
+        self.kind = kind
+        self._source: Optional[Source] = source
+        self._passthrough = source.mode == SourceMode.passthrough
+        self.rung = 0
+        self.pending_rung: Optional[int] = None
+        self._wait_keyframe = self._encoded
+        self._max_queue = max(1, max_queue)
+        # (data, droppable, trace) triples
+        self._queue: deque = deque()
+        self._event = asyncio.Event()
+        self._requested_at = requested_at or time.monotonic()
+        self.first_frame_delay: Optional[float] = None
+        self.dropped = 0
+        self.frames_sent = 0
+        # time the sender spends between two reads: encoding, packetizing, sending
+        self.busy_time = 0.0
+        self.busy_frames = 0
+        self._returned_at: Optional[float] = None
+        # stage timestamps of the frame just returned by recv (tracing only)
+        self.trace: Optional[dict] = None
+        # makes the next frame the sender encodes a keyframe (set with the adapter)
+        self.request_keyframe: Optional[Callable[[], None]] = None
+
+    @property
+    def _encoded(self) -> bool:
+        # the lower rungs are always encoded by the source
+        return self.kind == "video" and (self._passthrough or self.rung > 0)
+
+    @property
+    def _latest_only(self) -> bool:
+        return self.kind == "video" and not self._encoded
+
+    def switch(self, rung: int):
+        """Move to another rung of the ladder on its next keyframe"""
+        if self._source is None:
+            return
+        self.pending_rung = None if rung == self.rung else rung
+        self._source.update_ladder()
+
+    def prime(self, cached: list):
+        """Start from the cached GOP: the whole of it is needed, no limit here"""
+        for data, droppable in cached:
+            if self._wait_keyframe and not data.is_keyframe:
+                continue
+            self._wait_keyframe = False
+            self._queue.append((data, droppable, None))
+        if self._queue:
+            self._event.set()
+
+    def put(
+        self,
+        data: Union[Frame, Packet, None],
+        droppable: bool = True,
+        rung: int = 0,
+        trace: Optional[dict] = None,
+    ):
+        if data is not None and rung != self.rung:
+            if rung != self.pending_rung:
+                return
+            encoded = self._passthrough or rung > 0
+            if encoded and not data.is_keyframe:
+                return
+            # a keyframe of the new rung: what is queued from the old one is not needed
+            self._queue.clear()
+            self.rung = rung
+            self.pending_rung = None
+            self._wait_keyframe = False
+            if not encoded and self.request_keyframe is not None:
+                # decoded frames: the sender's encoder kept its references from
+                # before the ladder, the receiver has long moved on from them
+                self.request_keyframe()
+            if self._source is not None:
+                self._source.update_ladder()
+        if data is not None:
+            if self._wait_keyframe:
+                if not data.is_keyframe:
+                    self.dropped += 1
+                    return
+                self._wait_keyframe = False
+            if self._latest_only:
+                self.dropped += len(self._queue)
+                self._queue.clear()
+            elif len(self._queue) >= self._max_queue and not self._shed(data):
+                return
+        self._queue.append((data, droppable, trace))
+        self._event.set()
+
+    def _shed(self, data: Union[Frame, Packet]) -> bool:
+        """
+        Make room in a full queue. Returns False when the new data
+        has to be dropped as well.
+        """
+        if not self._encoded:
+            self._queue.popleft()
+            self.dropped += 1
+            return True
+
+        # nobody refers to a non-reference frame: it goes without artifacts
+        for i, (queued, droppable, _) in enumerate(self._queue):
+            if droppable and not queued.is_keyframe:
+                del self._queue[i]
+                self.dropped += 1
+                return True
+
+        # everything before a keyframe is not needed to decode what follows
+        if data.is_keyframe:
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            return True
+        for i in range(len(self._queue) - 1, 0, -1):
+            if self._queue[i][0].is_keyframe:
+                for _ in range(i):
+                    self._queue.popleft()
+                self.dropped += i
+                return True
+
+        # a reference frame can't be dropped alone: resync on the next keyframe
+        self.dropped += len(self._queue) + 1
+        self._queue.clear()
+        self._wait_keyframe = True
+        return False
+
+    async def recv(self) -> Union[Frame, Packet]:
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self._returned_at is not None:
+            self.busy_time += time.perf_counter() - self._returned_at
+            self.busy_frames += 1
+
+        while not self._queue:
+            self._event.clear()
+            await self._event.wait()
+
+        data, _, trace = self._queue.popleft()
+        if trace is not None:
+            # every viewer adds its own stages to the shared ones
+            self.trace = dict(trace, dequeued=time.perf_counter())
+        if data is None:
+            self.stop()
+            raise MediaStreamError
+        if self.first_frame_delay is None and self.kind == "video":
+            self.first_frame_delay = time.monotonic() - self._requested_at
+            if self._source is not None:
+                self._source.record_ttff(self.first_frame_delay)
+        self.frames_sent += 1
+        self._returned_at = time.perf_counter()
+        return data
+
+    def stop(self):
+        super().stop()
+        if self._source is not None:
+            self._source.detach(self)
+            self._source = None
+
+
+class Source:
+    """
+    One opened RTSP source (one RTSP session, one demuxer, one decoder),
+    shared by every viewer of the same camera.
+
+    In passthrough mode the demuxed H.264 access units go straight to the
+    RTP packetizer; in transcode mode video is decoded once and encoded
+    by aiortc for every peer connection.
+    """
+
+    def __init__(self, url: str, mode: SourceMode = SourceMode.auto):
+        self.url = url
+        self.requested_mode = mode
+        self.mode: Optional[SourceMode] = None
+        self.codec: Optional[str] = None
+        self.refs = 0
+        # pinned cameras stay connected without viewers
+        self.pinned = False
+        # pending close of a source left without viewers (grace period)
+        self.idle_timer: Optional[asyncio.TimerHandle] = None
+        self.ended = asyncio.Event()
+        # ended while in use (a pin holds a reference too): the camera was lost,
+        # not closed after its viewers left
+        self.lost = False
+        self.ttff: deque = deque(maxlen=TTFF_SAMPLES)
+        self.on_first_frame: Optional[Callable[["Source", float], None]] = None
+        # frames a viewer may lag behind before its queue starts dropping
+        self.max_queue = 10
+        # scales of the ladder rungs, the first one is the source itself
+        self.ladder: list[float] = [1.0]
+        self.ladder_bitrate = 2_000_000
+        self._rung_encoders: Dict[int, RungEncoder] = {}
+        # snapshot for the reader thread, replaced as a whole on changes
+        self._active_rungs: Tuple[RungEncoder, ...] = ()
+        # consumers of the packets as demuxed (recorders, HLS) and of decoded
+        # video frames (MJPEG), same kind of snapshots
+        self._packet_sinks: tuple = ()
+        self._frame_sinks: tuple = ()
+        # counters of the reader thread, read by the metrics collector
+        self.frames_in = 0
+        self.frames_decoded = 0
+        self.decode_time = 0.0
+        self.timings = SourceTimings()
+
+        # a lost camera is connected again in the reader thread, viewers keep their
+        # tracks; `reconnect_give_up` seconds without success end the source (0: never)
+        self.reconnect = False
+        self.reconnect_delay: Tuple[float, float] = (0.5, 30.0)
+        self.reconnect_give_up = 300.0
+        # while the camera is away, the last picture is repeated this often, seconds
+        self.placeholder_interval = 1.0
+        self.state = SOURCE_CONNECTED
+        self.reconnects = 0
+        self.live = False
+        self._timeout: Optional[Tuple[float, float]] = None
+        # video timeline that continues over reconnects: seconds of the last
+        # published frame and when it was published
+        self._video_time: Optional[float] = None
+        self._video_wall = 0.0
+        # the last keyframe (passthrough) or frame (transcode), repeated while away
+        self._last_picture: Union[Frame, Packet, None] = None
+        self._audio_samples = 0
+
+        self._container = None
+        self._audio_stream = None
+        self._video_stream = None
+        self._bsf = None
+        self._extradata: Optional[bytes] = None
+        self._throttle = False
+        # decoding for the pictures of a passthrough source (a decoder of its own)
+        # or of the video (transcode), cut down while only frame sinks take them
+        self._decoder: Optional[av.CodecContext] = None
+        self._decode_profile = DecodeProfile.full
+        # false after a cut-down decoder or a new one: decode from a keyframe on
+        self._decoder_synced = True
+
+        self._tracks: set[SourceTrack] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._quit = threading.Event()
+
+        # video since the last keyframe (passthrough) or the last decoded frame
+        # (transcode): a new viewer starts from it instead of waiting for the camera
+        self._gop: list = []
+
+    @property
+    def has_audio(self) -> bool:
+        return self._audio_stream is not None
+
+    @property
+    def has_video(self) -> bool:
+        return self._video_stream is not None
+
+    def open(self, timeout: Optional[Tuple[float, float]] = None):
+        """
+        Connect to the camera and choose the video path.
+        Blocking: run it in a worker thread, never on the event loop.
+        `timeout` is (open, read) in seconds, as accepted by av.open.
+        """
+        self._timeout = timeout
+        container = av.open(self.url, mode="r", timeout=timeout)
+        try:
+            self._audio_stream = next(iter(container.streams.audio), None)
+            self._video_stream = next(iter(container.streams.video), None)
+            if self._video_stream is not None:
+                self.codec = self._video_stream.codec_context.name
+            self.mode = self._resolve_mode()
+        except Exception:
+            container.close()
+            raise
+        self._container = container
+
+        self._bsf = self._extradata = None
+        self._decoder = None
+        self._decode_profile = DecodeProfile.full
+        self._decoder_synced = True
+        if self.mode == SourceMode.passthrough:
+            extradata = self._video_stream.codec_context.extradata
+            if extradata and not _is_annexb(extradata):
+                # avcC (mp4/mkv files): convert to Annex B, as RTP packetizer expects
+                self._bsf = av.BitStreamFilterContext("h264_mp4toannexb", self._video_stream)
+            else:
+                self._extradata = extradata or None
+
+        formats = set(container.format.name.split(","))
+        self._throttle = not formats.intersection(REAL_TIME_FORMATS)
+        # the end of a file is the end, the end of a camera stream is a hiccup
+        self.live = not self._throttle
+
+    def _resolve_mode(self) -> SourceMode:
+        if self._video_stream is None:
+            return SourceMode.transcode
+        can_passthrough = self.codec in PASSTHROUGH_CODECS
+        if self.requested_mode == SourceMode.auto:
+            return SourceMode.passthrough if can_passthrough else SourceMode.transcode
+        if self.requested_mode == SourceMode.passthrough and not can_passthrough:
+            raise SourceModeError(
+                f"Codec '{self.codec}' can't be passed through, transcoding is required"
+            )
+        return self.requested_mode
+
+    def start(self):
+        """Start the reader thread (must be called from the event loop)"""
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.Thread(
+            name=f"source-reader {public_url(self.url)}", target=self._run, daemon=True
+        )
+        self._thread.start()
+
+    def attach(
+        self, requested_at: Optional[float] = None
+    ) -> Tuple[Optional[SourceTrack], Optional[SourceTrack]]:
+        """Create audio and video tracks for one more viewer"""
+        audio = video = None
+        if self.has_audio:
+            audio = SourceTrack(self, "audio", requested_at, self.max_queue)
+        if self.has_video:
+            video = SourceTrack(self, "video", requested_at, self.max_queue)
+            video.prime(self._gop)
+        for track in (audio, video):
+            if track is not None:
+                self._tracks.add(track)
+        return audio, video
+
+    def picture(self) -> Union[Frame, Packet, None]:
+        """The last keyframe (passthrough) or decoded frame (transcode) of the camera"""
+        return self._last_picture
+
+    def add_packet_sink(self, sink):
+        """`sink.submit(packet, video_stream, audio_stream)` for every packet, in the reader thread"""
+        self._packet_sinks = self._packet_sinks + (sink,)
+
+    def remove_packet_sink(self, sink):
+        self._packet_sinks = tuple(s for s in self._packet_sinks if s is not sink)
+
+    def add_frame_sink(
+        self, sink, profile: DecodeProfile = DecodeProfile.full, every: int = 1
+    ):
+        """
+        `sink.submit(frame)` for video frames, in the reader thread: all of them,
+        those the decoder keeps with skip flags set (reduced), or keyframes only;
+        of those every `every`-th. A camera watched by such sinks alone is
+        decoded no more than they need. The frame is shared by all sinks: scale
+        it with a VideoReformatter of the sink's own, frame.reformat() is not
+        safe across threads.
+        """
+        self._frame_sinks = self._frame_sinks + (FrameSink(sink, profile, every),)
+
+    def remove_frame_sink(self, sink):
+        self._frame_sinks = tuple(s for s in self._frame_sinks if s.sink is not sink)
+
+    @property
+    def decoding(self) -> Optional[str]:
+        """Profile the video is decoded with, None when it is not decoded"""
+        if self.mode == SourceMode.passthrough and not (self._active_rungs or self._frame_sinks):
+            return None
+        return self._decode_profile.value
+
+    def record_ttff(self, delay: float):
+        self.ttff.append(delay)
+        if self.on_first_frame is not None:
+            self.on_first_frame(self, delay)
+
+    def detach(self, track: SourceTrack):
+        self._tracks.discard(track)
+        if track.rung or track.pending_rung:
+            self.update_ladder()
+
+    def update_ladder(self):
+        """Run encoders only for the rungs somebody watches or switches to"""
+        wanted = set()
+        for track in self._tracks:
+            wanted.update(r for r in (track.rung, track.pending_rung) if r)
+        for rung in wanted - set(self._rung_encoders):
+            encoder = RungEncoder(
+                rung,
+                self.ladder[rung],
+                rung_bitrate(self.ladder_bitrate, self.ladder[rung]),
+                lambda r, packet: self._publish("video", packet, r),
+            )
+            encoder.start()
+            self._rung_encoders[rung] = encoder
+        for rung in set(self._rung_encoders) - wanted:
+            self._rung_encoders.pop(rung).stop()
+        # a viewer waits for a keyframe of its new rung: don't make it wait a GOP
+        for track in self._tracks:
+            if track.pending_rung:
+                self._rung_encoders[track.pending_rung].request_keyframe()
+        self._active_rungs = tuple(self._rung_encoders.values())
+
+    def ladder_stats(self) -> dict:
+        return {
+            "rungs": self.ladder,
+            "encoding": sorted(self._rung_encoders),
+        }
+
+    def _resync(self):
+        """
+        The camera is connected again: its stream continues from any frame,
+        encoded video of viewers resumes on the next keyframe.
+        """
+        self._gop = []
+        for track in self._tracks:
+            if track._encoded:
+                track._wait_keyframe = True
+
+    def close(self):
+        """
+        Stop reading. The reader thread closes the container itself:
+        joining it here could block the event loop on a hung camera.
+        """
+        self._quit.set()
+        for track in list(self._tracks):
+            track.put(None)
+        for encoder in self._rung_encoders.values():
+            encoder.stop()
+        self._rung_encoders.clear()
+        self._active_rungs = ()
+        if self._thread is None and self._container is not None:
+            # opened, but never started (open timed out on our side)
+            self._container.close()
+            self._container = None
+
+    # ---------- reader thread ----------
+
+    def _publish(
+        self,
+        kind: str,
+        data: Union[Frame, Packet, None],
+        rung: int = 0,
+        trace: Optional[dict] = None,
+    ):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._dispatch, kind, data, rung, trace)
+
+    def _dispatch(
+        self,
+        kind: str,
+        data: Union[Frame, Packet, None],
+        rung: int = 0,
+        trace: Optional[dict] = None,
+    ):
+        if trace is not None:
+            trace["dispatched"] = time.perf_counter()
+            self.timings.stages["dispatch"].observe(trace["dispatched"] - trace["decoded"])
+        droppable = True
+        if data is None:
+            self.lost = self.refs > 0
+            self.ended.set()
+            self._gop = []
+        elif kind == "video":
+            if self.mode == SourceMode.passthrough or rung > 0:
+                droppable = not _is_reference(bytes(data))
+            if rung == 0:
+                self._cache(data, droppable)
+        for track in list(self._tracks):
+            if data is None:
+                track.put(None)
+            elif track.kind == kind and rung in (track.rung, track.pending_rung):
+                track.put(data, droppable, rung, trace)
+
+    def _cache(self, data: Union[Frame, Packet], droppable: bool):
+        if self.mode == SourceMode.transcode:
+            self._gop = [(data, droppable)]
+        elif data.is_keyframe:
+            self._gop = [(data, droppable)]
+        elif self._gop and len(self._gop) < GOP_CACHE_MAX_PACKETS:
+            self._gop.append((data, droppable))
+        else:
+            self._gop = []
+
+    def _video_packets(self, packet: Packet):
+        if self._bsf is not None:
+            yield from self._bsf.filter(packet)
+            return
+        if self._extradata and packet.is_keyframe and not _has_sps(bytes(packet)):
+            # parameter sets came in SDP only: receivers need them before every IDR
+            out = Packet(self._extradata + bytes(packet))
+            out.pts = packet.pts
+            out.dts = packet.dts
+            out.time_base = packet.time_base
+            out.is_keyframe = True
+            yield out
+            return
+        yield packet
+
+    def _decode(
+        self, packet: Packet, decoder: Optional[av.CodecContext] = None, drain: bool = False
+    ) -> list[Frame]:
+        started = time.perf_counter()
+        try:
+            decoder = decoder or packet.stream.codec_context
+            frames = decoder.decode(packet)
+            if drain:
+                # keyframes alone: no packets follow to push the picture out of
+                # the reorder delay of the decoder
+                for frame in decoder.decode(None):
+                    frame.time_base = packet.time_base
+                    frames.append(frame)
+                decoder.flush_buffers()
+        except av.FFmpegError as exc:
+            # a damaged packet (lost RTP) must not stop the source
+            logging.debug(f"Source {public_url(self.url)} decode error: {exc!r}")
+            return []
+        if packet.stream is self._video_stream:
+            self.decode_time += time.perf_counter() - started
+            self.frames_decoded += len(frames)
+        return frames
+
+    def _pictures(self, packet: Packet, consumers: tuple) -> list[Frame]:
+        """
+        Frames of a passthrough source for its rungs and frame sinks, by a
+        decoder of its own: opened again when their demand changes, as deblocking
+        is skipped only by a decoder opened so.
+        """
+        profile = decode_demand(consumers)
+        if self._decoder is None or profile != self._decode_profile:
+            codec = self._video_stream.codec_context
+            decoder = av.CodecContext.create(codec.name, "r")
+            decoder.extradata = codec.extradata
+            if profile == DecodeProfile.reduced:
+                decoder.options = {"skip_loop_filter": "all"}
+            decoder.skip_frame = DECODE_SKIP_FRAME[profile]
+            self._decoder = decoder
+            self._decode_profile = profile
+            self._decoder_synced = False
+        if not packet.is_keyframe and (
+            not self._decoder_synced or profile == DecodeProfile.keyframes
+        ):
+            return []
+        self._decoder_synced = True
+        return self._decode(packet, self._decoder, drain=profile == DecodeProfile.keyframes)
+
+    def _video_frames(self, packet: Packet, consumers: tuple) -> list[Frame]:
+        """
+        Frames of a transcoded source. Viewers need every one; frame sinks alone
+        may take less, then the decoder skips frames (not deblocking: it is open)
+        """
+        profile = DecodeProfile.full if self._tracks else decode_demand(consumers)
+        if profile != self._decode_profile:
+            if DECODE_ORDER.index(profile) > DECODE_ORDER.index(self._decode_profile):
+                # skipped frames were references: whole pictures from a keyframe on
+                self._decoder_synced = False
+            self._video_stream.codec_context.skip_frame = DECODE_SKIP_FRAME[profile]
+            self._decode_profile = profile
+        if not packet.is_keyframe and (
+            not self._decoder_synced or profile == DecodeProfile.keyframes
+        ):
+            return []
+        self._decoder_synced = True
+        return self._decode(packet, drain=profile == DecodeProfile.keyframes)
+
+    def _trace(self, data: Union[Frame, Packet], received: Optional[float]) -> Optional[dict]:
+        """Stage timestamps of a frame leaving the reader, when tracing is on"""
+        if received is None:
+            return None
+        decoded = time.perf_counter()
+        self.timings.stages["decode"].observe(decoded - received)
+        return {"pts": data.pts, "received": received, "decoded": decoded}
+
+    def _keep(self, data: Union[Frame, Packet]):
+        """Remember where the video timeline is and what to repeat while away"""
+        # B-frames come out of order: the timeline follows the latest pts
+        pts_time = float(data.pts * data.time_base)
+        if self._video_time is None or pts_time > self._video_time:
+            self._video_time = pts_time
+            self._video_wall = time.monotonic()
+        if self.mode == SourceMode.transcode or data.is_keyframe:
+            self._last_picture = data
+
+    def _video_offset(self, time_base: fractions.Fraction) -> int:
+        """Pts of the first frame of a connection: the timeline goes on over reconnects"""
+        if self._video_time is None:
+            return 0
+        return int((self._video_time + time.monotonic() - self._video_wall) / time_base)
+
+    def _placeholder(self) -> Union[Frame, Packet, None]:
+        """A copy of the last picture with a current pts"""
+        last = self._last_picture
+        if last is None:
+            return None
+        if isinstance(last, Packet):
+            out = Packet(bytes(last))
+            out.is_keyframe = True
+        else:
+            out = av.VideoFrame.from_ndarray(last.to_ndarray(format="yuv420p"), format="yuv420p")
+        out.time_base = last.time_base
+        out.pts = self._video_offset(last.time_base)
+        self._keep(out)
+        return out
+
+    def _hold(self, seconds: float):
+        """Wait, repeating the last picture: viewers see the camera is stalled, not gone"""
+        deadline = time.monotonic() + seconds
+        while not self._quit.is_set():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            if self._quit.wait(min(left, self.placeholder_interval)):
+                return
+            out = self._placeholder()
+            if out is not None:
+                self._publish("video", out)
+                if isinstance(out, Frame):
+                    for encoder in self._active_rungs + self._frame_sinks:
+                        encoder.submit(out)
+
+    def _reconnect(self) -> bool:
+        """
+        Connect to the camera again, with jittered exponential backoff.
+        False when the source has to end: reconnect is off, the source is a file,
+        the camera is away for too long or its codec changed.
+        """
+        if not self.reconnect or not self.live or self._quit.is_set():
+            return False
+        self.state = SOURCE_RECONNECTING
+        mode = self.mode
+        lost_at = time.monotonic()
+        delay, max_delay = self.reconnect_delay
+        while not self._quit.is_set():
+            if self.reconnect_give_up and time.monotonic() - lost_at > self.reconnect_give_up:
+                logging.warning(f"Source {public_url(self.url)} gave up reconnecting")
+                return False
+            # jitter: cameras lost together (a switch reboot) don't come back in lockstep
+            self._hold(random.uniform(delay / 2, delay))
+            if self._quit.is_set():
+                return False
+            try:
+                self.open(self._timeout)
+            except av.FFmpegError as exc:
+                logging.info(f"Source {public_url(self.url)} reconnect failed: {exc.strerror}")
+                delay = min(delay * 2, max_delay)
+                continue
+            except SourceModeError as exc:
+                logging.warning(f"Source {public_url(self.url)} can't resume: {exc}")
+                return False
+            if self.mode != mode:
+                # viewers negotiated the old path: they have to come again
+                logging.warning(f"Source {public_url(self.url)} changed codec to {self.codec}")
+                self._container.close()
+                return False
+            self.reconnects += 1
+            self.state = SOURCE_CONNECTED
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._resync)
+            logging.info(f"Source {public_url(self.url)} reconnected")
+            return True
+        return False
+
+    def _run(self):
+        resampler = av.AudioResampler(
+            format="s16",
+            layout="stereo",
+            rate=AUDIO_SAMPLE_RATE,
+            frame_size=int(AUDIO_SAMPLE_RATE * AUDIO_PTIME),
+        )
+        try:
+            while not self._quit.is_set():
+                self._read(self._container, resampler)
+                if not self._reconnect():
+                    break
+        finally:
+            self._publish("video", None)
+
+    def _read(self, container, resampler: av.AudioResampler):
+        """Read one connection to the camera until it ends"""
+        streams = [s for s in (self._audio_stream, self._video_stream) if s is not None]
+        audio_time_base = fractions.Fraction(1, AUDIO_SAMPLE_RATE)
+        video_first_pts = None
+        video_offset = 0
+        start_time = time.time()
+
+        try:
+            demuxer = container.demux(*streams)
+            while not self._quit.is_set():
+                try:
+                    packet = next(demuxer)
+                except av.FFmpegError as exc:
+                    if exc.errno == errno.EAGAIN:
+                        time.sleep(0.01)
+                        continue
+                    raise
+                if not packet.size:
+                    break
+
+                # files are read at their own pace, cameras at theirs
+                if self._throttle and packet.pts is not None and packet.time_base:
+                    wait = start_time + float(packet.pts * packet.time_base) - time.time()
+                    if wait > 0:
+                        time.sleep(min(wait, 1.0))
+                # after the pacing of files: it is not a delay of the pipeline
+                received = tracer.now()
+
+                # recorded as they come from the camera: no bitstream filter, no decoding
+                sinks = self._packet_sinks
+                if sinks and packet.pts is not None:
+                    for sink in sinks:
+                        sink.submit(packet, self._video_stream, self._audio_stream)
+
+                if packet.stream is self._video_stream:
+                    if packet.pts is None:
+                        continue
+                    self.frames_in += 1
+                    if received is not None:
+                        self.timings.arrived(received, float(packet.pts * packet.time_base))
+                    # camera streams don't start at pts 0, cancel out offset
+                    # (and continue the timeline of the previous connection)
+                    if video_first_pts is None:
+                        video_first_pts = packet.pts
+                        video_offset = self._video_offset(packet.time_base)
+                    shift = video_offset - video_first_pts
+                    # ladder rungs and frame sinks: everything that wants pictures
+                    rungs = self._active_rungs + self._frame_sinks
+                    if self.mode == SourceMode.passthrough:
+                        # lower rungs need pictures: decode only while they are watched
+                        # (before the bitstream filter, which takes the packet over)
+                        if rungs:
+                            for frame in self._pictures(packet, rungs):
+                                if frame.pts is not None:
+                                    frame.pts += shift
+                                    for encoder in rungs:
+                                        encoder.submit(frame)
+                        for out in self._video_packets(packet):
+                            out.pts += shift
+                            self._keep(out)
+                            self._publish("video", out, trace=self._trace(out, received))
+                    else:
+                        for frame in self._video_frames(packet, rungs):
+                            if frame.pts is None:
+                                continue
+                            frame.pts += shift
+                            self._keep(frame)
+                            self._publish("video", frame, trace=self._trace(frame, received))
+                            for encoder in rungs:
+                                encoder.submit(frame)
+                else:
+                    for frame in self._decode(packet):
+                        for out in resampler.resample(frame):
+                            out.pts = self._audio_samples
+                            out.time_base = audio_time_base
+                            self._audio_samples += out.samples
+                            self._publish("audio", out)
+        except (StopIteration, av.FFmpegError) as exc:
+            if not self._quit.is_set():
+                logging.warning(f"Source {public_url(self.url)} ended: {exc!r}")
+        finally:
+            container.close()
+
+
+class Subscription:
+    """Tracks of one viewer, holds a reference to the shared source"""
+
+    def __init__(
+        self, registry: "SourceRegistry", source: Source, requested_at: Optional[float] = None
+    ):
+        self._registry = registry
+        self.source = source
+        self.audio, self.video = source.attach(requested_at)
+        self.adapter: Optional[Adapter] = None
+        self._closed = False
+
+    @property
+    def tracks(self) -> list[MediaStreamTrack]:
+        return [track for track in (self.audio, self.video) if track is not None]
+
+    @property
+    def dropped(self) -> int:
+        """Frames skipped because this viewer fell behind"""
+        return sum(track.dropped for track in self.tracks)
+
+    def adapt(self, sender: RTCRtpSender):
+        """Move the viewer along the ladder of the source by its receiver reports"""
+        if self.video is None or len(self.source.ladder) < 2:
+            return
+        self.adapter = Adapter(sender, self.video, len(self.source.ladder))
+        self.video.request_keyframe = sender._send_keyframe
+        self.adapter.start()
+
+    def close(self, linger: bool = True):
+        """`linger=False` closes a source left without viewers at once, no grace period"""
+        if self._closed:
+            return
+        self._closed = True
+        if self.adapter is not None:
+            self.adapter.stop()
+        for track in self.tracks:
+            track.stop()
+        self._registry.release(self.source, linger)
+
+
+class SourceRegistry:
+    """
+    Refcounted registry of RTSP sources keyed by URL and the mode the source
+    runs in (passthrough or transcode). A source serves every viewer its mode
+    fits, auto ones whatever it is, so a camera has one session as long as
+    nobody asks for the other path explicitly. The camera is opened on the
+    first viewer and closed after the last one leaves.
+    """
+
+    def __init__(self):
+        settings = get_settings()
+        self.open_timeout = settings.RTSP_OPEN_TIMEOUT
+        self.read_timeout = settings.RTSP_READ_TIMEOUT
+        self.max_queue = settings.WEBRTC_MAX_QUEUE
+        self.adaptive = settings.WEBRTC_ADAPTIVE
+        self.ladder = settings.WEBRTC_LADDER
+        self.ladder_bitrate = settings.WEBRTC_LADDER_BITRATE
+        self.reconnect = settings.RTSP_RECONNECT
+        self.reconnect_delay = (
+            settings.RTSP_RECONNECT_MIN_DELAY, settings.RTSP_RECONNECT_MAX_DELAY
+        )
+        self.reconnect_give_up = settings.RTSP_RECONNECT_GIVE_UP
+        self.placeholder_interval = settings.WEBRTC_PLACEHOLDER_INTERVAL
+        self.grace = settings.RTSP_SOURCE_GRACE
+        # av.open blocks on DESCRIBE/SETUP/PLAY: bounded pool, so that a storm
+        # of reconnects can't eat all threads of the default executor
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.RTSP_OPEN_WORKERS, thread_name_prefix="source-open"
+        )
+        # a worker process keeps only the pinned cameras of its own shard
+        self.pinned_urls: list[str] = [
+            url
+            for url in settings.RTSP_PINNED_SOURCES
+            if shard_of(url, settings.WEBRTC_WORKER_COUNT) == settings.WEBRTC_WORKER_INDEX
+        ]
+        self._sources: Dict[Tuple[str, SourceMode], Source] = {}
+        # cameras being opened right now: viewers of the same camera share the attempt
+        self._opening: Dict[Tuple[str, SourceMode], asyncio.Future] = {}
+        self._pin_tasks: list[asyncio.Task] = []
+        # sources that ended because the camera was lost, and how many times
+        # such a source was opened again
+        self._lost: set[Tuple[str, SourceMode]] = set()
+        self._reopens: Dict[Tuple[str, SourceMode], int] = {}
+        # time to first frame by kind of source, outlives the sources themselves
+        self._ttff = {
+            "pinned": deque(maxlen=TTFF_SAMPLES),
+            "cold": deque(maxlen=TTFF_SAMPLES),
+        }
+        # and its running totals, [seconds, count], for the metrics
+        self._ttff_totals = {"pinned": [0.0, 0], "cold": [0.0, 0]}
+
+    async def subscribe(self, url: str, mode: SourceMode = SourceMode.auto) -> Subscription:
+        requested_at = time.monotonic()
+        source = await self.acquire(url, mode)
+        return Subscription(self, source, requested_at)
+
+    async def acquire(self, url: str, mode: SourceMode = SourceMode.auto) -> Source:
+        """Take a reference to the source, opening the camera if needed"""
+        source = self._live(url, mode)
+        if source is None:
+            key = (url, mode)
+            opening = self._opening.get(key)
+            if opening is None and mode == SourceMode.auto:
+                # a transcoding open fits an auto viewer too (a passthrough one may
+                # fail on the codec, where auto would not)
+                opening = self._opening.get((url, SourceMode.transcode))
+            if opening is None:
+                opening = asyncio.ensure_future(self._open(url, mode))
+                self._opening[key] = opening
+                opening.add_done_callback(lambda _: self._opening.pop(key, None))
+            # shield: a cancelled viewer must not cancel the open for the others
+            source = await asyncio.shield(opening)
+        if source.idle_timer is not None:
+            # came back within the grace period (a page reload): reuse the session
+            source.idle_timer.cancel()
+            source.idle_timer = None
+        source.refs += 1
+        return source
+
+    def _live(self, url: str, mode: SourceMode) -> Optional[Source]:
+        """The open source of the camera that fits `mode`: auto takes passthrough first"""
+        if mode == SourceMode.auto:
+            modes = (SourceMode.passthrough, SourceMode.transcode)
+        else:
+            modes = (mode,)
+        for candidate in modes:
+            key = (url, candidate)
+            source = self._sources.get(key)
+            if source is None:
+                continue
+            if source.ended.is_set():
+                # camera dropped: the next viewer opens it again
+                del self._sources[key]
+                if source.lost:
+                    self._lost.add(key)
+                continue
+            return source
+        return None
+
+    async def _open(self, url: str, mode: SourceMode) -> Source:
+        source = Source(url, mode)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self._executor, source.open, (self.open_timeout, self.read_timeout)
+        )
+        try:
+            # waiting in the pool queue counts too: fail fast instead of piling up
+            await asyncio.wait_for(asyncio.shield(future), self.open_timeout + 1)
+        except asyncio.TimeoutError:
+            def close_late(f: asyncio.Future):
+                # the camera answered after we gave up: don't leak the session
+                if not f.cancelled() and f.exception() is None:
+                    source.close()
+
+            future.add_done_callback(close_late)
+            raise SourceOpenError(f"Camera {public_url(url)} did not answer in time")
+        except av.FFmpegError as exc:
+            raise SourceOpenError(f"Camera {public_url(url)} is not available: {exc.strerror}")
+
+        existing = self._live(url, source.mode)
+        if existing is not None:
+            # opened meanwhile for a viewer of another requested mode: one session is enough
+            source.close()
+            return existing
+        key = (url, source.mode)
+        source.on_first_frame = self._record_ttff
+        source.max_queue = self.max_queue
+        source.reconnect = self.reconnect
+        source.reconnect_delay = self.reconnect_delay
+        source.reconnect_give_up = self.reconnect_give_up
+        source.placeholder_interval = self.placeholder_interval
+        if self.adaptive:
+            source.ladder = self.ladder
+            source.ladder_bitrate = self.ladder_bitrate
+        source.start()
+        self._sources[key] = source
+        if key in self._lost:
+            self._lost.discard(key)
+            self._reopens[key] = self._reopens.get(key, 0) + 1
+        logging.info(
+            f"Source opened: {public_url(url)} ({source.codec}, {source.mode.value})"
+        )
+        return source
+
+    def release(self, source: Source, linger: bool = True):
+        source.refs -= 1
+        if source.refs > 0:
+            return
+        if linger and self.grace > 0 and not source.ended.is_set():
+            # keep the camera a little: a reloaded page asks for it again at once
+            source.idle_timer = asyncio.get_running_loop().call_later(
+                self.grace, self._close_idle, source
+            )
+            return
+        self._close(source)
+
+    def _close_idle(self, source: Source):
+        source.idle_timer = None
+        if source.refs == 0:
+            self._close(source)
+
+    def _close(self, source: Source):
+        key = (source.url, source.mode)
+        if self._sources.get(key) is source:
+            del self._sources[key]
+        if source.lost:
+            self._lost.add(key)
+        source.close()
+        logging.info(f"Source closed: {public_url(source.url)}")
+
+    def start_pinned(self):
+        """
+        Keep configured cameras connected in the background. A pin is in auto
+        mode: it holds the camera in whatever mode it runs, or opens it the
+        cheapest way, and viewers of every mode that fits it start warm.
+        """
+        for url in self.pinned_urls:
+            self._pin_tasks.append(asyncio.ensure_future(self._keep_pinned(url)))
+
+    async def _keep_pinned(self, url: str):
+        while True:
+            try:
+                source = await self.acquire(url, SourceMode.auto)
+            except (SourceOpenError, SourceModeError) as exc:
+                logging.warning(f"Pinned source: {exc}")
+                await asyncio.sleep(PIN_RETRY_INTERVAL)
+                continue
+            source.pinned = True
+            await source.ended.wait()
+            self.release(source)
+            await asyncio.sleep(PIN_RETRY_INTERVAL)
+
+    def sources(self) -> list[Source]:
+        return list(self._sources.values())
+
+    def find(self, url: str) -> Optional[Source]:
+        """An open source of the camera, in whatever mode"""
+        for (source_url, _), source in self._sources.items():
+            if source_url == url and not source.ended.is_set():
+                return source
+        return None
+
+    def reconnects(self, source: Source) -> int:
+        """Reconnects within the source and reopens after it ended"""
+        reopens = self._reopens.get((source.url, source.mode), 0)
+        return reopens + source.reconnects
+
+    def stats(self) -> list[dict]:
+        return [
+            {
+                "url": public_url(source.url),
+                "viewers": source.refs - int(source.pinned),
+                "codec": source.codec,
+                "mode": source.mode.value if source.mode else None,
+                "pinned": source.pinned,
+                "idle": source.idle_timer is not None,
+                "state": source.state,
+                "reconnects": self.reconnects(source),
+                "ladder": source.ladder_stats(),
+                "decoding": source.decoding,
+                "time_to_first_frame": summarize(source.ttff),
+            }
+            for source in self._sources.values()
+        ]
+
+    def _record_ttff(self, source: Source, delay: float):
+        kind = "pinned" if source.pinned else "cold"
+        self._ttff[kind].append(delay)
+        totals = self._ttff_totals[kind]
+        totals[0] += delay
+        totals[1] += 1
+
+    def ttff_stats(self) -> dict:
+        """Time to first frame of pinned and cold sources, to compare them"""
+        return {kind: summarize(values) for kind, values in self._ttff.items()}
+
+    def ttff_totals(self) -> dict:
+        """Seconds to first frame and viewers, summed since the start, by kind of source"""
+        return {kind: tuple(totals) for kind, totals in self._ttff_totals.items()}
+
+    def close_all(self):
+        for task in self._pin_tasks:
+            task.cancel()
+        self._pin_tasks.clear()
+        for source in list(self._sources.values()):
+            if source.idle_timer is not None:
+                source.idle_timer.cancel()
+                source.idle_timer = None
+            source.close()
+        self._sources.clear()
+
+
+source_registry = SourceRegistry()
@@ -0,0 +1,104 @@
+import copy
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+from app.configs.settings import get_settings
+from app.services.signaling import SignalingStore
+
+# TURN servers handed to browsers until PUT /turn-config changes them
+DEFAULT_TURN_SERVERS = [
+    {
+        "urls": ["turn:localhost:3478?transport=udp", "turn:localhost:3478?transport=tcp"],
+        "username": "webrtc",
+        "credential": "webrtc"
+    },
+    {
+        "urls": ["turn:localhost:3479?transport=udp", "turn:localhost:3479?transport=tcp"],
+        "username": "test",
+        "credential": "test"
+    }
+]
+
+
+class StateBackend(ABC):
+    """
+    State the nodes of a deployment share: signaling rooms, TURN servers,
+    the nodes alive and which node owns a camera. Peer connections and
+    decoders can't be shared: they stay in their node, the backend only
+    tells the other nodes where they are (see services/cluster.py).
+    """
+
+    # offers/answers/candidates by room: SignalingStore or an alike
+    signaling = None
+
+    @abstractmethod
+    async def turn_servers(self) -> list:
+        ...
+
+    @abstractmethod
+    async def set_turn_servers(self, servers: list):
+        ...
+
+    @abstractmethod
+    async def heartbeat(self, node: str, url: str, ttl: float):
+        """Announce that `node` is alive at `url` for `ttl` seconds"""
+
+    @abstractmethod
+    async def node_url(self, node: str) -> Optional[str]:
+        """URL of a live node, None when it is gone"""
+
+    @abstractmethod
+    async def claim(self, key: str, node: str, ttl: float) -> str:
+        """
+        Make `node` the owner of `key` for `ttl` seconds, unless another live
+        node owns it already; returns the owner
+        """
+
+    async def close(self):
+        pass
+
+
+class MemoryState(StateBackend):
+    """State of a single node, in its memory"""
+
+    def __init__(self, signaling_ttl: float = 300.0):
+        self.signaling = SignalingStore(signaling_ttl)
+        self._turn_servers = copy.deepcopy(DEFAULT_TURN_SERVERS)
+        # node -> (url, alive until); key -> (owner, owned until)
+        self._nodes: Dict[str, tuple] = {}
+        self._claims: Dict[str, tuple] = {}
+
+    async def turn_servers(self) -> list:
+        return self._turn_servers
+
+    async def set_turn_servers(self, servers: list):
+        self._turn_servers = servers
+
+    async def heartbeat(self, node: str, url: str, ttl: float):
+        self._nodes[node] = (url, time.monotonic() + ttl)
+
+    async def node_url(self, node: str) -> Optional[str]:
+        url, until = self._nodes.get(node, (None, 0.0))
+        return url if until > time.monotonic() else None
+
+    async def claim(self, key: str, node: str, ttl: float) -> str:
+        now = time.monotonic()
+        owner, until = self._claims.get(key, (None, 0.0))
+        if owner is not None and owner != node and until > now and await self.node_url(owner):
+            return owner
+        self._claims[key] = (node, now + ttl)
+        return node
+
+
+def create_state() -> StateBackend:
+    """Backend of WEBRTC_STATE_BACKEND: "memory" (one node) or "redis" (shared)"""
+    settings = get_settings()
+    if settings.WEBRTC_STATE_BACKEND == "redis":
+        # redis is only needed by deployments of several nodes
+        from app.services.redis_state import RedisState
+
+        return RedisState(settings.WEBRTC_STATE_URL, settings.WEBRTC_SIGNALING_TTL)
+    if settings.WEBRTC_STATE_BACKEND != "memory":
+        raise ValueError(f"Unknown WEBRTC_STATE_BACKEND '{settings.WEBRTC_STATE_BACKEND}'")
+    return MemoryState(settings.WEBRTC_SIGNALING_TTL)
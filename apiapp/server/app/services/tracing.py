@@ -0,0 +1,172 @@
+import bisect
+import time
+import weakref
+from collections import deque
+from typing import Dict, Optional
+
+from aiortc import RTCRtpSender
+
+from app.configs.settings import get_settings
+
+# Upper bounds of the histogram buckets, milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+# Stages of a video frame, in order:
+# - receive: how late the packet came from the camera compared to its pts
+#   (RTSP/network buffering and jitter; demux happens inside FFmpeg with it)
+# - decode: demuxed packet to decoded frame (or filtered access unit in passthrough)
+# - dispatch: reader thread to the event loop
+# - queue: waiting in the viewer queue
+# - encode: aiortc encoder (transcode) or packing of the access unit (passthrough)
+# - packetize: RTP packetization and sending of all packets of the frame
+SOURCE_STAGES = ("receive", "decode", "dispatch")
+CONNECTION_STAGES = ("queue", "encode", "packetize", "total")
+
+
+class Histogram:
+    """Fixed buckets: constant memory and O(log buckets) per sample"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        ms = seconds * 1000
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total += ms
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket with the quantile (None: above the last one)"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self) -> Optional[dict]:
+        if not self.count:
+            return None
+        buckets = {f"le_{bound}": count for bound, count in zip(BUCKETS_MS, self.counts)}
+        buckets[f"gt_{BUCKETS_MS[-1]}"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 2),
+            "p50_ms": self.quantile(0.50),
+            "p90_ms": self.quantile(0.90),
+            "p99_ms": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+class Tracer:
+    """
+    Switch of latency tracing. When it is off, the media path only checks
+    `enabled`: no clocks, no allocations, so it stays in production builds.
+    """
+
+    def __init__(self, enabled: bool = False, samples: int = 200):
+        self.enabled = enabled
+        self.samples = samples
+
+    def now(self) -> Optional[float]:
+        return time.perf_counter() if self.enabled else None
+
+
+class SourceTimings:
+    """Histograms of the stages a source passes a frame through"""
+
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {stage: Histogram() for stage in SOURCE_STAGES}
+        # smallest (arrival - pts) seen: the reference of "on time"
+        self._offset: Optional[float] = None
+
+    def arrived(self, received: float, pts_time: float):
+        offset = received - pts_time
+        if self._offset is None or offset < self._offset:
+            self._offset = offset
+        self.stages["receive"].observe(offset - self._offset)
+
+    def to_dict(self) -> dict:
+        return {stage: histogram.to_dict() for stage, histogram in self.stages.items()}
+
+
+class ConnectionTimings:
+    """Histograms and recent traces of the frames one sender delivered"""
+
+    def __init__(self, samples: int):
+        self.stages: Dict[str, Histogram] = {
+            stage: Histogram() for stage in CONNECTION_STAGES
+        }
+        self.recent: deque = deque(maxlen=samples)
+
+    def finish(self, trace: dict):
+        durations = {
+            "queue": trace["dequeued"] - trace["dispatched"],
+            "encode": trace["encoded"] - trace["dequeued"],
+            "packetize": trace["sent"] - trace["encoded"],
+            "total": trace["sent"] - trace["received"],
+        }
+        for stage, seconds in durations.items():
+            self.stages[stage].observe(seconds)
+        self.recent.append(
+            {
+                "pts": trace["pts"],
+                "decode_ms": round((trace["decoded"] - trace["received"]) * 1000, 2),
+                "dispatch_ms": round((trace["dispatched"] - trace["decoded"]) * 1000, 2),
+                **{f"{stage}_ms": round(s * 1000, 2) for stage, s in durations.items()},
+            }
+        )
+
+    def to_dict(self, limit: int) -> dict:
+        return {
+            "stages": {stage: histogram.to_dict() for stage, histogram in self.stages.items()},
+            "recent": list(self.recent)[-limit:] if limit else [],
+        }
+
+
+# sender -> timings of the frames it sent
+_connections: "weakref.WeakKeyDictionary[RTCRtpSender, ConnectionTimings]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def trace_sender(sender: RTCRtpSender):
+    """
+    Time encode and packetize of every frame the sender takes from its track.
+    aiortc encodes and sends frame by frame in one loop: a frame is encoded
+    when `_next_encoded_frame` returns and sent when the loop asks for the
+    next one. The trace of the frame comes from the track (SourceTrack.trace).
+    """
+    timings = _connections.setdefault(sender, ConnectionTimings(tracer.samples))
+    next_encoded_frame = sender._next_encoded_frame
+    pending: list[dict] = []
+
+    async def _next_encoded_frame(codec):
+        if pending:
+            trace = pending.pop()
+            trace["sent"] = time.perf_counter()
+            timings.finish(trace)
+        encoded = await next_encoded_frame(codec)
+        if not tracer.enabled:
+            return encoded
+        track = sender.track
+        trace = getattr(track, "trace", None)
+        if trace is not None:
+            track.trace = None
+            if encoded is not None:
+                trace["encoded"] = time.perf_counter()
+                pending.append(trace)
+        return encoded
+
+    sender._next_encoded_frame = _next_encoded_frame
+
+
+def sender_timings(sender: RTCRtpSender) -> Optional[ConnectionTimings]:
+    return _connections.get(sender)
+
+
+tracer = Tracer(get_settings().WEBRTC_TRACE, get_settings().WEBRTC_TRACE_SAMPLES)
@@ -0,0 +1,73 @@
+import hashlib
+import secrets
+from typing import Optional
+
+from aiortc import RTCIceCandidate
+from aiortc.sdp import candidate_from_sdp
+
+SDP_MEDIA_TYPE = "application/sdp"
+# RFC 8840: ICE candidates trickled in a PATCH of a WHEP/WHIP session
+SDPFRAG_MEDIA_TYPE = "application/trickle-ice-sdpfrag"
+
+
+def new_resource_id(worker: int, node: str = "") -> str:
+    """
+    Session id; starts with the node (in a cluster) and the worker, so the
+    front of any node knows where the session lives
+    """
+    resource_id = f"{worker}-{secrets.token_urlsafe(12)}"
+    return f"{node}.{resource_id}" if node else resource_id
+
+
+def node_of_resource(resource_id: str) -> Optional[str]:
+    # the token and the worker have no dots, node ids (host names) may
+    node, _, _ = resource_id.rpartition(".")
+    return node or None
+
+
+def worker_of_resource(resource_id: str) -> int:
+    worker, _, _ = resource_id.rpartition(".")[2].partition("-")
+    return int(worker) if worker.isdigit() else 0
+
+
+def ice_ufrag(sdp: str) -> Optional[str]:
+    for line in sdp.splitlines():
+        if line.startswith("a=ice-ufrag:"):
+            return line[len("a=ice-ufrag:"):].strip()
+    return None
+
+
+def ice_etag(sdp: str) -> str:
+    """Entity tag of the ICE session: it changes only with an ICE restart"""
+    return '"' + hashlib.sha1((ice_ufrag(sdp) or "").encode()).hexdigest()[:16] + '"'
+
+
+def parse_sdpfrag(body: str) -> tuple[Optional[str], list[Optional[RTCIceCandidate]]]:
+    """
+    ICE ufrag and candidates of a trickle-ice-sdpfrag. `None` in the list
+    stands for end-of-candidates, as RTCPeerConnection.addIceCandidate expects.
+    """
+    ufrag = None
+    candidates: list[Optional[RTCIceCandidate]] = []
+    mid: Optional[str] = None
+    mline = -1
+    for line in body.splitlines():
+        line = line.strip()
+        if line.startswith("a=ice-ufrag:"):
+            ufrag = line[len("a=ice-ufrag:"):]
+        elif line.startswith("m="):
+            mline += 1
+            mid = None
+        elif line.startswith("a=mid:"):
+            mid = line[len("a=mid:"):]
+        elif line.startswith("a=candidate:"):
+            try:
+                candidate = candidate_from_sdp(line[len("a=candidate:"):])
+            except (AssertionError, ValueError, IndexError):
+                raise ValueError(f"Malformed candidate: {line}")
+            candidate.sdpMid = mid
+            candidate.sdpMLineIndex = max(mline, 0)
+            candidates.append(candidate)
+        elif line == "a=end-of-candidates":
+            candidates.append(None)
+    return ufrag, candidates
@@ -0,0 +1,233 @@
+import asyncio
+import itertools
+import logging
+import os
+import subprocess
+import sys
+import zlib
+from pathlib import Path
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+
+from app.configs.settings import get_settings
+
+# How long the dispatcher waits for a worker to answer an offer, seconds
+FORWARD_TIMEOUT = 30.0
+
+# Headers of an offer that belong to the connection to the front, not to the offer
+HOP_HEADERS = {"host", "content-length", "connection", "keep-alive", "transfer-encoding"}
+# Headers of a worker answer the client needs
+ANSWER_HEADERS = (
+    "content-type", "location", "etag", "retry-after", "last-modified", "cache-control"
+)
+
+# Directory with the `app` package: workers are started from it
+SERVER_ROOT = Path(__file__).resolve().parents[2]
+
+
+def shard_of(key: str, count: int) -> int:
+    """Worker that owns a camera: stable across restarts and processes"""
+    return zlib.crc32(key.encode()) % count
+
+
+async def proxy(
+    client: httpx.AsyncClient,
+    request: Request,
+    url: str,
+    upstream: str,
+    headers: Optional[dict] = None,
+    stream: bool = False,
+) -> Response:
+    """
+    Pass a request to `url` and return its answer as is; 503 when `upstream`
+    is down. `stream` relays the body as it comes (MJPEG never ends).
+    """
+    upstream_request = client.build_request(
+        request.method,
+        url,
+        params=request.query_params,
+        content=await request.body(),
+        # the upstream decides on admission: headers (priority class) go along
+        headers={
+            **{
+                name: value
+                for name, value in request.headers.items()
+                if name not in HOP_HEADERS
+            },
+            **(headers or {}),
+        },
+    )
+    try:
+        response = await client.send(upstream_request, stream=stream)
+    except httpx.HTTPError as exc:
+        raise HTTPException(status_code=503, detail=f"{upstream} is not available: {exc}")
+    answer_headers = {
+        name: response.headers[name]
+        for name in ANSWER_HEADERS
+        if name in response.headers
+    }
+    if stream:
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers=answer_headers,
+            background=BackgroundTask(response.aclose),
+        )
+    return Response(
+        content=response.content,
+        status_code=response.status_code,
+        headers=answer_headers,
+    )
+
+
+class WorkerPool:
+    """
+    Spreads sources and peer connections across N processes.
+
+    Every worker is a small uvicorn app with the WebRTC router. The front
+    process routes each offer to the worker that owns the camera (by hash of
+    the RTSP URL), so one camera is still opened once, and aggregates health
+    of all workers. Media flows between the browser and the worker directly.
+    """
+
+    def __init__(self):
+        settings = get_settings()
+        self.count = settings.WEBRTC_WORKERS
+        self.host = settings.WEBRTC_WORKER_HOST
+        self.base_port = settings.WEBRTC_WORKER_BASE_PORT
+        self._processes: list[subprocess.Popen] = []
+        self._client: Optional[httpx.AsyncClient] = None
+        self._round_robin = itertools.cycle(range(max(self.count, 1)))
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 0
+
+    def url(self, index: int) -> str:
+        return f"http://{self.host}:{self.base_port + index}"
+
+    def start(self, extra_env: Optional[dict] = None):
+        """Start the workers; `extra_env` is added to their environment"""
+        for index in range(self.count):
+            env = {
+                **os.environ,
+                **(extra_env or {}),
+                # the worker serves WebRTC itself and must not dispatch any further
+                "WEBRTC_WORKERS": "0",
+                "WEBRTC_WORKER_INDEX": str(index),
+                "WEBRTC_WORKER_COUNT": str(self.count),
+            }
+            command = [
+                sys.executable, "-m", "uvicorn", "app.worker:app",
+                "--host", self.host, "--port", str(self.base_port + index),
+            ]
+            self._processes.append(subprocess.Popen(command, env=env, cwd=SERVER_ROOT))
+        self._client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT)
+        logging.info(f"WebRTC workers started: {self.count}")
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        for process in self._processes:
+            process.terminate()
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            try:
+                await loop.run_in_executor(None, process.wait, 5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self._processes.clear()
+
+    def worker_for(self, key: Optional[str]) -> int:
+        if key is None:
+            return next(self._round_robin)
+        return shard_of(key, self.count)
+
+    async def forward(
+        self,
+        request: Request,
+        path: str,
+        key: Optional[str] = None,
+        index: Optional[int] = None,
+        stream: bool = False,
+    ) -> Response:
+        """
+        Pass a request to the worker that owns the camera (`key`), or to the
+        worker `index` (a WHEP/WHIP session lives there), and return its answer as is
+        """
+        if index is None:
+            index = self.worker_for(key)
+        return await proxy(
+            self._client, request, self.url(index) + path, f"WebRTC worker {index}", stream=stream
+        )
+
+    async def health(self) -> dict:
+        """Health of all workers merged into one answer"""
+
+        async def fetch(index: int) -> dict:
+            try:
+                response = await self._client.get(self.url(index) + "/webrtc/webrtc/health")
+                return {"worker": index, **response.json()}
+            except (httpx.HTTPError, ValueError) as exc:
+                return {"worker": index, "status": "unavailable", "error": str(exc)}
+
+        workers = await asyncio.gather(*(fetch(i) for i in range(self.count)))
+        merged = {
+            "status": "ok" if all(w["status"] == "ok" for w in workers) else "degraded",
+            "active_connections": sum(w.get("active_connections", 0) for w in workers),
+            "sources": [],
+            "connections": [],
+            "workers": [],
+        }
+        for w in workers:
+            for key in ("sources", "connections"):
+                merged[key].extend({"worker": w["worker"], **item} for item in w.get(key, []))
+            merged["workers"].append(
+                {
+                    "worker": w["worker"],
+                    "status": w["status"],
+                    "active_connections": w.get("active_connections", 0),
+                    "time_to_first_frame": w.get("time_to_first_frame"),
+                }
+            )
+        return merged
+
+    async def broadcast(self, method: str, path: str, params: Optional[dict] = None) -> list[dict]:
+        """Send the same request to every worker, answers labelled with the worker index"""
+
+        async def send(index: int) -> dict:
+            try:
+                response = await self._client.request(method, self.url(index) + path, params=params)
+                return {"worker": index, **response.json()}
+            except (httpx.HTTPError, ValueError) as exc:
+                return {"worker": index, "error": str(exc)}
+
+        return list(await asyncio.gather(*(send(i) for i in range(self.count))))
+
+    async def metrics(self) -> list[tuple]:
+        """Metric samples of all workers, labelled with the worker index"""
+
+        async def fetch(index: int) -> list[tuple]:
+            try:
+                response = await self._client.get(
+                    self.url(index) + "/webrtc/webrtc/metrics", params={"samples": "true"}
+                )
+                samples = response.json()
+            except (httpx.HTTPError, ValueError) as exc:
+                logging.warning(f"WebRTC worker {index} metrics: {exc!r}")
+                return []
+            return [
+                (name, {"worker": str(index), **labels}, value)
+                for name, labels, value in samples
+            ]
+
+        workers = await asyncio.gather(*(fetch(i) for i in range(self.count)))
+        return [sample for samples in workers for sample in samples]
+
+
+worker_pool = WorkerPool()
@@ -0,0 +1,21 @@
+from fastapi import FastAPI
+
+from fastapi.concurrency import asynccontextmanager
+
+# WebRTC worker process: serves offers routed by the front app (see services/workers.py)
+from app.routes.health import router as health_router
+from app.routes.webrtc import router as webrtc_router
+from app.routes.webrtc import start_webrtc, cleanup_webrtc
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_webrtc()
+    yield
+    await cleanup_webrtc()
+
+
+app = FastAPI(title="aivideolab webrtc worker", lifespan=lifespan)
+
+app.include_router(health_router)
+app.include_router(webrtc_router, prefix="/webrtc", tags=["WebRTC"])
@@ -0,0 +1,183 @@
+"""
+Signaling by room: the store behind long-poll (wait_for) and push delivery
+(subscribe: SSE and WebSocket), and the WebSocket endpoint itself.
+
+Run from apiapp/server: python -m pytest app_tests/api
+"""
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.api import app
+from app.routes.webrtc import signaling_events, state
+from app.services.signaling import SUBSCRIBER_QUEUE, SignalingStore
+
+OFFER = {"type": "offer", "sdp": "v=0 offer", "stream_path": "camera"}
+ANSWER = {"type": "answer", "sdp": "v=0 answer"}
+
+
+def candidate(n: int, role: str = "offer") -> dict:
+    return {"type": "candidate", "role": role, "candidate": f"candidate:{n}"}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+# ---------- store ----------
+
+def test_rooms_are_separate():
+    async def scenario():
+        store = SignalingStore()
+        await store.publish("a", OFFER)
+        return (await store.state("a"))["offer"], (await store.state("b"))["offer"]
+
+    offer_a, offer_b = run(scenario())
+    assert offer_a == {"type": "offer", "sdp": "v=0 offer"}
+    assert offer_b is None
+
+
+def test_new_offer_starts_a_new_negotiation():
+    async def scenario():
+        store = SignalingStore()
+        await store.publish("room", OFFER)
+        await store.publish("room", ANSWER)
+        await store.publish("room", candidate(1, "answer"))
+        await store.publish("room", {**OFFER, "sdp": "v=0 second"})
+        return await store.state("room")
+
+    state = run(scenario())
+    assert state["offer"]["sdp"] == "v=0 second"
+    assert state["answer"] is None
+    assert state["candidates"] == {"offer": [], "answer": []}
+
+
+def test_unknown_message_is_refused():
+    store = SignalingStore()
+    with pytest.raises(ValueError):
+        run(store.publish("room", {"type": "bye"}))
+    with pytest.raises(ValueError):
+        run(store.publish("room", ["offer"]))
+
+
+def test_long_poll_returns_when_the_answer_comes():
+    async def scenario():
+        store = SignalingStore()
+        waiting = asyncio.ensure_future(store.wait_for("room", "answer", 5))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        await store.publish("room", ANSWER)
+        return await asyncio.wait_for(waiting, 1)
+
+    assert run(scenario()) == ANSWER
+
+
+def test_long_poll_answers_at_once_when_there_is_an_offer():
+    async def scenario():
+        store = SignalingStore()
+        await store.publish("room", OFFER)
+        return await asyncio.wait_for(store.wait_for("room", "offer", 5), 0.5)
+
+    assert run(scenario())["sdp"] == OFFER["sdp"]
+
+
+def test_long_poll_times_out_empty():
+    assert run(SignalingStore().wait_for("room", "offer", 0.05)) is None
+
+
+def test_subscriber_gets_the_state_then_new_messages():
+    async def scenario():
+        store = SignalingStore()
+        await store.publish("room", OFFER)
+        await store.publish("room", candidate(1))
+        messages = store.subscribe("room")
+        received = [await messages.__anext__(), await messages.__anext__()]
+        await store.publish("room", ANSWER)
+        await store.publish("room", candidate(2, "answer"))
+        received += [await messages.__anext__(), await messages.__anext__()]
+        await messages.aclose()
+        return received, store.stats()
+
+    received, stats = run(scenario())
+    assert received == [OFFER, candidate(1), ANSWER, candidate(2, "answer")]
+    assert stats["subscribers"] == 0
+
+
+def test_lagging_subscriber_loses_the_oldest_messages():
+    async def scenario():
+        store = SignalingStore()
+        await store.publish("room", OFFER)
+        messages = store.subscribe("room")
+        await messages.__anext__()  # the state; the subscriber is queued from here on
+        for n in range(SUBSCRIBER_QUEUE + 5):
+            await store.publish("room", candidate(n))
+        received = [await messages.__anext__() for _ in range(SUBSCRIBER_QUEUE)]
+        await messages.aclose()
+        return received
+
+    received = run(scenario())
+    assert received[0] == candidate(5)
+    assert received[-1] == candidate(SUBSCRIBER_QUEUE + 4)
+
+
+def test_every_subscriber_gets_every_message():
+    async def scenario():
+        store = SignalingStore()
+        await store.publish("room", OFFER)
+        first, second = store.subscribe("room"), store.subscribe("room")
+        await first.__anext__()
+        await second.__anext__()
+        await store.publish("room", ANSWER)
+        received = [await first.__anext__(), await second.__anext__()]
+        await first.aclose()
+        await second.aclose()
+        return received
+
+    assert run(scenario()) == [ANSWER, ANSWER]
+
+
+# ---------- WebSocket ----------
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+def test_websocket_keeps_open_after_bad_messages(client):
+    with client.websocket_connect("/webrtc/signaling/ws?room=test-ws") as websocket:
+        websocket.send_text("{not json")
+        assert websocket.receive_json()["type"] == "error"
+        websocket.send_bytes(b"\x00")
+        assert websocket.receive_json()["type"] == "error"
+        websocket.send_json({"type": "bye"})
+        assert websocket.receive_json()["type"] == "error"
+        websocket.send_json(OFFER)
+        assert websocket.receive_json() == OFFER
+
+
+# ---------- SSE ----------
+
+def test_events_start_with_the_state_of_the_room():
+    # the endpoint's stream never ends: read it directly, not through the test client
+    async def scenario():
+        room = "test-sse"
+        await state.signaling.publish(room, OFFER)
+        await state.signaling.publish(room, candidate(1))
+        response = await signaling_events(room)
+        events = response.body_iterator
+        received = [await events.__anext__(), await events.__anext__()]
+        await state.signaling.publish(room, ANSWER)
+        received.append(await events.__anext__())
+        await events.aclose()
+        return response.media_type, received
+
+    media_type, received = run(scenario())
+    assert media_type == "text/event-stream"
+    assert received == [
+        f"event: offer\ndata: {json.dumps(OFFER)}\n\n",
+        f"event: candidate\ndata: {json.dumps(candidate(1))}\n\n",
+        f"event: answer\ndata: {json.dumps(ANSWER)}\n\n",
+    ]
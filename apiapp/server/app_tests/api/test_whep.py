@@ -0,0 +1,173 @@
+"""
+WHEP/WHIP sessions: trickle ICE with PATCH (RFC 8840 sdpfrags), its
+preconditions (ETag/If-Match, no ICE restart) and teardown with DELETE.
+
+Run from apiapp/server: python -m pytest app_tests/api
+"""
+import asyncio
+import fractions
+
+import av
+import pytest
+from aiortc import RTCPeerConnection, VideoStreamTrack
+from fastapi.testclient import TestClient
+
+from app.api import app
+from app.services.whep import SDP_MEDIA_TYPE, SDPFRAG_MEDIA_TYPE, ice_ufrag, parse_sdpfrag
+
+CANDIDATE = "1 1 udp 2130706431 192.0.2.1 50000 typ host"
+
+
+def sdpfrag(ufrag: str, *lines: str) -> str:
+    lines = [f"a=ice-ufrag:{ufrag}", "a=ice-pwd:0123456789abcdefghijkl", *lines]
+    return "\r\n".join(lines) + "\r\n"
+
+
+# ---------- parse_sdpfrag ----------
+
+def test_sdpfrag_candidates_keep_their_media_section():
+    ufrag, candidates = parse_sdpfrag(sdpfrag(
+        "abcd",
+        "m=audio 9 RTP/AVP 0",
+        "a=mid:0",
+        f"a=candidate:{CANDIDATE}",
+        "m=video 9 RTP/AVP 96",
+        "a=mid:1",
+        "a=candidate:2 1 udp 1694498815 198.51.100.7 40000 typ srflx raddr 0.0.0.0 rport 0",
+    ))
+    assert ufrag == "abcd"
+    assert [(c.sdpMid, c.sdpMLineIndex) for c in candidates] == [("0", 0), ("1", 1)]
+    assert candidates[0].ip == "192.0.2.1" and candidates[0].port == 50000
+    assert candidates[1].type == "srflx"
+
+
+def test_sdpfrag_without_media_section_goes_to_the_first_one():
+    ufrag, candidates = parse_sdpfrag(f"a=candidate:{CANDIDATE}\r\n")
+    assert ufrag is None
+    assert candidates[0].sdpMid is None and candidates[0].sdpMLineIndex == 0
+
+
+def test_sdpfrag_end_of_candidates_is_none():
+    _, candidates = parse_sdpfrag(sdpfrag(
+        "abcd", "m=audio 9 RTP/AVP 0", "a=mid:0", f"a=candidate:{CANDIDATE}",
+        "a=end-of-candidates",
+    ))
+    assert candidates[-1] is None and len(candidates) == 2
+
+
+def test_sdpfrag_malformed_candidate():
+    with pytest.raises(ValueError):
+        parse_sdpfrag("a=candidate:1 1 udp\r\n")
+
+
+# ---------- sessions ----------
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.fixture(scope="module")
+def camera(tmp_path_factory) -> str:
+    """A second of H.264 test picture standing in for the camera"""
+    path = tmp_path_factory.mktemp("camera") / "camera.mp4"
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("libx264", rate=25)
+        stream.width, stream.height, stream.pix_fmt = 320, 240, "yuv420p"
+        for i in range(25):
+            frame = av.VideoFrame(320, 240, "yuv420p")
+            frame.pts, frame.time_base = i, fractions.Fraction(1, 25)
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode(None))
+    return str(path)
+
+
+def client_offer(kind: str) -> str:
+    """
+    SDP offer of a client that plays (whep) or publishes (whip), without
+    candidates: they would be trickled, and the server has nothing to check
+    """
+    async def offer():
+        pc = RTCPeerConnection()
+        if kind == "whep":
+            pc.addTransceiver("video", direction="recvonly")
+        else:
+            pc.addTrack(VideoStreamTrack())
+        await pc.setLocalDescription(await pc.createOffer())
+        sdp = pc.localDescription.sdp
+        await pc.close()
+        return "".join(
+            line for line in sdp.splitlines(keepends=True) if not line.startswith("a=candidate:")
+        )
+
+    return asyncio.run(offer())
+
+
+@pytest.fixture(params=["whep", "whip"])
+def session(request, client, camera):
+    """(resource URL, ETag, client ufrag) of a new session"""
+    kind = request.param
+    offer = client_offer(kind)
+    response = client.post(
+        f"/webrtc/{kind}",
+        params={"path": camera} if kind == "whep" else None,
+        content=offer,
+        headers={"Content-Type": SDP_MEDIA_TYPE},
+    )
+    assert response.status_code == 201, response.text
+    assert response.headers["content-type"].startswith(SDP_MEDIA_TYPE)
+    resource = f"/webrtc/{response.headers['location']}"
+    yield resource, response.headers["etag"], ice_ufrag(offer)
+    client.delete(resource)
+
+
+def patch(client, resource: str, body: str, **headers):
+    return client.patch(
+        resource, content=body, headers={"Content-Type": SDPFRAG_MEDIA_TYPE, **headers}
+    )
+
+
+def test_trickle_with_current_etag(client, session):
+    resource, etag, ufrag = session
+    body = sdpfrag(ufrag, "m=video 9 RTP/AVP 96", "a=mid:0", f"a=candidate:{CANDIDATE}")
+    assert patch(client, resource, body, **{"If-Match": etag}).status_code == 204
+    # no If-Match: no precondition
+    assert patch(client, resource, body).status_code == 204
+
+
+def test_trickle_with_stale_etag_is_412(client, session):
+    resource, _, ufrag = session
+    response = patch(client, resource, sdpfrag(ufrag), **{"If-Match": '"0000000000000000"'})
+    assert response.status_code == 412
+
+
+def test_ice_restart_is_422(client, session):
+    resource, etag, ufrag = session
+    response = patch(client, resource, sdpfrag(ufrag + "x"), **{"If-Match": etag})
+    assert response.status_code == 422
+
+
+def test_trickle_needs_sdpfrag(client, session):
+    resource, _, ufrag = session
+    response = client.patch(
+        resource, content=sdpfrag(ufrag), headers={"Content-Type": "text/plain"}
+    )
+    assert response.status_code == 415
+
+
+def test_malformed_candidate_is_400(client, session):
+    resource, _, ufrag = session
+    assert patch(client, resource, sdpfrag(ufrag, "a=candidate:1 1 udp")).status_code == 400
+
+
+def test_deleted_session_is_404(client, session):
+    resource, _, ufrag = session
+    assert client.delete(resource).status_code == 200
+    assert client.delete(resource).status_code == 404
+    assert patch(client, resource, sdpfrag(ufrag)).status_code == 404
+
+
+def test_offer_must_be_sdp(client):
+    response = client.post("/webrtc/whip", content="v=0", headers={"Content-Type": "text/plain"})
+    assert response.status_code == 415
@@ -0,0 +1,539 @@
+"""
+Load test of the WebRTC API: how many viewers one instance can serve.
+
+A camera stand-in is prepared first:
+- by default a test pattern (lavfi testsrc, H.264) is written to a file,
+  which the server reads at its own pace, like a camera;
+- `--publish rtsp://localhost:8554/bench` pushes the test pattern in real time
+  into a running MediaMTX (infra/mediamtx.yml), to go through RTSP as well;
+- `--camera URL` uses an existing camera or RTSP path as is.
+
+Then N headless aiortc clients are connected for every step of `--viewers`:
+publisher clients post offers to /webrtc/offer and receive the camera,
+subscriber clients post offers to /webrtc/subscriber/offer and send a test
+track. The server is started locally (uvicorn, a free port) unless `--url`
+points to a running one; CPU and memory are measured only for a local server.
+
+Results are written as JSON (`--output`), one entry per scenario and step.
+`--compare baseline.json` exits with code 1 when a step got worse than the
+baseline by more than `--tolerance`, so regressions show up between releases.
+
+Usage (from apiapp/server):
+    python -m app_tests.load.benchmark --viewers 1,10,25 --duration 10 --output bench.json
+
+Clients decode the received video themselves: for hundreds of viewers run
+the load generator on another host than the server.
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import av
+import httpx
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+
+# Bump when the layout of the results changes
+SCHEMA_VERSION = 1
+
+SERVER_ROOT = Path(__file__).resolve().parents[2]
+
+# Test pattern of the camera stand-in
+PATTERN_SIZE = "1280x720"
+PATTERN_RATE = 30
+PATTERN_GOP = 60
+
+# How long a client waits for its connection and first frame, seconds
+CONNECT_TIMEOUT = 20.0
+
+# Metrics compared with the baseline: name -> True when higher is better
+COMPARED = {
+    "offers_per_second": True,
+    "offer_latency_ms.p90": False,
+    "time_to_first_frame_ms.p90": False,
+    "frame_interval_ms.p99": False,
+    "cpu_percent_per_stream": False,
+    "rss_mb_per_pc": False,
+}
+
+
+def percentiles(values: list[float]) -> Optional[dict]:
+    """p50/p90/p99/max of samples in seconds, reported in milliseconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+    return {
+        "count": len(ordered),
+        "p50": rank(0.50),
+        "p90": rank(0.90),
+        "p99": rank(0.99),
+        "max": round(ordered[-1] * 1000, 1),
+    }
+
+
+# ---------- camera stand-in ----------
+
+
+def _pattern(seconds: Optional[float] = None):
+    options = f"size={PATTERN_SIZE}:rate={PATTERN_RATE}"
+    if seconds:
+        options += f":duration={seconds}"
+    return av.open(f"testsrc={options}", format="lavfi")
+
+
+def _pattern_stream(output, realtime: bool):
+    stream = output.add_stream("libx264", rate=PATTERN_RATE)
+    width, height = PATTERN_SIZE.split("x")
+    stream.width, stream.height = int(width), int(height)
+    stream.pix_fmt = "yuv420p"
+    stream.codec_context.options = {
+        "g": str(PATTERN_GOP),
+        "preset": "ultrafast",
+        "tune": "zerolatency" if realtime else "film",
+    }
+    return stream
+
+
+def write_pattern(path: str, seconds: float):
+    """H.264 test pattern file: the server plays it at its own pace, like a camera"""
+    source = _pattern(seconds)
+    with av.open(path, "w") as output:
+        stream = _pattern_stream(output, realtime=False)
+        for frame in source.decode(video=0):
+            output.mux(stream.encode(frame))
+        output.mux(stream.encode(None))
+    source.close()
+
+
+class PatternPublisher:
+    """Pushes the test pattern to an RTSP server (MediaMTX) in real time"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._quit = threading.Event()
+        self._thread = threading.Thread(name="pattern-publisher", target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._quit.set()
+        self._thread.join(5)
+
+    def _run(self):
+        source = _pattern()
+        output = av.open(self.url, "w", format="rtsp", options={"rtsp_transport": "tcp"})
+        stream = _pattern_stream(output, realtime=True)
+        stream.codec_context.time_base = fractions.Fraction(1, PATTERN_RATE)
+        started = time.monotonic()
+        try:
+            for index, frame in enumerate(source.decode(video=0)):
+                if self._quit.is_set():
+                    break
+                wait = started + index / PATTERN_RATE - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                frame.pts = index
+                frame.time_base = stream.codec_context.time_base
+                output.mux(stream.encode(frame))
+        finally:
+            output.close()
+            source.close()
+
+
+# ---------- server under test ----------
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_tree(pid: int) -> list[int]:
+    """The process and its descendants (WebRTC workers), Linux only"""
+    children: dict[int, list[int]] = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(children.get(current, []))
+    return tree
+
+
+def cpu_seconds(pid: int) -> float:
+    total = 0
+    for child in process_tree(pid):
+        try:
+            fields = Path(f"/proc/{child}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime, in clock ticks
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def rss_mb(pid: int) -> float:
+    total = 0
+    for child in process_tree(pid):
+        try:
+            status = Path(f"/proc/{child}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1])
+    return total / 1024
+
+
+class LocalServer:
+    """The API started with uvicorn on a free port, for CPU/memory measurements"""
+
+    def __init__(self, env: dict):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._env = {**os.environ, **env}
+        self.process: Optional[subprocess.Popen] = None
+
+    async def start(self):
+        command = [
+            sys.executable, "-m", "uvicorn", "app.api:app",
+            "--host", "127.0.0.1", "--port", str(self.port), "--log-level", "warning",
+        ]
+        self.process = subprocess.Popen(command, env=self._env, cwd=SERVER_ROOT)
+        async with httpx.AsyncClient() as client:
+            for _ in range(100):
+                try:
+                    await client.get(self.url + "/webrtc/webrtc/health")
+                    return
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.2)
+        raise RuntimeError("Server did not start")
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(10)
+
+
+# ---------- clients ----------
+
+
+class Client:
+    """One headless viewer (publisher offer) or sender (subscriber offer)"""
+
+    def __init__(self, scenario: str):
+        self.scenario = scenario
+        self.pc = RTCPeerConnection()
+        self.offer_latency: Optional[float] = None
+        self.first_frame: Optional[float] = None
+        self.frames = 0
+        self.intervals: list[float] = []
+        self.error: Optional[str] = None
+        self._ready = asyncio.Event()
+        self._last_frame: Optional[float] = None
+        self._readers: list[asyncio.Task] = []
+
+    async def connect(self, client: httpx.AsyncClient, camera: str, mode: Optional[str]):
+        started = time.monotonic()
+        if self.scenario == "publisher":
+            self.pc.addTransceiver("video", direction="recvonly")
+            self.pc.addTransceiver("audio", direction="recvonly")
+            self.pc.on("track", lambda track: self._read(track, started))
+            path = "/webrtc/offer"
+            params = {"path": camera, **({"mode": mode} if mode else {})}
+        else:
+            self.pc.addTrack(VideoStreamTrack())
+
+            @self.pc.on("connectionstatechange")
+            def on_state():
+                if self.pc.connectionState == "connected":
+                    self.first_frame = time.monotonic() - started
+                    self._ready.set()
+
+            path = "/webrtc/subscriber/offer"
+            params = {}
+
+        await self.pc.setLocalDescription(await self.pc.createOffer())
+        offer = {"sdp": self.pc.localDescription.sdp, "type": self.pc.localDescription.type}
+        try:
+            response = await client.post(path, params=params, json=offer)
+        except httpx.HTTPError as exc:
+            self.error = f"{type(exc).__name__}"
+            return
+        self.offer_latency = time.monotonic() - started
+        if response.status_code != 200:
+            self.error = f"HTTP {response.status_code}"
+            return
+        await self.pc.setRemoteDescription(RTCSessionDescription(**response.json()))
+        try:
+            await asyncio.wait_for(self._ready.wait(), CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.error = "no first frame" if self.scenario == "publisher" else "not connected"
+
+    def _read(self, track, started: float):
+        if track.kind != "video":
+            return
+
+        async def run():
+            try:
+                while True:
+                    await track.recv()
+                    now = time.monotonic()
+                    if self.first_frame is None:
+                        self.first_frame = now - started
+                        self._ready.set()
+                    elif self._last_frame is not None:
+                        self.intervals.append(now - self._last_frame)
+                    self._last_frame = now
+                    self.frames += 1
+            except Exception:
+                pass
+
+        self._readers.append(asyncio.ensure_future(run()))
+
+    def reset_counters(self):
+        """Measure the steady state only, not the start"""
+        self.frames = 0
+        self.intervals = []
+
+    async def close(self):
+        for task in self._readers:
+            task.cancel()
+        await self.pc.close()
+
+
+async def run_step(
+    base_url: str,
+    scenario: str,
+    viewers: int,
+    args: argparse.Namespace,
+    camera: str,
+    server: Optional[LocalServer],
+) -> dict:
+    clients = [Client(scenario) for _ in range(viewers)]
+    limit = asyncio.Semaphore(args.concurrency)
+    pid = server.process.pid if server else None
+    idle_rss = rss_mb(pid) if pid else None
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=CONNECT_TIMEOUT) as http:
+
+        async def connect(client: Client):
+            async with limit:
+                await client.connect(http, camera, args.mode)
+
+        started = time.monotonic()
+        await asyncio.gather(*(connect(client) for client in clients))
+        connect_time = time.monotonic() - started
+
+        connected = [client for client in clients if client.error is None]
+        for client in connected:
+            client.reset_counters()
+        cpu_before = cpu_seconds(pid) if pid else None
+        steady_started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        steady = time.monotonic() - steady_started
+        cpu = cpu_seconds(pid) - cpu_before if pid else None
+        busy_rss = rss_mb(pid) if pid else None
+
+        await asyncio.gather(*(client.close() for client in clients))
+
+    errors: dict[str, int] = {}
+    for client in clients:
+        if client.error is not None:
+            errors[client.error] = errors.get(client.error, 0) + 1
+    result = {
+        "scenario": scenario,
+        "viewers": viewers,
+        "connected": len(connected),
+        "errors": errors,
+        "offers_per_second": round(viewers / connect_time, 2) if connect_time else None,
+        "offer_latency_ms": percentiles(
+            [c.offer_latency for c in clients if c.offer_latency is not None]
+        ),
+        # for subscribers: time until the connection is up
+        "time_to_first_frame_ms": percentiles(
+            [c.first_frame for c in connected if c.first_frame is not None]
+        ),
+        "frame_interval_ms": percentiles([i for c in connected for i in c.intervals]),
+        "fps_per_viewer": (
+            round(sum(c.frames for c in connected) / len(connected) / steady, 2)
+            if connected and scenario == "publisher"
+            else None
+        ),
+        "cpu_percent_per_stream": (
+            round(cpu / steady / len(connected) * 100, 2) if cpu is not None and connected else None
+        ),
+        "rss_mb_idle": round(idle_rss, 1) if idle_rss is not None else None,
+        "rss_mb_per_pc": (
+            round((busy_rss - idle_rss) / len(connected), 2)
+            if busy_rss is not None and connected
+            else None
+        ),
+    }
+    # let the server release the sources before the next step
+    await asyncio.sleep(args.cooldown)
+    return result
+
+
+# ---------- results ----------
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SERVER_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metric(step: dict, name: str) -> Optional[float]:
+    value = step
+    for part in name.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Steps that got worse than the baseline by more than `tolerance` (0.2 = 20%)"""
+    previous = {(s["scenario"], s["viewers"]): s for s in baseline.get("steps", [])}
+    regressions = []
+    for step in results["steps"]:
+        old = previous.get((step["scenario"], step["viewers"]))
+        if old is None:
+            continue
+        for name, higher_is_better in COMPARED.items():
+            new_value, old_value = metric(step, name), metric(old, name)
+            if new_value is None or not old_value:
+                continue
+            change = (new_value - old_value) / abs(old_value)
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{step['scenario']} x{step['viewers']}: {name} {old_value} -> {new_value}"
+                )
+    return regressions
+
+
+async def main(args: argparse.Namespace) -> int:
+    publisher: Optional[PatternPublisher] = None
+    workdir = tempfile.TemporaryDirectory(prefix="webrtc-bench-")
+    if args.camera:
+        camera = args.camera
+    elif args.publish:
+        publisher = PatternPublisher(args.publish)
+        publisher.start()
+        camera = args.publish
+    else:
+        camera = os.path.join(workdir.name, "pattern.mp4")
+        # long enough to outlast every step
+        write_pattern(camera, len(args.viewers) * (args.duration + CONNECT_TIMEOUT) + 60)
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        env = {"DATA_ROOT": os.path.join(workdir.name, "data")}
+        if args.workers:
+            env["WEBRTC_WORKERS"] = str(args.workers)
+        server = LocalServer(env)
+        await server.start()
+        base_url = server.url
+
+    steps = []
+    try:
+        for scenario in args.scenarios:
+            for viewers in args.viewers:
+                step = await run_step(base_url, scenario, viewers, args, camera, server)
+                print(json.dumps(step), file=sys.stderr)
+                steps.append(step)
+    finally:
+        if server is not None:
+            server.stop()
+        if publisher is not None:
+            publisher.stop()
+        workdir.cleanup()
+
+    results = {
+        "schema": SCHEMA_VERSION,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "params": {
+            "server": args.url or "local",
+            "workers": args.workers,
+            "camera": "pattern" if not args.camera else "external",
+            "mode": args.mode,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "cpu_count": os.cpu_count(),
+        },
+        "steps": steps,
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="running server, e.g. http://localhost:7100 (default: start one)")
+    parser.add_argument("--camera", help="camera URL or path as passed to /webrtc/offer")
+    parser.add_argument("--publish", help="push the test pattern to this RTSP URL (MediaMTX)")
+    parser.add_argument(
+        "--viewers", default="1,10,25",
+        type=lambda value: [int(n) for n in value.split(",")],
+        help="comma separated numbers of clients, one step each",
+    )
+    parser.add_argument(
+        "--scenarios", default="publisher,subscriber",
+        type=lambda value: value.split(","),
+        help="publisher (/webrtc/offer), subscriber (/webrtc/subscriber/offer)",
+    )
+    parser.add_argument("--mode", choices=["auto", "passthrough", "transcode"])
+    parser.add_argument("--workers", type=int, default=0, help="WEBRTC_WORKERS of a local server")
+    parser.add_argument("--duration", type=float, default=10.0, help="steady state per step, s")
+    parser.add_argument("--concurrency", type=int, default=10, help="offers in flight at once")
+    parser.add_argument("--cooldown", type=float, default=2.0, help="pause between steps, s")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    parser.add_argument("--compare", help="baseline results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, 0.2 = 20%%")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urljoin, urlsplit
+
+import aiohttp
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamTrack
+
+# How often the bitrate of an upstream connection is sampled, seconds
+STATS_INTERVAL = 5.0
+
+# Frames whose arrival time is remembered for the relay latency
+RECEIVED_FRAMES = 300
+
+
+def public_path(path: str) -> str:
+    """Camera path without credentials, for logs and metric labels"""
+    parts = urlsplit(path)
+    if parts.username is None and parts.password is None:
+        return path
+    return parts._replace(netloc=parts.hostname + (f":{parts.port}" if parts.port else "")).geturl()
+
+
+class LatencyStats:
+    """
+    Relay latency of all relayed frames: count and total, never reset, so
+    that every scraper gets the mean over its own interval from the deltas
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+
+
+class UpstreamTrack(MediaStreamTrack):
+    """A track received from upstream, noting when each frame came out of it"""
+
+    def __init__(self, source: "UpstreamSource", track: MediaStreamTrack):
+        super().__init__()
+        self.kind = track.kind
+        self.source = source
+        self.track = track
+
+    async def recv(self):
+        frame = await self.track.recv()
+        received = self.source.received
+        received[(self.kind, frame.pts)] = time.monotonic()
+        while len(received) > RECEIVED_FRAMES:
+            received.popitem(last=False)
+        return frame
+
+
+class ViewerTrack(MediaStreamTrack):
+    """A relayed track of one viewer, measuring how long frames took to reach it"""
+
+    def __init__(self, source: "UpstreamSource", track: MediaStreamTrack):
+        super().__init__()
+        self.kind = track.kind
+        self.source = source
+        self.track = track
+
+    async def recv(self):
+        frame = await self.track.recv()
+        received = self.source.received.get((self.kind, frame.pts))
+        if received is not None:
+            self.source.latency[self.kind].add(time.monotonic() - received)
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.track.stop()
+
+
+class UpstreamSource:
+    """
+    One camera pulled from an upstream apiapp node over WHEP and fanned out
+    to the viewers of this edge: the upstream sends one stream per edge
+    instead of one per viewer.
+    """
+
+    def __init__(self, upstream_url: str, path: str):
+        self.upstream_url = upstream_url.rstrip("/") + "/"
+        self.path = path
+        self.refs = 0
+        self.relay = MediaRelay()
+        self.pc: Optional[RTCPeerConnection] = None
+        self.resource: Optional[str] = None
+        self.tracks: list[UpstreamTrack] = []
+        self.received: "OrderedDict[tuple, float]" = OrderedDict()
+        self.latency = {"audio": LatencyStats(), "video": LatencyStats()}
+        self.bitrate = 0.0
+        self.closed = asyncio.Event()
+        # set by whoever opens the source: viewers arriving meanwhile await it
+        self.opening: Optional[asyncio.Future] = None
+        self._stats_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def open(self):
+        pc = self.pc = RTCPeerConnection()
+        pc.addTransceiver("video", direction="recvonly")
+        pc.addTransceiver("audio", direction="recvonly")
+
+        @pc.on("connectionstatechange")
+        async def on_connectionstatechange():
+            logging.info(f"Upstream {public_path(self.path)} connection state: {pc.connectionState}")
+            if pc.connectionState in ("failed", "closed"):
+                # end the relayed tracks too: viewers see the camera gone and reconnect
+                self.closed.set()
+                await self.close()
+
+        await pc.setLocalDescription(await pc.createOffer())
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                urljoin(self.upstream_url, "whep"),
+                params={"path": self.path},
+                data=pc.localDescription.sdp,
+                headers={"Content-Type": "application/sdp"},
+            ) as response:
+                if response.status != 201:
+                    raise RuntimeError(
+                        f"Upstream refused {public_path(self.path)}: "
+                        f"{response.status} {await response.text()}"
+                    )
+                answer = await response.text()
+                # relative to the WHEP endpoint
+                self.resource = urljoin(self.upstream_url, response.headers["Location"])
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer, type="answer"))
+
+        # only the kinds the camera has: the others are inactive in the answer
+        self.tracks = [
+            UpstreamTrack(self, transceiver.receiver.track)
+            for transceiver in pc.getTransceivers()
+            if transceiver.currentDirection == "recvonly"
+        ]
+        self._stats_task = asyncio.ensure_future(self._sample_bitrate())
+
+    def subscribe(self) -> list[ViewerTrack]:
+        """Tracks for one more viewer"""
+        return [
+            ViewerTrack(self, self.relay.subscribe(track, buffered=False))
+            for track in self.tracks
+        ]
+
+    async def _sample_bitrate(self):
+        previous = None
+        while True:
+            report = await self.pc.getStats()
+            now = time.monotonic()
+            # aiortc counts bytes per transport only: media plus its RTCP
+            received = sum(
+                stats.bytesReceived for stats in report.values() if stats.type == "transport"
+            )
+            if previous is not None:
+                self.bitrate = 8 * (received - previous[0]) / (now - previous[1])
+            previous = (received, now)
+            await asyncio.sleep(STATS_INTERVAL)
+
+    async def close(self):
+        # a failed connection and the last viewer leaving may both close the source
+        if self._closing:
+            return
+        self._closing = True
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+        for track in self.tracks:
+            track.stop()
+        if self.pc is not None:
+            await self.pc.close()
+        if self.resource is not None:
+            # end the upstream session at once, instead of waiting for it to time out
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.delete(self.resource):
+                        pass
+            except aiohttp.ClientError as exc:
+                logging.warning(f"Upstream session of {public_path(self.path)} not deleted: {exc!r}")
+        self.closed.set()
+
+    def metrics(self) -> list[tuple]:
+        """(name, labels, value) samples of this camera"""
+        labels = {"camera": public_path(self.path)}
+        samples = [
+            ("edge_viewers", labels, self.refs),
+            ("edge_upstream_bitrate_bps", labels, round(self.bitrate)),
+        ]
+        for kind, stats in self.latency.items():
+            if not any(track.kind == kind for track in self.tracks):
+                continue
+            kind_labels = {**labels, "kind": kind}
+            samples.append(("edge_relay_latency_seconds_sum", kind_labels, round(stats.total, 6)))
+            samples.append(("edge_relay_latency_seconds_count", kind_labels, stats.count))
+        return samples
@@ -1,14 +1,23 @@
 import asyncio
 import logging
+import os
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from aiortc import RTCPeerConnection, RTCSessionDescription
-from aiortc.contrib.media import MediaPlayer
+from aiortc.contrib.media import MediaPlayer, MediaRelay
 from pydantic import BaseModel
 from typing import Optional, List
 
+from edge import UpstreamSource
+
 logging.basicConfig(level=logging.INFO)
 
+# Edge relay mode: base URL of the WebRTC router of an upstream apiapp node
+# (e.g. http://apiapp:8000/webrtc). Each camera is pulled from it once and
+# fanned out to the viewers here; empty -- cameras are opened directly
+UPSTREAM_URL = os.environ.get("WEBRTC_UPSTREAM_URL", "")
+
 app = FastAPI(title="WebRTC API")
 
 # CORS
@@ -23,6 +32,81 @@ app.add_middleware(
 # Store peer connections
 pcs = set()
 
+# Shared RTSP sources: url -> {"player", "relay", "refs"},
+# or camera path -> UpstreamSource in edge mode
+sources: dict = {}
+# Peer connection -> (rtsp url, source, relayed tracks)
+subscriptions: dict = {}
+
+
+def acquire_source(rtsp_url: str) -> tuple:
+    """Open the camera once and return it with relayed tracks for one more viewer"""
+    source = sources.get(rtsp_url)
+    if source is None:
+        source = {"player": MediaPlayer(rtsp_url), "relay": MediaRelay(), "refs": 0}
+        sources[rtsp_url] = source
+    source["refs"] += 1
+    player = source["player"]
+    return source, [
+        source["relay"].subscribe(track, buffered=False)
+        for track in (player.audio, player.video)
+        if track is not None
+    ]
+
+
+async def acquire_upstream(path: str) -> tuple:
+    """Pull the camera from upstream once and return it with relayed tracks for one more viewer"""
+    source = sources.get(path)
+    if source is None:
+        source = sources[path] = UpstreamSource(UPSTREAM_URL, path)
+        source.opening = asyncio.ensure_future(source.open())
+        asyncio.ensure_future(forget_when_closed(path, source))
+    source.refs += 1
+    try:
+        # viewers coming while the camera is being pulled wait for the same session
+        await asyncio.shield(source.opening)
+    except Exception:
+        if sources.get(path) is source:
+            del sources[path]
+        release_upstream(source)
+        raise
+    return source, source.subscribe()
+
+
+async def forget_when_closed(path: str, source: UpstreamSource):
+    """A lost upstream session is pulled again by the next viewer"""
+    await source.closed.wait()
+    if sources.get(path) is source:
+        del sources[path]
+
+
+def release_upstream(source: UpstreamSource):
+    source.refs -= 1
+    if source.refs <= 0:
+        source.closed.set()
+        asyncio.ensure_future(source.close())
+
+
+def release_source(pc: RTCPeerConnection):
+    """Drop viewer tracks, close the camera after the last viewer leaves"""
+    if pc not in subscriptions:
+        return
+    # the source this viewer got: the one under its url may be a newer one by now
+    rtsp_url, source, tracks = subscriptions.pop(pc)
+    for track in tracks:
+        track.stop()
+    if isinstance(source, UpstreamSource):
+        release_upstream(source)
+        return
+    source["refs"] -= 1
+    if source["refs"] <= 0:
+        if sources.get(rtsp_url) is source:
+            del sources[rtsp_url]
+        player = source["player"]
+        for track in (player.audio, player.video):
+            if track is not None:
+                track.stop()
+
 # TURN configuration storage
 turn_credentials: dict = {
     "servers": [
@@ -61,6 +145,8 @@ async def on_shutdown():
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
     pcs.clear()
+    for pc in list(subscriptions):
+        release_source(pc)
 
 
 # ========== TURN Configuration Endpoints ==========
@@ -105,19 +191,22 @@ async def publisher_offer(request: Request, path: Optional[str] = None):
         if pc.connectionState == "failed" or pc.connectionState == "closed":
             await pc.close()
             pcs.discard(pc)
-
-    # Get RTSP path
-    rtsp_url = path or "rtsp://192.168.0.138:554/live/ch0"
+            release_source(pc)
 
     try:
-        # Create media player from RTSP stream
-        player = MediaPlayer(rtsp_url)
-
-        if player.audio:
-            pc.addTrack(player.audio)
-
-        if player.video:
-            pc.addTrack(player.video)
+        if UPSTREAM_URL:
+            # Edge relay: one upstream session per camera for all viewers here
+            rtsp_url = path or "camera"
+            source, tracks = await acquire_upstream(rtsp_url)
+        else:
+            # Get RTSP path
+            rtsp_url = path or "rtsp://192.168.0.138:554/live/ch0"
+            # Shared media player: one RTSP session per camera for all viewers
+            source, tracks = acquire_source(rtsp_url)
+        subscriptions[pc] = (rtsp_url, source, tracks)
+
+        for track in tracks:
+            pc.addTrack(track)
 
         # Set remote description
         await pc.setRemoteDescription(offer)
@@ -134,6 +223,7 @@ async def publisher_offer(request: Request, path: Optional[str] = None):
         logging.error(f"Publisher error: {e}")
         await pc.close()
         pcs.discard(pc)
+        release_source(pc)
         raise
 
 
@@ -179,4 +269,27 @@ async def subscriber_offer(request: Request):
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "active_connections": len(pcs)}
+    return {
+        "status": "ok",
+        "mode": "edge" if UPSTREAM_URL else "direct",
+        "upstream": UPSTREAM_URL or None,
+        "active_connections": len(pcs),
+        "active_sources": len(sources),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Edge metrics in Prometheus text format, per camera: viewers, upstream
+    bitrate, and relay latency (sum and count counters) from a frame leaving
+    the upstream connection to a viewer's encoder taking it
+    """
+    lines = [f"edge_connections {len(pcs)}"]
+    for source in list(sources.values()):
+        if not isinstance(source, UpstreamSource) or not source.opening.done():
+            continue
+        for name, labels, value in source.metrics():
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+    return PlainTextResponse("\n".join(lines) + "\n")